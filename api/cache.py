@@ -0,0 +1,181 @@
+"""
+Persistent on-disk cache of the Quantalys responses
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from time import time
+from typing import TYPE_CHECKING, Dict, Tuple
+from urllib.parse import urlencode
+
+# httpx is only imported when a response is rebuilt, so that the default paths below are cheap to import
+if TYPE_CHECKING:
+    from httpx import Response
+
+# Default folder for the files kept between runs
+DATA_DIRECTORY = os.path.join(os.path.expanduser("~"), ".quantalys")
+
+DAY = 24 * 60 * 60
+
+# Time to live of the cached responses, per endpoint (seconds)
+DEFAULT_TTLS = {
+    "search": DAY,
+    "fast_search": 30 * DAY,
+    "page": DAY,
+    "composition": 7 * DAY,
+}
+
+# Only these headers are kept : the cached content is stored decoded
+KEPT_HEADERS = ["content-type", "etag", "last-modified"]
+
+# Access times of the hits are written in batches : a write transaction per hit would be slow,
+# and one left open would lock the cache for the other processes (shards, service)
+ACCESS_FLUSH_SIZE = 100
+ACCESS_FLUSH_INTERVAL = 5.0  # Seconds
+
+
+@dataclass
+class CacheConfig:
+    path: str = os.path.join(DATA_DIRECTORY, "http_cache.sqlite")
+    max_size: int = 500 * 1024 * 1024  # Bytes, least recently used entries are evicted above
+    ttls: Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_TTLS))
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidated: int = 0  # Stale entries confirmed by a 304 Not Modified
+    evicted: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.revalidated} revalidated, {self.misses} misses, {self.evicted} evicted"
+
+
+@dataclass
+class CacheEntry:
+    status_code: int
+    headers: Dict[str, str]
+    content: bytes
+    stored_at: float
+
+
+def request_key(method: str, url: str, data: Dict | None = None) -> str:
+    """Cache key of a request : method, url and form body"""
+    body = urlencode(sorted((str(k), str(v)) for k, v in data.items())) if data else ""
+    return hashlib.sha256(f"{method} {url}\n{body}".encode()).hexdigest()
+
+
+def entry_to_response(entry: CacheEntry, method: str, url: str) -> "Response":
+    from httpx import Request, Response
+    return Response(entry.status_code, headers=entry.headers, content=entry.content, request=Request(method, url))
+
+
+class ResponseCache:
+    """Size bounded LRU cache of responses, stored in a sqlite file"""
+
+    def __init__(self, config: CacheConfig | None = None):
+        self.config = config or CacheConfig()
+        self.stats = CacheStats()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.config.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.config.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            endpoint TEXT,
+            status_code INTEGER,
+            headers TEXT,
+            content BLOB,
+            size INTEGER,
+            stored_at REAL,
+            accessed_at REAL
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.accessed: Dict[str, float] = {}  # Access times of the hits not written yet
+        self.flushed_at = time()
+
+    def close(self) -> None:
+        self.flush_accesses()
+        self.db.close()
+
+    def flush_accesses(self) -> None:
+        """Write the access times of the latest hits, in a single short transaction"""
+        if len(self.accessed) > 0:
+            self.db.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                                [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+            self.db.commit()
+            self.accessed = {}
+        self.flushed_at = time()
+
+    def is_fresh(self, entry: CacheEntry, endpoint: str) -> bool:
+        return time() - entry.stored_at < self.config.ttls.get(endpoint, 0)
+
+    def get(self, key: str) -> CacheEntry | None:
+        row = self.db.execute(
+            "SELECT status_code, headers, content, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        self.accessed[key] = time()
+        if len(self.accessed) >= ACCESS_FLUSH_SIZE or time() - self.flushed_at > ACCESS_FLUSH_INTERVAL:
+            self.flush_accesses()
+        return CacheEntry(row[0], json.loads(row[1]), row[2], row[3])
+
+    def lookup(self, key: str, endpoint: str) -> Tuple[CacheEntry | None, bool]:
+        """Return the cached entry if any, and whether it can be used without revalidation"""
+        entry = self.get(key)
+
+        if entry is not None and self.is_fresh(entry, endpoint):
+            self.stats.hits += 1
+            return entry, True
+
+        self.stats.misses += 1
+        return entry, False
+
+    def put(self, key: str, endpoint: str, response: "Response") -> None:
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        content = response.content
+        now = time()
+
+        previous = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if previous is not None:
+            self.size -= previous[0]
+
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, endpoint, response.status_code, json.dumps(headers), content, len(content), now, now))
+        self.size += len(content)
+        self.accessed.pop(key, None)
+        self.evict()
+        self.db.commit()
+
+    def refresh(self, key: str) -> None:
+        """The server confirmed that the entry did not change : restart its TTL"""
+        self.stats.revalidated += 1
+        self.db.execute("UPDATE responses SET stored_at = ? WHERE key = ?", (time(), key))
+        self.db.commit()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in its maximum size"""
+        if self.size > self.config.max_size:
+            self.flush_accesses()  # The recent hits must not look unused
+        while self.size > self.config.max_size:
+            key, size = self.db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= size
+            self.stats.evicted += 1
+
+
+def conditional_headers(entry: CacheEntry) -> Dict[str, str]:
+    """Revalidation headers for a stale entry, when the server sent validators"""
+    headers = {}
+    if "etag" in entry.headers:
+        headers["If-None-Match"] = entry.headers["etag"]
+    if "last-modified" in entry.headers:
+        headers["If-Modified-Since"] = entry.headers["last-modified"]
+    return headers
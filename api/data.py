@@ -2,18 +2,44 @@
 Module that fetches the required fields using the requests module
 """
 import asyncio
-from api.quantalys import TypeCompo
-from api.requests import fonds_page_from_product_id, get_composition_table_from_product_id, main_page_search
+import hashlib
+from api.deadlines import Deadline, before_deadline
+from api.index import ProductIndex
+from api.exposures import CompositionBlock, ExposureStore, composition_block
+from api.fields import COMPOSITION, PAGE, FieldPlan
+from api.quantalys import TypeCompo, search_columns
+from api.requests import get_composition_table_from_product_id, main_page_search
+from api.session import Session, leave, share
+from api.snapshots import FRESHNESS_COLUMNS, PAGE_COLUMNS, FundRefresh
 from bs4 import BeautifulSoup, Tag
-from httpx import AsyncClient
-from typing import List, Dict, TypedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from httpx import Response
+from typing import Any, Awaitable, List, Dict, Tuple, TypedDict
+import importlib
+import multiprocessing
 import numpy as np
-import os
+import shutil
+
+# lxml builds the tree an order of magnitude faster than beautifulsoup : use it when installed
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
 
 LAST_BAR_LENGTH = 0  # Flush the progress bar
+# Results kept in memory per run, by ISIN and by product ID
+MEMO_SIZE = 100_000
 # Minimum percentage to be considered as a significant activity
 GEO_ACTIVITY_THRESHOLD = 25
 
+# Composition tables, in the order they appear in the "Secteur et Style" field
+COMPOSITION_TYPES = [
+    TypeCompo.ActiviteGeographique,
+    TypeCompo.RepartitionSectorielle,
+    TypeCompo.DecompositionParCapitalisation,
+    TypeCompo.DecompositionParStyle,
+]
+
 
 # Defined in priority order. The first match gets returned
 PREDEFINED_GEO_ZONE_VALUES = [
@@ -58,61 +84,143 @@ def remove_stupende_from_geo_zone(stupende: str, geo_zone: str) -> str:
         return geo_zone[len(stupende) + 1:]
 
 
-def parse_french_percent(percent_str: str) -> float:
-    if percent_str == "-":
-        return 0
-    return percent_str.replace(",", ".").strip("%")
+def compute_mean_values_from_composition_data(data: List[Dict[str, float]]) -> Dict[str, float]:
+    """Mean percentage of every category over all the dates"""
+    block = composition_block(data)
+    return dict(zip(block.categories, block.means().tolist()))
 
 
-def compute_mean_values_from_composition_data(data: List[Dict[str, float]]) -> Dict[str, float]:
+def max_category(block: CompositionBlock) -> str | None:
+    """Category with the highest mean (the first one on ties), None if the table is empty"""
+    if len(block.categories) == 0:
+        return None
+    return block.categories[int(np.argmax(block.means()))]
+
+
+class FondsPage:
+    """Fund page parsed once. The tree is built directly with lxml when it is installed :
+    the <dt> and <td> labels are then found by XPath queries, evaluated in C.
+    Otherwise beautifulsoup is used, and the labels are indexed in a single pass
+    instead of scanning the whole document for every field"""
+
+    def __init__(self, html: str):
+        if lxml_html is not None:
+            self.root = lxml_html.document_fromstring(html)
+            return
+
+        self.root = BeautifulSoup(html, 'html.parser')
+        self.dts: Dict[str, Any] = {}
+        self.tds: Dict[str, Any] = {}
+
+        for element in self.root.find_all(["dt", "td"]):
+            if element.name == "dt":
+                self.dts[element.text] = element  # Last match, like the former dt loop
+            else:
+                self.tds.setdefault(element.text, element)  # First match, like find_by_tag_and_text
+
+    def find_dt(self, label: str):
+        """Last <dt> whose text is exactly label"""
+        if lxml_html is not None:
+            return self.root.xpath("(//dt[. = $label])[last()]", label=label)[0]
+
+        return self.dts[label]
+
+    def find_td(self, label: str):
+        """First <td> whose text is exactly label"""
+        if lxml_html is not None:
+            return self.root.xpath("(//td[. = $label])[1]", label=label)[0]
+
+        return self.tds[label]
+
+    def text(self, element) -> str:
+        return element.text_content() if lxml_html is not None else element.text
+
+    def find_srri(self):
+        """The selected SRRI div, or None"""
+        if lxml_html is not None:
+            divs = self.root.xpath('//div[normalize-space(@class)="indic-srri indic-srri-selected"]')
+            return divs[0] if len(divs) > 0 else None
+
+        return self.root.find("div", {"class": "indic-srri indic-srri-selected"})
+
+    def find_next_sibling(self, element, tag: str):
+        if lxml_html is not None:
+            return next(element.itersiblings(tag), None)
+
+        return element.find_next_sibling(tag)
+
+    def find(self, element, tag: str):
+        """First descendant with this tag, or None"""
+        if lxml_html is not None:
+            return next(element.iterdescendants(tag), None)
+
+        return element.find(tag)
+
+
+class FondsPageFields(TypedDict):
+    srri_rating: int
+    geo_zone: str | None
+    performances: Dict[str, str]
+
+
+def parse_fonds_page(content: bytes, encoding: str) -> FondsPageFields:
+    """Extract all the fields of the fund page from the raw response.
+    This is a top level function taking bytes, so that it can run in a process pool"""
+
+    page = FondsPage(content.decode(encoding, errors="replace"))
+
+    return {
+        # Parse the SRRI rating
+        "srri_rating": parse_srri_rating_from_fonds_page(page),
+        # Parse the geographical zone from more precise predefined values.
+        "geo_zone": parse_geo_zone_from_fonds_page(page),
+        "performances": parse_performances_from_fonds_page(page),
+    }
 
-    percentages = {}
-    for obj in data:
-        for key, value in obj.items():
-            if key != 'x':
-                if key not in percentages:
-                    percentages[key] = value
-                else:
-                    percentages[key] += value
 
-    # Compute mean
-    for key, value in percentages.items():
-        percentages[key] = value / len(data)
+def parse_executor(workers: int) -> Executor:
+    """Process pool running parse_fonds_page. Its workers are not forked from this process, as a fork while
+    another thread runs (reading stdin, importing a module, resolving a host name) deadlocks : they are forked
+    from a server which imports the parsing modules once. The workers are started right away, so they are ready
+    for the first fund page"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["api.data"])
+    else:
+        context = multiprocessing.get_context("spawn")  # Windows
 
-    return percentages
+    executor = ProcessPoolExecutor(workers, context)
+    for _ in range(workers):
+        executor.submit(importlib.import_module, "api.data")
+    return executor
 
 
-def parse_srri_rating_from_fonds_page(soup: BeautifulSoup) -> int:
+def parse_srri_rating_from_fonds_page(page: FondsPage) -> int:
     """Parse the SRRI rating from the fonds page html code using beautifulsoup"""
 
     # Get SRRI rating number
-    srri_rating = soup.find(
-        "div", {"class": "indic-srri indic-srri-selected"})
+    srri_rating = page.find_srri()
 
     # It is not defined for some funds
     if srri_rating is None:
-        return np.nan
+        return float("nan")
 
-    return int(srri_rating.text)
+    return int(page.text(srri_rating))
 
 
-def parse_geo_zone_from_fonds_page(soup: BeautifulSoup) -> str | None:
+def parse_geo_zone_from_fonds_page(page: FondsPage) -> str | None:
     """Parse the geographical zone from the fonds page html code using beautifulsoup"""
 
     # Find the table entry
     # Warning : there is a space at the end !
-    dts = soup.find_all("dt")
-
     # For some reason, soup.find("dt", text="Catégorie Quantalys ") does not work
-    for dt in dts:
-        if dt.text == "Catégorie Quantalys ":
-            table_entry = dt
+    table_entry = page.find_dt("Catégorie Quantalys ")
 
     # Find the next dt sibling
-    dt_sibling = table_entry.find_next_sibling("dd")
+    dt_sibling = page.find_next_sibling(table_entry, "dd")
 
     # Get its text content
-    quantalys_category = dt_sibling.find("a").text
+    quantalys_category = page.text(page.find(dt_sibling, "a"))
 
     # Get the first occurrence from the predefined values
     for predefined_value in PREDEFINED_GEO_ZONE_VALUES:
@@ -122,7 +230,7 @@ def parse_geo_zone_from_fonds_page(soup: BeautifulSoup) -> str | None:
     return None  # Default : not found
 
 
-def parse_performances_from_fonds_page(soup: BeautifulSoup) -> Dict[str, str]:
+def parse_performances_from_fonds_page(page: FondsPage) -> Dict[str, str]:
 
     # Find the 4 of them
     perfs = ["Perf. 1er janvier", "Perf. 1 an", "Perf. 3 ans", "Perf. 5 ans"]
@@ -131,18 +239,37 @@ def parse_performances_from_fonds_page(soup: BeautifulSoup) -> Dict[str, str]:
     for perf in perfs:
         # Find the corresponding title element
         # For some reason they have an extra space
-        title = find_by_tag_and_text(soup, 'td', f" {perf}")
+        title = page.find_td(f" {perf}")
 
         # Find the next sibling, whose innre text is the data
-        data = title.find_next_sibling("td").text
+        data = page.text(page.find_next_sibling(title, "td"))
 
         results[perf] = data
 
     return results
 
 
-async def fonds_composition_page_from_product_id(Product_ID: int, client: AsyncClient):
-    """Parse the composition page. See what can be inferred from the data, etc"""
+async def fonds_composition_page_from_product_id(Product_ID: int, session: Session,
+                                                 store: ExposureStore | None = None):
+    """Fetch and parse the composition page. The raw exposures are kept in the store if there is one"""
+
+    # The 4 tables only depend on the product ID : fetch them concurrently
+    tables = await asyncio.gather(
+        *(get_composition_table_from_product_id(Product_ID, type_compo, session) for type_compo in COMPOSITION_TYPES))
+
+    with session.metrics.stage("parse_compositions"):
+        blocks = [composition_block(table.json()["graph"]["dataProvider"]) for table in tables]
+
+        if store is not None:
+            store.append(Product_ID, [type_compo.value for type_compo in COMPOSITION_TYPES], blocks)
+
+        return parse_composition_tables(*blocks)
+
+
+def parse_composition_tables(geographical_activity: CompositionBlock, sectorial_activity: CompositionBlock,
+                             capitalisation_decomposition: CompositionBlock,
+                             style_decomposition: CompositionBlock) -> str:
+    """Parse the composition tables. See what can be inferred from the data, etc"""
 
     fields = []
 
@@ -150,158 +277,211 @@ async def fonds_composition_page_from_product_id(Product_ID: int, client: AsyncC
     #               GEOGRAPHICAL ACTIVITY                 #
     #######################################################
 
-    # Parse the geographical zone activity. Sort by decreasing percentage, only if >= 25%
-    # Find the Geo activity table
-    # Start with geographical activity
-    geographical_activity = await get_composition_table_from_product_id(Product_ID, TypeCompo.ActiviteGeographique, client)
+    # Parse the geographical zone activity : only the zones >= 25%, in the table order
+    geo_means = geographical_activity.means()
 
-    geo_data = geographical_activity.json()["graph"]["dataProvider"]
+    for i in np.flatnonzero(geo_means >= GEO_ACTIVITY_THRESHOLD):
+        key = geographical_activity.categories[i]
+        # [5:] to remove the "Act. " prefix if it is there
+        fields.append(f"{key[5:] if 'Act. ' == key[:5] else key} {geo_means[i]:.0f}%")
 
-    parsed_geo_data = compute_mean_values_from_composition_data(geo_data)
+    #######################################################
+    #   SECTORIAL ACTIVITY, CAPITALISATION AND STYLE      #
+    #######################################################
 
-    # Format strings
-    geo_activity_zones = []
-    for key, value in parsed_geo_data.items():
+    # For these sections, only take the max value, if there is data
+    for block in (sectorial_activity, capitalisation_decomposition, style_decomposition):
+        if (category := max_category(block)) is not None:
+            fields.append(category)
 
-        if value >= GEO_ACTIVITY_THRESHOLD:
-            geo_activity_zones.append(
-                # [5:] to remove the "Act. " prefix if it is there
-                f"{key[5:] if 'Act. ' == key[:5] else key} {value:.0f}%")
+    # This is "" if no data was found
+    return ", ".join(fields)
 
-    fields.extend(geo_activity_zones)  # Add geo activity zones to the fields
+
+def hash_page(fonds_page_html: Response) -> str:
+    return hashlib.sha256(fonds_page_html.content).hexdigest()
+
+
+async def parse_fund_page(fonds_page_html: Response, session: Session,
+                          executor: Executor | None = None) -> FondsPageFields:
+    """Parsing the fund page in order to get more precise information.
+    With an executor, the CPU work runs in another process and the event loop keeps the requests going"""
+    with session.metrics.stage("parse_page"):
+        if executor is None:
+            return parse_fonds_page(fonds_page_html.content, fonds_page_html.encoding)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, parse_fonds_page, fonds_page_html.content, fonds_page_html.encoding)
+
+
+class RunMemo:
+    """Results already computed during the run, by product ID and by fund page :
+    share classes of the same fund are only fetched and parsed once.
+    Entries are futures, so that a duplicate arriving while the first one is in progress waits for it.
+    The raw composition exposures of the run go to the store if there is one"""
+
+    def __init__(self, max_size: int = MEMO_SIZE, store: ExposureStore | None = None):
+        self.max_size = max_size
+        self.store = store
+        self.pages: Dict[Tuple, asyncio.Future] = {}  # Product ID and previous page hash : fields and page hash
+        self.compositions: Dict[int, asyncio.Future] = {}  # Product ID
+        self.parsed: Dict[str, asyncio.Future] = {}  # Fund page hash
+        self.waiters: Dict[asyncio.Future, int] = {}  # Callers of every entry
+
+    def add(self, table: Dict, key: Any, future: asyncio.Future) -> asyncio.Future:
+        # Drop the oldest entry : its waiters keep their future, later duplicates fetch again
+        if len(table) >= self.max_size:
+            del table[next(iter(table))]
+        table[key] = future
+        future.add_done_callback(lambda future: self.forget_failure(table, key, future))
+        return future
+
+    def remember(self, table: Dict, key: Any, awaitable: Awaitable) -> asyncio.Future:
+        if key not in table:
+            self.add(table, key, asyncio.ensure_future(awaitable))
+        elif asyncio.iscoroutine(awaitable):
+            awaitable.close()  # Not needed
+
+        # A caller giving up must not cancel the work shared with the others, unless they all did
+        return share(table[key], self.waiters)
+
+    @staticmethod
+    def forget_failure(table: Dict, key: Any, future: asyncio.Future) -> None:
+        """Errors are not memoized : the next duplicate tries again"""
+        if future.cancelled() or future.exception() is not None:
+            if table.get(key) is future:
+                del table[key]
+
+    def claim_page(self, Product_ID: int, previous_page_hash: str | None) -> Tuple[asyncio.Future, bool]:
+        """Fields and hash of a fund page, for a caller fetching and parsing it in several steps (the pipeline).
+        Returns the future of the page, and whether the caller is the first one : it must then fetch the page
+        and give the result to share_page. The others get a shared view"""
+        key = (Product_ID, previous_page_hash)
+        if key in self.pages:
+            return share(self.pages[key], self.waiters), False
+
+        future = self.add(self.pages, key, asyncio.get_running_loop().create_future())
+        self.waiters[future] = 1  # The first caller, until it shares the result
+        return future, True
+
+    def share_page(self, future: asyncio.Future, result: Tuple[FondsPageFields | None, str] | None = None,
+                   error: Exception | None = None) -> None:
+        """Result of a page claimed with claim_page, or the error which prevented getting it"""
+        if not future.done():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        leave(future, self.waiters)
+
+    def sector_and_style(self, Product_ID: int, session: Session) -> asyncio.Future:
+        return self.remember(self.compositions, Product_ID,
+                             fonds_composition_page_from_product_id(Product_ID, session, self.store))
+
+    def parsed_page(self, fonds_page_html: Response, page_hash: str, session: Session,
+                    executor: Executor | None) -> asyncio.Future:
+        """Fields of a fetched fund page : identical pages are only parsed once"""
+        return self.remember(self.parsed, page_hash, parse_fund_page(fonds_page_html, session, executor))
+
+
+async def search_fund(isin: str, session: Session, index: ProductIndex | None, searched_columns: Tuple[str, ...],
+                      deadline: Deadline | None = None) -> List[Dict[str, Any]]:
+    """Search results of an ISIN, from the universe crawl when it has these columns"""
+    # The universe crawl makes the search a local lookup
+    search_row = index.get_search_row(isin) if index is not None else None
+
+    # Crawled with other columns : search again
+    if search_row is not None and all(column in search_row for column in searched_columns):
+        return [search_row]
 
     #######################################################
-    #                 SECTORIAL ACTIVITY                  #
+    #            INFO FROM THE QUICK SEARCH               #
     #######################################################
+    return (await before_deadline(main_page_search(
+        isin, session, search_columns(searched_columns)), deadline)).json()["data"]
 
-    # Parse the sectorial activity
-    sectorial_activity = await get_composition_table_from_product_id(Product_ID, TypeCompo.RepartitionSectorielle, client)
-    secto_data = sectorial_activity.json()["graph"]["dataProvider"]
 
-    parsed_secto_data = compute_mean_values_from_composition_data(secto_data)
+def search_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Columns given by the search"""
+    # Extract useful data
+    stupende_support = data["sGroupeCat_rng1"]
 
-    # Format strings : for this section, only take the max value
-    # Only process further if there is data (ie dict is not empty)
-    if len(parsed_secto_data) > 0:
-        max_sector = max(parsed_secto_data, key=parsed_secto_data.get)
-        fields.append(max_sector)
+    return {
+        "Nom du fond": data["sNom"],
+        "Rating Quantalys": data["nStarRating"],
+        "Sharpe Ratio": data["nSharpe3a"],
+        "Stupende Support": stupende_support,
+        "Zone Géo": remove_stupende_from_geo_zone(stupende_support, data["sGroupeCat_Specific_Dynamic"]),
+    }
 
-    #######################################################
-    #            CAPITALISATION DECOMPOSITION             #
-    #######################################################
 
-    # Parse the capitalisation decomposition
-    capitalisation_decomposition = await get_composition_table_from_product_id(Product_ID, TypeCompo.DecompositionParCapitalisation, client)
-    capi_data = capitalisation_decomposition.json()["graph"]["dataProvider"]
+def page_columns(page_fields: FondsPageFields) -> Dict[str, Any]:
+    """Columns given by the fund page"""
+    columns = {"Rating SRRI": page_fields["srri_rating"]}
 
-    parsed_capi_data = compute_mean_values_from_composition_data(capi_data)
+    # If no predefined value is found, we keep the previous value
+    if page_fields["geo_zone"] is not None:
+        columns["Zone Géo"] = page_fields["geo_zone"]
 
-    # Format strings : only keep the max
-    if len(parsed_capi_data) > 0:
-        max_cap = max(parsed_capi_data, key=parsed_capi_data.get)
-        fields.append(max_cap)
+    return columns | page_fields["performances"]
 
-    #######################################################
-    #                STYLE DECOMPOSITION                  #
-    #######################################################
 
-    # Parse the style decomposition
-    style_decomposition = await get_composition_table_from_product_id(Product_ID, TypeCompo.DecompositionParStyle, client)
-    style_data = style_decomposition.json()["graph"]["dataProvider"]
+def start_refresh(refresh: FundRefresh, data: Dict[str, Any], plan: FieldPlan) -> Tuple[FieldPlan, str | None]:
+    """Plan of the parts that changed since the previous run, and the hash of the previous fund page"""
+    refresh.markers = {column: data.get(column) for column in FRESHNESS_COLUMNS}
+    details_plan = refresh.stale_plan(plan)
+    refresh.fetched_page = details_plan.needs(PAGE)
+    refresh.fetched_compositions = details_plan.needs(COMPOSITION)
+    return details_plan, refresh.previous.page_hash if refresh.previous is not None else None
 
-    parsed_style_data = compute_mean_values_from_composition_data(style_data)
 
-    # Format strings : only keep the max
-    if len(parsed_style_data) > 0:
-        max_style = max(parsed_style_data, key=parsed_style_data.get)
-        fields.append(max_style)
+def carry_forward(refresh: FundRefresh, plan: FieldPlan, page_fields: FondsPageFields | None, page_hash: str | None,
+                  compositions: bool) -> Dict[str, Any]:
+    """Values of the previous run, for the fund page (not fetched, or with the same hash) and the compositions
+    (not fetched) of the plan"""
+    refresh.page_hash = page_hash
+    columns = {}
+
+    if page_fields is None and plan.needs(PAGE):
+        # Unchanged fund page : carry forward the values of the previous run
+        refresh.page_unchanged = page_hash is not None
+        columns |= {column: refresh.carried(column) for column in PAGE_COLUMNS}
+
+    if not compositions and plan.needs(COMPOSITION):
+        columns["Secteur et Style"] = refresh.carried("Secteur et Style")
+
+    return columns
 
-    # This is "" if no data was found
-    return ", ".join(fields)
 
+def plan_row(isin: str, row: Dict[str, Any], plan: FieldPlan, data: Dict[str, Any],
+             partial: bool = False) -> FundsData:
+    """Only the columns of the plan, in registry order. A partial row leaves out the columns not collected"""
+    if partial:
+        return {"ISIN": isin} | {column: row[column] for column in plan.columns if column in row} | {
+            column: data[column] for column in plan.extra_columns if column in data}
 
-async def agregate_from_isin(queue: asyncio.Queue, isin: str) -> FundsData:
-    """Agregate all necessary data
-    """
-    try:
-
-        async with AsyncClient(timeout=None) as client:
-
-            #######################################################
-            #            INFO FROM THE QUICK SEARCH               #
-            #######################################################
-            search_results: List[Dict[str, str]] = (await main_page_search(isin, client)).json()["data"]
-
-            if len(search_results) == 0:
-                wipe_progress_bar()
-                print("Could not find ISIN", isin, "on Quantalys")
-                await queue.put(isin)  # Communicate to the progress bar
-                return {"ISIN": isin, }
-
-            data = search_results[0]
-
-            # Extract useful data
-            fund_name = data["sNom"]
-            quantalys_rating = data["nStarRating"]
-            srri_rating = None
-            sharpe_ratio_3a = data["nSharpe3a"]
-            stupende_support = data["sGroupeCat_rng1"]
-
-            geo_zone = remove_stupende_from_geo_zone(
-                stupende_support, data["sGroupeCat_Specific_Dynamic"])
-
-            # Request main page to get the SRRI rating
-            product_id = data["ID_Produit"]
-
-            #######################################################
-            #                INFO FROM THE FUND PAGE              #
-            #######################################################
-            # Parsing the fund page in order to get more precise information
-            fonds_page_html = await fonds_page_from_product_id(product_id, client)
-            soup = BeautifulSoup(fonds_page_html.text, 'html.parser')
-
-            # Parse the SRRI rating
-            srri_rating = parse_srri_rating_from_fonds_page(soup)
-
-            # Parse the geographical zone from more precise predefined values.
-            # If no predefined value is found, we keep the previous value
-            precise_geo_zone = parse_geo_zone_from_fonds_page(soup)
-            if precise_geo_zone is not None:
-                geo_zone = precise_geo_zone
-
-            # TODO : here : fallback content ?
-            sector_and_style = await fonds_composition_page_from_product_id(product_id, client)
-
-            performances = parse_performances_from_fonds_page(soup)
-
-            #######################################################
-            #                    RETURN THE DATA                  #
-            #######################################################
-
-            await queue.put(isin)  # Communicate to the progress bar
-
-            return {
-                "ISIN": isin,
-                "Nom du fond": fund_name,
-                "Rating Quantalys": quantalys_rating,
-                "Rating SRRI": srri_rating,
-                "Sharpe Ratio": sharpe_ratio_3a,
-                "Stupende Support": stupende_support,
-                "Zone Géo": geo_zone,
-                "Secteur et Style": sector_and_style,
-            } | performances
-    except Exception as e:
-        wipe_progress_bar()
-        print("Error with ISIN : ", isin, ":", e)
-        await queue.put(isin)  # Communicate to the progress bar
-        return {"ISIN": isin, }
-
-
-def print_progress_bar(count: int, total: int, bar_length: int = 60) -> None:
-    """Prints a progress bar in the terminal"""
+    return {"ISIN": isin} | {column: row.get(column) for column in plan.columns} | {
+        column: data.get(column) for column in plan.extra_columns}
+
+
+def deadline_expired(isin: str, session: Session, duration: float) -> None:
+    wipe_progress_bar()
+    print("Deadline expired for ISIN", isin, ": only the fields collected so far are kept")
+    session.metrics.record_stage("deadline_expired", duration)
+
+
+def print_progress_bar(count: int, total: int | None, bar_length: int = 60) -> None:
+    """Prints a progress bar in the terminal. Only the count is shown if the total is unknown"""
     global LAST_BAR_LENGTH
 
-    terminal_width = os.get_terminal_size().columns
+    if total is None:
+        progress_msg = f'Progress: {count} done'
+        LAST_BAR_LENGTH = len(progress_msg)
+        print('\r', progress_msg, end='', flush=True)
+        return
+
+    # Falls back to 80 columns when not attached to a terminal (pipes, cron)
+    terminal_width = shutil.get_terminal_size().columns
 
     if bar_length > terminal_width + 10:
         bar_length = terminal_width - 10
@@ -322,13 +502,16 @@ def wipe_progress_bar() -> None:
     print("\r", " " * LAST_BAR_LENGTH, end='\r', flush=True)
 
 
-async def display_progress_bar(queue: asyncio.Queue, total: int) -> None:
-    """Read the queue and update the progress bar value"""
+async def display_progress_bar(queue: asyncio.Queue, total: int | None) -> None:
+    """Read the queue and update the progress bar value.
+    With an unknown total (streamed input), a None message ends the progress bar"""
 
     completed_tasks = 0
 
     while True:
-        await queue.get()
+        if await queue.get() is None:
+            print()
+            break
 
         completed_tasks += 1
         print_progress_bar(completed_tasks, total)
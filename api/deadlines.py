@@ -0,0 +1,103 @@
+"""
+Deadline of a fund : a time budget shared by all its requests, after which its row is emitted with the fields
+already collected. The clock stops while the fund waits behind the other funds : for the scheduler, or in a queue
+of the pipeline
+"""
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Any, Awaitable, Iterator
+
+FUND_DEADLINE = 60.0  # Seconds, default budget of a fund in main.py
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """Time budget of a fund. It only runs while the fund is being worked on :
+    it is paused while the fund waits behind the other funds and none of its requests is in flight"""
+
+    def __init__(self, budget: float):
+        self.expires = monotonic() + budget
+        self.queued = 0  # Requests waiting for the scheduler, and the fund waiting in a pipeline queue
+        self.sending = 0  # Requests in flight
+        self.paused_at: float | None = None
+
+    def remaining(self) -> float:
+        return self.expires - (self.paused_at if self.paused_at is not None else monotonic())
+
+    def wait(self) -> None:
+        """Something of the fund waits behind the other funds : a request, or the fund itself in a pipeline queue"""
+        self.queued += 1
+        self.update()
+
+    def stop_waiting(self) -> None:
+        self.queued -= 1
+        self.update()
+
+    def update(self) -> None:
+        paused = self.queued > 0 and self.sending == 0
+        if paused and self.paused_at is None:
+            self.paused_at = monotonic()
+        elif not paused and self.paused_at is not None:
+            self.expires += monotonic() - self.paused_at
+            self.paused_at = None
+
+
+# Deadline of the fund being fetched : the tasks of its requests inherit it
+current_deadline: ContextVar[Deadline | None] = ContextVar("current_deadline", default=None)
+
+
+@contextmanager
+def waiting_for_scheduler() -> Iterator[None]:
+    """Stop the clock of the current fund while its request waits for a slot"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        yield
+        return
+
+    deadline.wait()
+    try:
+        yield
+    finally:
+        deadline.stop_waiting()
+
+
+@contextmanager
+def in_flight() -> Iterator[None]:
+    """The request of the current fund is being sent : its clock runs"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        yield
+        return
+
+    deadline.sending += 1
+    deadline.update()
+    try:
+        yield
+    finally:
+        deadline.sending -= 1
+        deadline.update()
+
+
+async def before_deadline(awaitable: Awaitable, deadline: Deadline | None) -> Any:
+    """Result of awaitable, which is cancelled if the deadline expires first (raises DeadlineExceeded)"""
+    if deadline is None:
+        return await awaitable
+
+    future = asyncio.ensure_future(awaitable)
+    try:
+        while not future.done():
+            remaining = deadline.remaining()
+            if remaining <= 0:
+                raise DeadlineExceeded()
+            # A paused clock keeps the same remaining time : check again when it would have expired
+            await asyncio.wait({future}, timeout=remaining)
+    finally:
+        if not future.done():
+            future.cancel()
+
+    return future.result()
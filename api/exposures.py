@@ -0,0 +1,200 @@
+"""
+Composition tables as numpy blocks (dates x categories), and a compact columnar store of the raw exposures.
+Other aggregations can then be computed over all the funds at once, without downloading anything again
+
+Usage : python -m api.exposures [--directory DIRECTORY] [--output summary.csv]
+"""
+import argparse
+import glob
+import os
+import numpy as np
+import tempfile
+from api.cache import DATA_DIRECTORY
+from dataclasses import dataclass
+from time import time
+from typing import TYPE_CHECKING, Dict, List, Sequence
+
+# pandas is only needed to load and summarize the store, not to fill it during a run
+if TYPE_CHECKING:
+    import pandas as pd
+
+EXPOSURES_DIRECTORY = os.path.join(DATA_DIRECTORY, "exposures")
+CHUNK_ROWS = 100_000  # Exposures buffered in memory before being written
+
+
+@dataclass
+class CompositionBlock:
+    """One composition table : the exposure (%) of every category at every date"""
+    dates: List[str]
+    categories: List[str]
+    values: np.ndarray  # Shape (dates, categories)
+
+    def means(self) -> np.ndarray:
+        """Mean exposure of every category over all the dates"""
+        if len(self.dates) == 0:
+            return np.zeros(len(self.categories))
+        return self.values.mean(axis=0)
+
+
+def composition_block(data: List[Dict]) -> CompositionBlock:
+    """Block of a "graph.dataProvider" list. A category missing at a date counts as 0"""
+
+    # Categories in the order they first appear, like the website legend
+    categories = list(dict.fromkeys(key for row in data for key in row if key != "x"))
+    values = np.array([[row.get(category, 0.0) for category in categories] for row in data], dtype=float)
+
+    return CompositionBlock([str(row.get("x", "")) for row in data], categories,
+                            values.reshape(len(data), len(categories)))
+
+
+class ExposureStore:
+    """Directory of compressed .npz chunks, in long format : one row per product, table, date and category.
+    Dates and categories are dictionary encoded, the values are stored as float32.
+    Several writers can share the directory (shards of a run) : a chunk is written to a temporary file,
+    then linked to the first free name, which fails instead of overwriting if another writer took it"""
+
+    def __init__(self, directory: str = EXPOSURES_DIRECTORY, chunk_rows: int = CHUNK_ROWS):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+
+        self.buffer: List[Dict[str, np.ndarray]] = []
+        self.buffered_rows = 0
+        self.chunk = len(glob.glob(os.path.join(directory, "exposures-*.npz")))
+
+    def __enter__(self) -> "ExposureStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def append(self, product_id: int, type_compos: Sequence[int], blocks: Sequence[CompositionBlock]) -> None:
+        """Add the composition tables of a fund"""
+        downloaded_at = time()
+        for type_compo, block in zip(type_compos, blocks):
+            size = block.values.size
+            if size == 0:
+                continue
+
+            # Long format : the block is flattened row by row (date after date)
+            self.buffer.append({
+                "product_id": np.full(size, product_id, dtype=np.int64),
+                "type_compo": np.full(size, type_compo, dtype=np.int8),
+                "position": np.repeat(np.arange(len(block.dates), dtype=np.int32), len(block.categories)),
+                "date": np.repeat(np.array(block.dates, dtype=str), len(block.categories)),
+                "category": np.tile(np.array(block.categories, dtype=str), len(block.dates)),
+                "value": block.values.ravel().astype(np.float32),
+                "downloaded_at": np.full(size, downloaded_at),
+            })
+            self.buffered_rows += size
+
+        if self.buffered_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffered_rows == 0:
+            return
+
+        columns = {name: np.concatenate([part[name] for part in self.buffer]) for name in self.buffer[0]}
+        dates, date_codes = np.unique(columns.pop("date"), return_inverse=True)
+        categories, category_codes = np.unique(columns.pop("category"), return_inverse=True)
+
+        descriptor, temporary = tempfile.mkstemp(".tmp", "exposures-", self.directory)
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                np.savez_compressed(file, dates=dates, categories=categories, date=date_codes.astype(np.int32),
+                                    category=category_codes.astype(np.int32), **columns)
+
+            # The chunk only appears once complete, under a name no other writer has
+            while True:
+                try:
+                    os.link(temporary, os.path.join(self.directory, f"exposures-{self.chunk:05d}.npz"))
+                    break
+                except FileExistsError:
+                    self.chunk += 1
+        finally:
+            os.remove(temporary)
+
+        self.chunk += 1
+        self.buffer = []
+        self.buffered_rows = 0
+
+    def close(self) -> None:
+        self.flush()
+
+
+def load_exposures(directory: str = EXPOSURES_DIRECTORY) -> "pd.DataFrame":
+    """All the stored exposures. A table downloaded several times keeps its latest version"""
+    import pandas as pd
+
+    frames = []
+    for path in sorted(glob.glob(os.path.join(directory, "exposures-*.npz"))):
+        with np.load(path) as chunk:
+            frames.append(pd.DataFrame({
+                "product_id": chunk["product_id"],
+                "type_compo": chunk["type_compo"],
+                "position": chunk["position"],
+                "date": chunk["dates"][chunk["date"]],
+                "category": chunk["categories"][chunk["category"]],
+                "value": chunk["value"],
+                "downloaded_at": chunk["downloaded_at"],
+            }))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["product_id", "type_compo", "position", "date", "category", "value",
+                                     "downloaded_at"])
+
+    df = pd.concat(frames, ignore_index=True)
+
+    # Only keep the latest download of each table
+    latest = df.groupby(["product_id", "type_compo"])["downloaded_at"].transform("max")
+    df = df[df["downloaded_at"] == latest].reset_index(drop=True)
+
+    df["date"] = df["date"].astype("category")
+    df["category"] = df["category"].astype("category")
+    return df
+
+
+def summarize_exposures(df: "pd.DataFrame") -> "pd.DataFrame":
+    """Mean, max, last value and trend (slope per date) of every category of every fund, in one pass"""
+
+    df = df.assign(xy=df["position"] * df["value"].astype(float), xx=df["position"].astype(float) ** 2)
+    grouped = df.groupby(["product_id", "type_compo", "category"], observed=True)
+
+    summary = grouped.agg(
+        dates=("value", "size"),
+        mean=("value", "mean"),
+        max=("value", "max"),
+        last=("value", "last"),
+        sum_x=("position", "sum"),
+        sum_y=("value", "sum"),
+        sum_xy=("xy", "sum"),
+        sum_xx=("xx", "sum"),
+    )
+
+    # Least squares slope of the value against the date position
+    n = summary["dates"]
+    variance = n * summary["sum_xx"] - summary["sum_x"] ** 2
+    summary["trend"] = (n * summary["sum_xy"] - summary["sum_x"] * summary["sum_y"]) / variance.where(variance != 0)
+
+    return summary.drop(columns=["sum_x", "sum_y", "sum_xy", "sum_xx"]).reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the stored composition exposures of all the funds")
+    parser.add_argument("--directory", default=EXPOSURES_DIRECTORY, help="store written by main.py --exposures")
+    parser.add_argument("--output", "-o", default="exposures.csv", help="summary file (.csv or .xlsx)")
+    args = parser.parse_args()
+
+    summary = summarize_exposures(load_exposures(args.directory))
+
+    if args.output.endswith(".xlsx"):
+        summary.to_excel(args.output, index=False)
+    else:
+        summary.to_csv(args.output, index=False)
+
+    print(f"{summary['product_id'].nunique()} funds, {len(summary)} categories summarized into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
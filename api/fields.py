@@ -0,0 +1,104 @@
+"""
+Registry of the output columns : which endpoint and which parser produce each of them.
+A run only fetches the endpoints needed by the selected columns
+"""
+from api.quantalys import search_columns
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+
+# Endpoints, named like the cache and the metrics
+SEARCH = "search"  # Main page search, one row per fund
+PAGE = "page"  # Fund page html
+COMPOSITION = "composition"  # The 4 composition tables
+
+# Value types, for the typed output formats
+TEXT = "text"
+INTEGER = "integer"
+NUMBER = "number"
+PERCENT = "percent"  # French formatted on the website : "12,3 %"
+
+
+def parse_french_number(number_str: str) -> float:
+    """ "1 234,5" -> 1234.5. Missing values ("-", "") are NaN"""
+    number_str = number_str.replace("\xa0", "").replace(" ", "").replace(",", ".")
+    if number_str in ("", "-"):
+        return float("nan")
+    return float(number_str)
+
+
+def parse_french_percent(percent_str: str) -> float:
+    """ "12,3 %" -> 12.3. Missing values ("-", "") are NaN"""
+    return parse_french_number(percent_str.replace("%", ""))
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str  # Output column
+    endpoints: FrozenSet[str]  # Responses needed to compute it
+    source: str  # Search column or parser producing it
+    kind: str = TEXT
+
+
+# In output order
+FIELDS: List[Field] = [
+    Field("Nom du fond", frozenset({SEARCH}), "sNom"),
+    Field("Rating Quantalys", frozenset({SEARCH}), "nStarRating", INTEGER),
+    Field("Rating SRRI", frozenset({PAGE}), "parse_srri_rating_from_fonds_page", INTEGER),
+    Field("Sharpe Ratio", frozenset({SEARCH}), "nSharpe3a", NUMBER),
+    Field("Stupende Support", frozenset({SEARCH}), "sGroupeCat_rng1"),
+    # The category of the search, refined by the fund page
+    Field("Zone Géo", frozenset({SEARCH, PAGE}), "sGroupeCat_Specific_Dynamic, parse_geo_zone_from_fonds_page"),
+    Field("Secteur et Style", frozenset({COMPOSITION}), "parse_composition_tables"),
+    Field("Perf. 1er janvier", frozenset({PAGE}), "parse_performances_from_fonds_page", PERCENT),
+    Field("Perf. 1 an", frozenset({PAGE}), "parse_performances_from_fonds_page", PERCENT),
+    Field("Perf. 3 ans", frozenset({PAGE}), "parse_performances_from_fonds_page", PERCENT),
+    Field("Perf. 5 ans", frozenset({PAGE}), "parse_performances_from_fonds_page", PERCENT),
+]
+
+FIELD_NAMES = [field.name for field in FIELDS]
+FIELDS_BY_NAME = {field.name: field for field in FIELDS}
+
+
+def column_kind(column: str) -> str:
+    """Type of an output column. The type of a search column comes from its prefix : nSharpe3a is a number..."""
+    if column in FIELDS_BY_NAME:
+        return FIELDS_BY_NAME[column].kind
+    if column.startswith("ID_"):
+        return INTEGER
+    if column[:1] == "n" and column[1:2].isupper():
+        return NUMBER
+    return TEXT
+
+
+@dataclass(frozen=True)
+class FieldPlan:
+    """Columns of a run, and the endpoints to fetch for them"""
+    columns: Tuple[str, ...]  # Registry columns, in output order
+    extra_columns: Tuple[str, ...]  # Search columns added at the end of the row
+    endpoints: FrozenSet[str]
+
+    def needs(self, endpoint: str) -> bool:
+        return endpoint in self.endpoints
+
+    def kinds(self) -> Dict[str, str]:
+        """Type of every output column, ISIN first"""
+        return {column: column_kind(column) for column in ("ISIN",) + self.columns + self.extra_columns}
+
+
+def field_plan(columns: Iterable[str] | None = None, extra_columns: Iterable[str] = ()) -> FieldPlan:
+    """Plan for the selected columns (default : all of them). Raises ValueError for an unknown column"""
+
+    selected = set(FIELD_NAMES if columns is None else columns)
+    unknown = selected - set(FIELD_NAMES)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown columns : {', '.join(sorted(unknown))}")
+
+    extra_columns = tuple(extra_columns)
+    search_columns(extra_columns)  # Checks the extra columns
+
+    fields = [field for field in FIELDS if field.name in selected]
+    endpoints = frozenset().union(*(field.endpoints for field in fields))
+    if len(extra_columns) > 0:
+        endpoints |= {SEARCH}
+
+    return FieldPlan(tuple(field.name for field in fields), extra_columns, endpoints)
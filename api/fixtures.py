@@ -0,0 +1,60 @@
+"""
+Fixture store : recorded Quantalys responses, replayed by the mock server for offline tests and benchmarks
+"""
+import base64
+import json
+import os
+from api.cache import KEPT_HEADERS, request_key
+from httpx import Response
+from typing import Dict, Iterator, TypedDict
+
+
+class Fixture(TypedDict):
+    method: str
+    url: str  # Path relative to the base url
+    data: Dict[str, str] | None  # Form body
+    endpoint: str
+    status_code: int
+    headers: Dict[str, str]
+    content: str  # Base64, so that the replayed bytes are exactly the recorded ones
+
+
+class FixtureStore:
+    """Directory of recorded responses, one JSON file per request key"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def record(self, method: str, url: str, data: Dict | None, endpoint: str, response: Response) -> None:
+        fixture: Fixture = {
+            "method": method,
+            "url": url,
+            "data": {str(k): str(v) for k, v in data.items()} if data else None,
+            "endpoint": endpoint,
+            "status_code": response.status_code,
+            "headers": {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            "content": base64.b64encode(response.content).decode("ascii"),
+        }
+
+        with open(self.path(request_key(method, url, data)), "w", encoding="utf-8") as file:
+            json.dump(fixture, file, ensure_ascii=False, indent=1)
+
+    def get(self, key: str) -> Fixture | None:
+        if not os.path.exists(self.path(key)):
+            return None
+
+        with open(self.path(key), encoding="utf-8") as file:
+            return json.load(file)
+
+    def __iter__(self) -> Iterator[Fixture]:
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(".json"):
+                yield self.get(filename[:-len(".json")])
+
+
+def fixture_content(fixture: Fixture) -> bytes:
+    return base64.b64decode(fixture["content"])
@@ -0,0 +1,92 @@
+"""
+Hedged requests : a request still unanswered after the usual latency of its endpoint (p95) is sent a second time,
+and the first response wins. This cuts the tail latency caused by a slow or stalled connection,
+for a few percent more requests
+"""
+import asyncio
+from api.metrics import percentile
+from collections import deque
+from dataclasses import dataclass
+from functools import partial
+from httpx import Response
+from time import perf_counter
+from typing import Awaitable, Callable, Deque, Dict
+
+Send = Callable[[], Awaitable[Response]]  # Sends a request
+
+
+@dataclass
+class HedgeConfig:
+    enabled: bool = True
+    percentile: float = 95  # A request slower than this percentile of its endpoint is hedged
+    min_delay: float = 0.05  # Seconds, never hedge earlier
+    min_samples: int = 20  # Latencies of an endpoint needed before hedging it
+    window: int = 500  # Latest latencies of an endpoint the percentile is computed on
+    max_ratio: float = 0.05  # Hedged requests per request at most, so that a slow server is not flooded
+
+
+@dataclass
+class HedgeStats:
+    hedged: int = 0  # Duplicates sent
+    won: int = 0  # Duplicates answered before the original request
+
+    def __str__(self) -> str:
+        return f"{self.hedged} hedged requests, {self.won} answered first by the duplicate"
+
+
+class Hedger:
+    """Latency of the latest responses of every endpoint, and the hedging of the slow requests"""
+
+    def __init__(self, config: HedgeConfig | None = None):
+        self.config = config or HedgeConfig()
+        self.stats = HedgeStats()
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.requests = 0
+
+    def delay(self, endpoint: str) -> float | None:
+        """Seconds after which a request to endpoint is hedged, None if it is not"""
+        latencies = self.latencies.get(endpoint, ())
+        if not self.config.enabled or len(latencies) < self.config.min_samples:
+            return None
+        return max(self.config.min_delay, percentile(list(latencies), self.config.percentile))
+
+    def record(self, endpoint: str, latency: float) -> None:
+        self.latencies.setdefault(endpoint, deque(maxlen=self.config.window)).append(latency)
+
+    async def timed(self, endpoint: str, send: Send) -> Response:
+        start = perf_counter()
+        response = await send()
+        self.record(endpoint, perf_counter() - start)
+        return response
+
+    async def run(self, endpoint: str, send: Send,
+                  schedule: Callable[[Send], Awaitable[Response]] | None = None) -> Response:
+        """Send a request, and a duplicate if it is slow. The first response wins, the other request is cancelled.
+        If one of them fails, the other one is still awaited.
+        schedule sends the duplicate within the limits of the scheduler (a token and a slot of its own)"""
+        self.requests += 1
+        delay = self.delay(endpoint)
+        original = asyncio.ensure_future(self.timed(endpoint, send))
+        if delay is None:
+            return await original
+
+        tasks = {original}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if len(done) == 0 and self.stats.hedged < self.config.max_ratio * self.requests:
+                self.stats.hedged += 1
+                duplicate = partial(self.timed, endpoint, send)
+                tasks.add(asyncio.ensure_future(schedule(duplicate) if schedule is not None else duplicate()))
+
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.stats.won += task is not original
+                        return task.result()
+                if len(pending) == 0:
+                    return (original if original in done else done.pop()).result()  # Both failed : raise
+                tasks = pending  # Failed : wait for the other one
+        finally:
+            for task in tasks:
+                task.cancel()
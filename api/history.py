@@ -0,0 +1,237 @@
+"""
+History of the results of every run, deduplicated : a value is only stored when it changed since the previous run.
+Indexed by ISIN and run date, to follow how the rating, SRRI, zone or sector of the funds change
+
+Usage :
+    python -m api.history import 01-09-2026_10-00-00.csv ...
+    python -m api.history changes "Rating Quantalys" --since 2026-09-17 --dropped
+    python -m api.history series FR0010315770 --column "Secteur et Style"
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import sqlite3
+from api.cache import DATA_DIRECTORY
+from api.fields import column_kind
+from api.writers import typed_value
+from dataclasses import dataclass
+from time import time
+from typing import TYPE_CHECKING, Any, Dict, List
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+HISTORY_PATH = os.path.join(DATA_DIRECTORY, "history.sqlite")
+COMMIT_ROWS = 1000  # Funds recorded between two commits
+
+# Name of the files written by main.py, which gives the date of the imported runs
+RUN_FILENAME_FORMAT = "%d-%m-%Y_%H-%M-%S"
+
+
+@dataclass
+class Change:
+    isin: str
+    before: Any  # None if the fund had no value at that date
+    after: Any
+
+
+class History:
+    """Runs, and the values that changed at each run, in a sqlite file.
+    Values are stored typed (see fields.column_kind), so "12,3 %" and 12.3 are the same value"""
+
+    def __init__(self, path: str = HISTORY_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS changes (
+                isin TEXT,
+                column TEXT,
+                run_id INTEGER,
+                value TEXT,
+                PRIMARY KEY (isin, column, run_id)
+            );
+            CREATE INDEX IF NOT EXISTS changes_column ON changes (column, run_id);
+            -- Current value of every fund, to detect the changes without scanning the history
+            CREATE TABLE IF NOT EXISTS latest (
+                isin TEXT,
+                column TEXT,
+                value TEXT,
+                PRIMARY KEY (isin, column)
+            );
+        """)
+        self.run_id: int | None = None
+        self.run_isins = set()  # A repeated ISIN is only recorded once per run
+        self.recorded = 0
+        self.changed = 0
+
+    def __enter__(self) -> "History":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def start_run(self, source: str, started_at: float | None = None) -> int:
+        """New run, which the following rows belong to. Runs must be recorded in chronological order"""
+        started_at = time() if started_at is None else started_at
+        last = self.db.execute("SELECT MAX(started_at) FROM runs").fetchone()[0]
+        if last is not None and started_at < last:
+            raise ValueError(f"{source} is older than the last recorded run")
+
+        self.run_id = self.db.execute("INSERT INTO runs (started_at, source) VALUES (?, ?)",
+                                      (started_at, source)).lastrowid
+        self.run_isins = set()
+        return self.run_id
+
+    def record(self, row: Dict[str, Any]) -> int:
+        """Store the values of a fund that changed since the previous run. Returns the number of changes.
+        Failed funds (ISIN only) are skipped, and a column missing from the row keeps its previous value"""
+        isin = row.get("ISIN")
+        if len(row) <= 1 or not isin or isin in self.run_isins:
+            return 0
+        self.run_isins.add(isin)
+
+        previous = dict(self.db.execute("SELECT column, value FROM latest WHERE isin = ?", (isin,)))
+        changes = []
+        for column, value in row.items():
+            if column == "ISIN":
+                continue
+            value = json.dumps(typed_value(column_kind(column), value), ensure_ascii=False)
+            if previous.get(column) != value:
+                changes.append((isin, column, value))
+
+        self.db.executemany("INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?)",
+                            [(isin, column, self.run_id, value) for isin, column, value in changes])
+        self.db.executemany("INSERT OR REPLACE INTO latest VALUES (?, ?, ?)", changes)
+
+        self.recorded += 1
+        self.changed += len(changes)
+        if self.recorded % COMMIT_ROWS == 0:
+            self.db.commit()
+        return len(changes)
+
+    def last_run_before(self, date: datetime.datetime) -> int:
+        """Last run started at or before date, 0 if there is none"""
+        query = "SELECT MAX(run_id) FROM runs WHERE started_at <= ?"
+        return self.db.execute(query, (date.timestamp(),)).fetchone()[0] or 0
+
+    def values_at(self, column: str, date: datetime.datetime) -> Dict[str, Any]:
+        """Value of column for every fund, as of the last run before date"""
+        # SQLite takes the value of the row with the max run_id of each group
+        entries = self.db.execute("""SELECT isin, value, MAX(run_id) FROM changes
+                                     WHERE column = ? AND run_id <= ? GROUP BY isin""",
+                                  (column, self.last_run_before(date)))
+        return {isin: json.loads(value) for isin, value, _ in entries}
+
+    def changes(self, column: str, since: datetime.datetime) -> List[Change]:
+        """Funds whose value of column changed since date, with the value then and now"""
+        before = self.values_at(column, since)
+        entries = self.db.execute("""SELECT isin, value FROM latest WHERE column = ? AND isin IN (
+                                         SELECT isin FROM changes WHERE column = ? AND run_id > ?)""",
+                                  (column, column, self.last_run_before(since)))
+
+        changes = []
+        for isin, value in entries:
+            after = json.loads(value)
+            if before.get(isin) != after:
+                changes.append(Change(isin, before.get(isin), after))
+        return sorted(changes, key=lambda change: change.isin)
+
+    def series(self, isin: str, column: str | None = None) -> "pd.DataFrame":
+        """Values of a fund at each run where they changed : date, column, value"""
+        import pandas as pd
+
+        query = """SELECT runs.started_at AS date, changes.column, changes.value FROM changes
+                   JOIN runs ON runs.run_id = changes.run_id WHERE changes.isin = ?"""
+        parameters = [isin]
+        if column is not None:
+            query += " AND changes.column = ?"
+            parameters.append(column)
+
+        df = pd.read_sql_query(query + " ORDER BY changes.run_id, changes.column", self.db, params=parameters)
+        df["date"] = pd.to_datetime(df["date"], unit="s").dt.floor("s")
+        df["value"] = df["value"].map(json.loads)
+        return df
+
+
+def run_date(path: str) -> float:
+    """Date of a result file : from its name if main.py named it, else its modification time"""
+    try:
+        name = os.path.splitext(os.path.basename(path))[0]
+        return datetime.datetime.strptime(name, RUN_FILENAME_FORMAT).timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+def import_results(history: History, paths: List[str]) -> int:
+    """Record the CSV (or Excel) results of previous runs, oldest first. Returns the number of changes"""
+    import pandas as pd
+
+    changed = history.changed
+    for path in sorted(paths, key=run_date):
+        read = pd.read_excel if path.endswith(".xlsx") else pd.read_csv
+        df = read(path, index_col=0, dtype=str, keep_default_na=False)
+
+        history.start_run(path, run_date(path))
+        for row in df.to_dict("records"):
+            history.record({column: value if value != "" else None for column, value in row.items()})
+
+    return history.changed - changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the history of the results")
+    parser.add_argument("--history", default=HISTORY_PATH, help="history written by main.py --history")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="record the results of previous runs (.csv or .xlsx)")
+    importer.add_argument("files", nargs="+")
+
+    changes = commands.add_parser("changes", help="funds whose value of a column changed since a date")
+    changes.add_argument("column")
+    changes.add_argument("--since", type=datetime.datetime.fromisoformat, required=True, help="YYYY-MM-DD")
+    direction = changes.add_mutually_exclusive_group()
+    direction.add_argument("--dropped", action="store_true", help="only the values that decreased")
+    direction.add_argument("--raised", action="store_true", help="only the values that increased")
+
+    series = commands.add_parser("series", help="values of a fund at each run where they changed")
+    series.add_argument("isin")
+    series.add_argument("--column")
+
+    args = parser.parse_args()
+
+    with History(args.history) as history:
+        if args.command == "import":
+            paths = [path for pattern in args.files for path in sorted(glob.glob(pattern)) or [pattern]]
+            try:
+                print(f"{import_results(history, paths)} changes recorded from {len(paths)} files")
+            except ValueError as e:
+                parser.error(str(e))
+
+        elif args.command == "changes":
+            found = history.changes(args.column, args.since)
+            if args.dropped or args.raised:
+                # Funds without a value then or now are not comparable
+                found = [change for change in found if change.before is not None and change.after is not None
+                         and (change.after < change.before if args.dropped else change.after > change.before)]
+            for change in found:
+                print(f"{change.isin} : {change.before} -> {change.after}")
+            print(f"{len(found)} funds")
+
+        else:
+            print(history.series(args.isin, args.column).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Persistent ISIN -> ID_Produit index, filled as ISINs get resolved.
+It also keeps the search rows of the universe crawl
+"""
+import json
+import os
+import sqlite3
+from api.cache import DATA_DIRECTORY, DAY
+from api.requests import fast_search
+from api.session import Session
+from time import time
+from typing import Dict, Iterable
+
+INDEX_PATH = os.path.join(DATA_DIRECTORY, "index.sqlite")
+
+# Search rows older than this are searched again
+SEARCH_ROW_TTL = DAY
+
+
+class ProductIndex:
+    """ISIN -> ID_Produit mapping stored in a sqlite file.
+    The mapping practically never changes, so entries do not expire"""
+
+    def __init__(self, path: str = INDEX_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS products (
+            isin TEXT PRIMARY KEY,
+            product_id INTEGER,
+            name TEXT,
+            updated_at REAL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS search_rows (
+            isin TEXT PRIMARY KEY,
+            row TEXT,
+            crawled_at REAL
+        )""")
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def get(self, isin: str) -> int | None:
+        row = self.db.execute("SELECT product_id FROM products WHERE isin = ?", (isin,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, isin: str, product_id: int, name: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?)", (isin, product_id, name, time()))
+        self.db.commit()
+
+    def get_search_row(self, isin: str, max_age: float = SEARCH_ROW_TTL) -> Dict | None:
+        """Row of the main page search for this ISIN, if it was crawled recently enough"""
+        row = self.db.execute(
+            "SELECT row FROM search_rows WHERE isin = ? AND crawled_at > ?", (isin, time() - max_age)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_search_rows(self, rows: Iterable[Dict]) -> int:
+        """Store crawled search rows, and index their product IDs. Returns the number of rows stored"""
+        now = time()
+        rows = [row for row in rows if row.get("sCodeISIN")]
+
+        self.db.executemany("INSERT OR REPLACE INTO search_rows VALUES (?, ?, ?)",
+                            [(row["sCodeISIN"], json.dumps(row), now) for row in rows])
+        self.db.executemany("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?)",
+                            [(row["sCodeISIN"], row["ID_Produit"], row["sNom"], now) for row in rows])
+        self.db.commit()
+
+        return len(rows)
+
+
+async def resolve_product_id(isin: str, session: Session, index: ProductIndex | None = None) -> int | None:
+    """Product ID of an ISIN : from the index if known, else from the lightweight fast search"""
+
+    if index is not None and (product_id := index.get(isin)) is not None:
+        return product_id
+
+    results = (await fast_search(isin, session)).json()
+
+    # The fast search is a text search : make sure we pick the right ISIN
+    matches = [result for result in results if result.get("sCodeISIN") == isin]
+    if len(matches) == 0:
+        return None
+
+    product_id = matches[0]["ID_Produit"]
+    if index is not None:
+        index.put(isin, product_id, matches[0]["sNom"])
+
+    return product_id
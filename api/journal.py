@@ -0,0 +1,130 @@
+"""
+Append-only journal of the results, written as each fund completes.
+The final CSV is materialized from it, so an interrupted run can be resumed
+"""
+import csv
+import json
+import math
+import os
+from api.fields import column_kind
+from api.writers import is_typed_output, open_writer
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+
+class Journal:
+    """JSON lines file : one {"position": ..., "row": ...} entry per completed fund"""
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+
+        # A killed run may have left a truncated last line : start on a fresh one
+        needs_newline = False
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as file:
+                file.seek(-1, os.SEEK_END)
+                needs_newline = file.read(1) != b"\n"
+
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+        if needs_newline:
+            self.file.write("\n")
+
+    def __enter__(self) -> "Journal":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def append(self, position: int, row: Dict) -> None:
+        """Write a result. It is flushed right away, so it survives a crash or a Ctrl-C"""
+        self.file.write(json.dumps({"position": position, "row": row}, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+
+def journal_entries(path: str) -> Iterator[Tuple[int, int, Dict]]:
+    """Read the (offset, position, row) entries of a journal, in completion order.
+    The byte offset of an entry allows reading its row again later, instead of keeping it in memory"""
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as file:
+        offset = 0
+        for line in file:
+            start, offset = offset, offset + len(line)
+            # The last line may be truncated if the run was killed while writing it, even in the middle of a character
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            yield start, entry["position"], entry["row"]
+
+
+def read_journal(path: str) -> Iterator[Tuple[int, Dict]]:
+    """Read the (position, row) entries of a journal, in completion order"""
+    for _, position, row in journal_entries(path):
+        yield position, row
+
+
+def rows_at(journal_paths: List[str], locations: Iterable[Tuple[int, int]]) -> Iterator[Dict]:
+    """Rows of the journals at these (journal, offset) locations, read one at a time"""
+    files = [open(path, "rb") for path in journal_paths]
+    try:
+        for journal, offset in locations:
+            files[journal].seek(offset)
+            yield json.loads(files[journal].readline())["row"]
+    finally:
+        for file in files:
+            file.close()
+
+
+def completed_entries(path: str) -> Set[Tuple[int, str]]:
+    """(position, ISIN) pairs that already have a result in the journal.
+    Failed funds (ISIN only) are not included, so they get retried"""
+    return {(position, row["ISIN"]) for position, row in read_journal(path) if len(row) > 1}
+
+
+def csv_value(value: Any) -> str:
+    """CSV cell : missing values (None, NaN) are empty"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return str(value)
+
+
+def materialize(journal_paths: List[str], output_path: str) -> int:
+    """Write the results of one or several journals (shards of the same input) to a CSV (or Excel) file,
+    or to a typed file (Parquet, Arrow, SQLite), in input order.
+    For a resumed run, the latest result of each position wins. Returns the number of rows"""
+
+    # Only the location of the latest result of each position is kept : the rows are read again when written.
+    # Every column seen, in order of appearance
+    locations: Dict[int, Tuple[int, int]] = {}
+    columns: Dict[str, None] = {}
+    for journal, journal_path in enumerate(journal_paths):
+        for offset, position, row in journal_entries(journal_path):
+            locations[position] = (journal, offset)
+            columns.update(dict.fromkeys(row))
+    positions = sorted(locations)
+    rows = rows_at(journal_paths, (locations[position] for position in positions))
+
+    if is_typed_output(output_path):
+        with open_writer(output_path, {column: column_kind(column) for column in columns}) as writer:
+            for position, row in zip(positions, rows):
+                writer.write(position, row)
+        return len(positions)
+
+    if output_path.endswith(".xlsx"):
+        # Only Excel needs pandas : it is imported here, not at startup
+        import pandas as pd
+        pd.DataFrame.from_records(list(rows), index=positions, columns=list(columns)).to_excel(output_path)
+        return len(positions)
+
+    # Same layout as pandas : unnamed index column, every column seen, missing values left empty
+    with open(output_path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        writer.writerow([""] + list(columns))
+        for position, row in zip(positions, rows):
+            writer.writerow([position] + [csv_value(row.get(column)) for column in columns])
+
+    return len(positions)
@@ -0,0 +1,315 @@
+"""
+Run metrics : latency, bytes, status codes, retries and cache hits of every request, per endpoint,
+the duration of every processing stage, and the queue depth and throughput of every pipeline stage.
+Printed as a table at the end of a run, and optionally dumped as JSON or as a Prometheus textfile
+"""
+import json
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Collection, Deque, Dict, Iterator, List
+
+# Cache outcome of a request
+CACHE_HIT = "hit"  # Answered from the cache, no network
+CACHE_REVALIDATED = "revalidated"  # 304 : the cached response was still valid
+CACHE_MISS = "miss"  # Fetched, and stored if cacheable
+CACHE_BYPASS = "bypass"  # No cache, or not a cached endpoint
+CACHE_COALESCED = "coalesced"  # Shared the response of an identical request in flight
+
+PROMETHEUS_PREFIX = "quantalys"
+
+# Latest latencies kept per endpoint and per stage for the percentiles : the service runs for days
+LATENCY_WINDOW = 10_000
+
+
+def latency_window() -> Deque[float]:
+    return deque(maxlen=LATENCY_WINDOW)
+
+
+def percentile(values: Collection[float], percent: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+@dataclass
+class EndpointMetrics:
+    """Requests to one endpoint"""
+    requests: int = 0
+    errors: int = 0  # Requests that raised, after all their retries
+    retries: int = 0
+    bytes: int = 0  # Received over the network, cache hits excluded
+    cache: Counter = field(default_factory=Counter)  # Cache outcome -> count
+    status_codes: Counter = field(default_factory=Counter)
+    latency_total: float = 0.0  # Seconds, including the scheduler wait and the retries
+    latencies: Deque[float] = field(default_factory=latency_window)  # Latest ones only
+
+
+@dataclass
+class StageMetrics:
+    """Calls to one processing stage"""
+    calls: int = 0
+    errors: int = 0
+    duration_total: float = 0.0  # Seconds
+    durations: Deque[float] = field(default_factory=latency_window)  # Latest ones only
+
+
+@dataclass
+class QueueMetrics:
+    """Bounded queue in front of a pipeline stage, and the workers of the stage.
+    Shared by the pipelines of a process (e.g. the batches of the service) : the counters add up"""
+    workers: int = 0  # Per pipeline
+    capacity: int = 0  # Per pipeline
+    processed: int = 0  # Funds done by the stage
+    busy: float = 0.0  # Seconds spent working, summed over the workers
+    blocked: float = 0.0  # Seconds the previous stages waited for room in the queue : this stage is too slow
+    depth: int = 0  # Funds waiting now, in the queues of all the pipelines
+    max_depth: int = 0
+    running: int = 0  # Workers running now, of all the pipelines
+    depth_area: float = 0.0  # Integral of the depth over time, for the mean depth
+    running_area: float = 0.0  # Integral of the running workers over time, for the utilization
+    started_at: float = field(default_factory=perf_counter)
+    changed_at: float = field(default_factory=perf_counter)
+    stopped_at: float | None = None  # When no worker runs anymore
+
+    def integrate(self) -> None:
+        now = perf_counter()
+        self.depth_area += self.depth * (now - self.changed_at)
+        self.running_area += self.running * (now - self.changed_at)
+        self.changed_at = now
+
+    def change_depth(self, change: int) -> None:
+        self.integrate()
+        self.depth += change
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def start_workers(self, count: int) -> None:
+        self.integrate()
+        self.running += count
+        self.stopped_at = None
+
+    def stop_workers(self, count: int) -> None:
+        self.integrate()
+        self.running -= count
+        if self.running == 0:
+            self.stopped_at = perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return max(1e-9, (self.stopped_at or perf_counter()) - self.started_at)
+
+    def area(self, area: float, value: int) -> float:
+        """Integral up to now (or to the stop) of a value last changed at changed_at"""
+        return area + value * ((self.stopped_at or perf_counter()) - self.changed_at)
+
+    @property
+    def throughput(self) -> float:
+        """Funds per second"""
+        return self.processed / self.elapsed
+
+    @property
+    def utilization(self) -> float:
+        """Share of the time the running workers were busy"""
+        worker_time = self.area(self.running_area, self.running)
+        return self.busy / worker_time if worker_time > 0 else 0.0
+
+    @property
+    def mean_depth(self) -> float:
+        return self.area(self.depth_area, self.depth) / self.elapsed
+
+
+class Metrics:
+    """Collects the measures of a run. Owned by the session, so every request function reaches it"""
+
+    def __init__(self):
+        self.endpoints: Dict[str, EndpointMetrics] = {}
+        self.stages: Dict[str, StageMetrics] = {}
+        self.queues: Dict[str, QueueMetrics] = {}  # Pipeline stages, in pipeline order
+
+    def record_request(self, endpoint: str, latency: float, status_code: int | None, size: int,
+                       retries: int, cache: str) -> None:
+        """Record a completed request. A None status code means it failed without a response"""
+        metrics = self.endpoints.setdefault(endpoint, EndpointMetrics())
+        metrics.requests += 1
+        metrics.retries += retries
+        metrics.bytes += size
+        metrics.cache[cache] += 1
+        metrics.latency_total += latency
+        metrics.latencies.append(latency)
+
+        if status_code is None or status_code >= 400:
+            metrics.errors += 1
+        if status_code is not None:
+            metrics.status_codes[status_code] += 1
+
+    def record_stage(self, name: str, duration: float, failed: bool = False) -> None:
+        metrics = self.stages.setdefault(name, StageMetrics())
+        metrics.calls += 1
+        metrics.duration_total += duration
+        metrics.durations.append(duration)
+        if failed:
+            metrics.errors += 1
+
+    def queue(self, name: str, workers: int, capacity: int) -> QueueMetrics:
+        """Metrics of a pipeline stage, shared with the pipelines of the same stage run before or alongside"""
+        metrics = self.queues.setdefault(name, QueueMetrics())
+        metrics.workers = workers
+        metrics.capacity = capacity
+        return metrics
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the enclosed block. Works around awaits too, the duration is then the wall clock time"""
+        start = perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.record_stage(name, perf_counter() - start, failed)
+
+    def to_dict(self) -> Dict:
+        return {
+            "endpoints": {
+                name: {
+                    "requests": metrics.requests,
+                    "errors": metrics.errors,
+                    "retries": metrics.retries,
+                    "bytes": metrics.bytes,
+                    "cache": dict(metrics.cache),
+                    "status_codes": {str(code): count for code, count in metrics.status_codes.items()},
+                    "latency_total_s": metrics.latency_total,
+                    "latency_p50_s": percentile(metrics.latencies, 50),
+                    "latency_p95_s": percentile(metrics.latencies, 95),
+                    "latency_p99_s": percentile(metrics.latencies, 99),
+                }
+                for name, metrics in self.endpoints.items()
+            },
+            "stages": {
+                name: {
+                    "calls": metrics.calls,
+                    "errors": metrics.errors,
+                    "duration_total_s": metrics.duration_total,
+                    "duration_p50_s": percentile(metrics.durations, 50),
+                    "duration_p95_s": percentile(metrics.durations, 95),
+                    "duration_p99_s": percentile(metrics.durations, 99),
+                }
+                for name, metrics in self.stages.items()
+            },
+            "pipeline": {
+                name: {
+                    "workers": metrics.workers,
+                    "capacity": metrics.capacity,
+                    "processed": metrics.processed,
+                    "throughput_per_s": metrics.throughput,
+                    "utilization": metrics.utilization,
+                    "busy_s": metrics.busy,
+                    "blocked_s": metrics.blocked,
+                    "depth": metrics.depth,
+                    "mean_depth": metrics.mean_depth,
+                    "max_depth": metrics.max_depth,
+                }
+                for name, metrics in self.queues.items()
+            },
+        }
+
+    def summary(self) -> str:
+        """Human readable table of the endpoints and of the stages"""
+        lines = [f"{'Endpoint':<20}{'req.':>8}{'errors':>8}{'retries':>9}{'cache hits':>12}{'MB':>9}"
+                 f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}"]
+
+        for name, metrics in sorted(self.endpoints.items()):
+            hits = metrics.cache[CACHE_HIT] + metrics.cache[CACHE_REVALIDATED] + metrics.cache[CACHE_COALESCED]
+            lines.append(f"{name:<20}{metrics.requests:>8}{metrics.errors:>8}{metrics.retries:>9}{hits:>12}"
+                         f"{metrics.bytes / 1e6:>9.2f}{percentile(metrics.latencies, 50) * 1000:>10.1f}"
+                         f"{percentile(metrics.latencies, 95) * 1000:>10.1f}"
+                         f"{percentile(metrics.latencies, 99) * 1000:>10.1f}")
+
+        lines.append("")
+        lines.append(f"{'Stage':<20}{'calls':>8}{'errors':>8}{'total (s)':>11}"
+                     f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}")
+
+        for name, metrics in sorted(self.stages.items()):
+            lines.append(f"{name:<20}{metrics.calls:>8}{metrics.errors:>8}{metrics.duration_total:>11.2f}"
+                         f"{percentile(metrics.durations, 50) * 1000:>10.1f}"
+                         f"{percentile(metrics.durations, 95) * 1000:>10.1f}"
+                         f"{percentile(metrics.durations, 99) * 1000:>10.1f}")
+
+        if len(self.queues) > 0:
+            lines.append("")
+            lines.append(f"{'Pipeline stage':<20}{'workers':>8}{'funds':>8}{'per s':>8}{'busy':>7}"
+                         f"{'mean queue':>12}{'max queue':>11}{'blocked (s)':>13}")
+
+            for name, metrics in self.queues.items():
+                lines.append(f"{name:<20}{metrics.workers:>8}{metrics.processed:>8}{metrics.throughput:>8.1f}"
+                             f"{metrics.utilization:>7.0%}{metrics.mean_depth:>12.1f}"
+                             f"{f'{metrics.max_depth}/{metrics.capacity}':>11}{metrics.blocked:>13.2f}")
+
+        return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format, for the node exporter textfile collector"""
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples: List[tuple]) -> None:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_text}}} {value}")
+
+        endpoints = sorted(self.endpoints.items())
+        stages = sorted(self.stages.items())
+
+        metric("requests_total", "counter", "Requests per endpoint",
+               [({"endpoint": name}, m.requests) for name, m in endpoints])
+        metric("request_errors_total", "counter", "Failed requests per endpoint",
+               [({"endpoint": name}, m.errors) for name, m in endpoints])
+        metric("request_retries_total", "counter", "Retries per endpoint",
+               [({"endpoint": name}, m.retries) for name, m in endpoints])
+        metric("response_bytes_total", "counter", "Bytes received over the network per endpoint",
+               [({"endpoint": name}, m.bytes) for name, m in endpoints])
+        metric("responses_total", "counter", "Responses per endpoint and status code",
+               [({"endpoint": name, "code": code}, count)
+                for name, m in endpoints for code, count in sorted(m.status_codes.items())])
+        metric("cache_requests_total", "counter", "Requests per endpoint and cache outcome",
+               [({"endpoint": name, "outcome": outcome}, count)
+                for name, m in endpoints for outcome, count in sorted(m.cache.items())])
+        metric("request_duration_seconds", "summary", "Request latency per endpoint",
+               [({"endpoint": name, "quantile": str(q / 100)}, percentile(m.latencies, q))
+                for name, m in endpoints for q in (50, 95, 99)])
+        for name, m in endpoints:
+            lines.append(f'{PROMETHEUS_PREFIX}_request_duration_seconds_sum{{endpoint="{name}"}} {m.latency_total}')
+            lines.append(f'{PROMETHEUS_PREFIX}_request_duration_seconds_count{{endpoint="{name}"}} {m.requests}')
+        metric("stage_duration_seconds_total", "counter", "Total time spent in each stage",
+               [({"stage": name}, m.duration_total) for name, m in stages])
+        metric("stage_calls_total", "counter", "Calls of each stage",
+               [({"stage": name}, m.calls) for name, m in stages])
+        metric("stage_errors_total", "counter", "Failed calls of each stage",
+               [({"stage": name}, m.errors) for name, m in stages])
+
+        queues = list(self.queues.items())
+        metric("pipeline_workers", "gauge", "Workers of each pipeline stage",
+               [({"stage": name}, m.workers) for name, m in queues])
+        metric("pipeline_queue_depth", "gauge", "Funds waiting in front of each pipeline stage",
+               [({"stage": name}, m.depth) for name, m in queues])
+        metric("pipeline_queue_capacity", "gauge", "Size of the queue of each pipeline stage",
+               [({"stage": name}, m.capacity) for name, m in queues])
+        metric("pipeline_processed_total", "counter", "Funds done by each pipeline stage",
+               [({"stage": name}, m.processed) for name, m in queues])
+        metric("pipeline_busy_seconds_total", "counter", "Time spent working by the workers of each pipeline stage",
+               [({"stage": name}, m.busy) for name, m in queues])
+        metric("pipeline_blocked_seconds_total", "counter", "Time spent waiting for room in the queue of each stage",
+               [({"stage": name}, m.blocked) for name, m in queues])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Dump the metrics : Prometheus textfile for a .prom path, JSON otherwise"""
+        with open(path, "w", encoding="utf-8") as file:
+            if path.endswith(".prom"):
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), file, indent=1)
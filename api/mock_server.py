@@ -0,0 +1,189 @@
+"""
+Local stand-in for www.quantalys.com, replaying recorded fixtures with configurable
+latency, jitter, errors and throttling. Point the scraper at it with --base-url
+
+Usage : python -m api.mock_server FIXTURES_DIRECTORY [--port 8000] [--latency 50] [--jitter 20]
+                                  [--error-rate 0.01] [--throttle-rps 50] [--stall-rate 0.01 --stall 5000]
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from api.cache import request_key
+from api.fixtures import FixtureStore, fixture_content
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+from urllib.parse import parse_qsl
+
+# Called for requests without a fixture : (method, path, form) -> (status, content type, body) or None
+FallbackHandler = Callable[[str, str, Dict[str, str]], Tuple[int, str, bytes] | None]
+
+
+@dataclass
+class MockServerConfig:
+    latency: float = 0.0  # Seconds added to every response
+    jitter: float = 0.0  # Seconds, uniformly added or removed from the latency
+    error_rate: float = 0.0  # Probability of a 503 response
+    throttle_rps: float | None = None  # Above this rate, requests get a 429
+    seed: int | None = None  # Makes the errors reproducible
+    stall_rate: float = 0.0  # Probability of a response delayed by stall seconds, like a stalled connection
+    stall: float = 0.0
+
+
+@dataclass
+class MockServerStats:
+    requests: int = 0
+    not_found: int = 0
+    errors: int = 0
+    throttled: int = 0
+    stalled: int = 0
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], store: FixtureStore | None, config: MockServerConfig,
+                 fallback: FallbackHandler | None = None):
+        super().__init__(address, MockRequestHandler)
+        self.store = store
+        self.config = config
+        self.fallback = fallback
+        self.stats = MockServerStats()
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+
+        # Fixed window throttling : at most throttle_rps requests per second
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients giving up on a slow response (timeout, hedged request) are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self) -> Tuple[float, bool, bool]:
+        """Latency, error and throttling of the next response"""
+        config = self.config
+
+        with self.lock:
+            self.stats.requests += 1
+
+            throttled = False
+            if config.throttle_rps is not None:
+                now = time.monotonic()
+                if now - self.window_start >= 1:
+                    self.window_start = now
+                    self.window_requests = 0
+                self.window_requests += 1
+                throttled = self.window_requests > config.throttle_rps
+
+            latency = max(0.0, config.latency + self.random.uniform(-config.jitter, config.jitter))
+            error = self.random.random() < config.error_rate
+            if self.random.random() < config.stall_rate:
+                latency += config.stall
+                self.stats.stalled += 1
+
+            if throttled:
+                self.stats.throttled += 1
+            elif error:
+                self.stats.errors += 1
+
+        return latency, error, throttled
+
+    def respond(self, method: str, path: str, form: Dict[str, str]) -> Tuple[int, str, bytes]:
+        fixture = self.store.get(request_key(method, path, form or None)) if self.store is not None else None
+
+        if fixture is not None:
+            return fixture["status_code"], fixture["headers"].get("content-type", ""), fixture_content(fixture)
+
+        if self.fallback is not None and (response := self.fallback(method, path, form)) is not None:
+            return response
+
+        with self.lock:
+            self.stats.not_found += 1
+        return 404, "text/plain", b"No fixture for this request"
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real server
+    server: MockServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def reply(self, status: int, content_type: str, body: bytes, headers: Dict[str, str] | None = None) -> None:
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if len(body) < length:
+            self.close_connection = True  # Client gone while sending (cancelled request)
+            return
+        form = dict(parse_qsl(body.decode(), keep_blank_values=True))
+
+        latency, error, throttled = self.server.draw()
+        time.sleep(latency)
+
+        if throttled:
+            return self.reply(429, "text/plain", b"Too many requests", {"Retry-After": "1"})
+        if error:
+            return self.reply(503, "text/plain", b"Service unavailable")
+
+        self.reply(*self.server.respond(method, self.path, form))
+
+    def do_GET(self) -> None:
+        self.handle_request("GET")
+
+    def do_POST(self) -> None:
+        self.handle_request("POST")
+
+
+def start_mock_server(store: FixtureStore | None, config: MockServerConfig | None = None, port: int = 0,
+                      fallback: FallbackHandler | None = None) -> MockServer:
+    """Start a mock server in a background thread. Port 0 picks a free port, see server.base_url"""
+    server = MockServer(("127.0.0.1", port), store, config or MockServerConfig(), fallback)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Quantalys responses locally")
+    parser.add_argument("fixtures", help="directory of fixtures, recorded with main.py --record")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds of random latency variation")
+    parser.add_argument("--error-rate", type=float, default=0, help="probability of a 503 response")
+    parser.add_argument("--throttle-rps", type=float, help="answer 429 above this many requests per second")
+    parser.add_argument("--seed", type=int, help="random seed, for reproducible runs")
+    parser.add_argument("--stall-rate", type=float, default=0, help="probability of a stalled response")
+    parser.add_argument("--stall", type=float, default=0, help="milliseconds a stalled response is delayed")
+    args = parser.parse_args()
+
+    config = MockServerConfig(args.latency / 1000, args.jitter / 1000, args.error_rate, args.throttle_rps, args.seed,
+                              args.stall_rate, args.stall / 1000)
+    server = MockServer(("127.0.0.1", args.port), FixtureStore(args.fixtures), config)
+
+    print(f"Replaying {args.fixtures} on {server.base_url} (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{server.stats}")
+
+
+if __name__ == "__main__":
+    main()
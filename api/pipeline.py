@@ -0,0 +1,410 @@
+"""
+Streaming pipeline of a run : the funds go through stages connected by bounded queues
+
+    resolve (search) -+-> fetch_page -> parse -+-> emit
+                      +-> fetch_compositions --+
+
+When the index knows the product ID of a fund, its fund page and compositions are fetched during the search.
+Every stage has its own workers. A full queue blocks the stage feeding it (backpressure) : the number of funds
+in progress, and so the memory, stays flat whatever the size of the input, and a slow stage only holds its own
+workers. The depth and the throughput of every stage are in the run metrics, to size the workers from data
+"""
+import asyncio
+from api.data import (MEMO_SIZE, FondsPageFields, FundsData, RunMemo, carry_forward, deadline_expired, hash_page,
+                      page_columns, plan_row, search_fields, search_fund, start_refresh, wipe_progress_bar)
+from api.deadlines import Deadline, DeadlineExceeded, before_deadline, current_deadline
+from api.fields import COMPOSITION, PAGE, SEARCH, FieldPlan
+from api.index import ProductIndex, resolve_product_id
+from api.metrics import QueueMetrics
+from api.requests import fonds_page_from_product_id
+from api.session import Session
+from api.snapshots import FRESHNESS_COLUMNS, FundRefresh, SnapshotStore
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from functools import partial
+from httpx import Response
+from time import perf_counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+
+# Stages, in pipeline order
+RESOLVE = "resolve"
+FETCH_PAGE = "fetch_page"
+FETCH_COMPOSITIONS = "fetch_compositions"
+PARSE = "parse"
+EMIT = "emit"
+
+
+class PageAbandoned(Exception):
+    """The fund fetching a fund page for the other share classes gave up on it : they fetch it themselves"""
+
+
+@dataclass
+class PipelineConfig:
+    """Workers of every stage, and size of the queue in front of each one"""
+    resolve_workers: int = 16  # Searches in progress
+    page_workers: int = 16  # Fund pages being downloaded
+    composition_workers: int = 16  # Funds whose 4 composition tables are being downloaded
+    parse_workers: int = 1  # Fund pages being parsed : one per process of the executor
+    queue_size: int = 100  # Funds waiting in front of a stage at most
+
+
+@dataclass
+class FundJob:
+    """A fund going through the pipeline"""
+    position: int
+    isin: str
+    refresh: FundRefresh | None = None
+    deadline: Deadline | None = None
+    row: Dict[str, Any] = field(default_factory=dict)  # Columns of the search and of the compositions
+    data: Dict[str, Any] = field(default_factory=dict)  # Search row
+    plan: FieldPlan | None = None  # Parts to fetch : only the stale ones for a refresh
+    previous_page_hash: str | None = None
+    product_id: int | None = None
+    # Fetched, not parsed yet, by product ID (two of them if the product ID of the index was outdated),
+    # with their hash and their page memo entry
+    pages: Dict[int, Tuple[Response, str, asyncio.Future]] = field(default_factory=dict)
+    page_hash: str | None = None
+    page_fields: FondsPageFields | None = None
+    compositions: bool = False  # Fetched
+    parts: int = 1  # Stages working on the fund, or with the fund in their queue
+    duplicates: List[int] = field(default_factory=list)  # Positions of the same ISIN, emitted with this one
+    result: FundsData | None = None  # Row already computed for the same ISIN
+    missing: bool = False  # Not on Quantalys
+    failed: bool = False
+    expired: bool = False
+    started_at: float = field(default_factory=perf_counter)
+
+
+class Stage:
+    """Workers taking the funds from a bounded queue"""
+
+    def __init__(self, work: Callable[[FundJob], Awaitable[None]], metrics: QueueMetrics):
+        self.work = work
+        self.metrics = metrics
+        self.workers = metrics.workers
+        self.queue: asyncio.Queue = asyncio.Queue(metrics.capacity)
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+        self.metrics.start_workers(len(self.tasks))
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.metrics.stop_workers(len(self.tasks))
+        self.metrics.change_depth(-self.queue.qsize())  # Left behind by an error
+
+    async def put(self, job: FundJob) -> None:
+        """Queue a fund, waiting for room while the stage is behind"""
+        if job.deadline is not None:
+            job.deadline.wait()  # Behind the other funds : its clock stops
+
+        if self.queue.full():
+            start = perf_counter()
+            await self.queue.put(job)
+            self.metrics.blocked += perf_counter() - start
+        else:
+            self.queue.put_nowait(job)
+        self.metrics.change_depth(1)
+
+    async def run(self) -> None:
+        while True:
+            job = await self.queue.get()
+            self.metrics.change_depth(-1)
+            if job.deadline is not None:
+                job.deadline.stop_waiting()
+
+            # The requests of the fund inherit its deadline, to pause it while they wait for the scheduler
+            token = current_deadline.set(job.deadline)
+            start = perf_counter()
+            try:
+                await self.work(job)
+            finally:
+                current_deadline.reset(token)
+                self.metrics.busy += perf_counter() - start
+                self.metrics.processed += 1
+
+
+class Pipeline:
+    """Fetches a stream of ISINs through the stages, and hands every row to emit as soon as it is complete.
+    A repeated ISIN is only fetched once, and the share classes of the same fund (same product ID)
+    share their fund page and compositions (see RunMemo)"""
+
+    def __init__(self, session: Session, plan: FieldPlan, emit: Callable[[int, FundsData], None],
+                 config: PipelineConfig | None = None, index: ProductIndex | None = None,
+                 executor: Executor | None = None, memo: RunMemo | None = None,
+                 snapshots: SnapshotStore | None = None, deadline: float | None = None,
+                 progress: asyncio.Queue | None = None):
+        self.session = session
+        self.plan = plan
+        self.emit = emit
+        self.config = config or PipelineConfig()
+        self.index = index
+        self.executor = executor
+        self.memo = memo or RunMemo()
+        self.snapshots = snapshots
+        self.deadline = deadline
+        self.progress = progress
+
+        # A refresh needs the freshness markers of the search before deciding what to fetch
+        self.with_search = plan.needs(SEARCH) or snapshots is not None
+        self.searched_columns = plan.extra_columns + (FRESHNESS_COLUMNS if snapshots is not None else ())
+
+        config = self.config
+        metrics = session.metrics
+        self.resolve_stage = Stage(partial(self.step, self.resolve),
+                                   metrics.queue(RESOLVE, config.resolve_workers, config.queue_size))
+        self.page_stage = Stage(partial(self.step, self.fetch_page),
+                                metrics.queue(FETCH_PAGE, config.page_workers, config.queue_size))
+        self.composition_stage = Stage(partial(self.step, self.fetch_compositions),
+                                       metrics.queue(FETCH_COMPOSITIONS, config.composition_workers, config.queue_size))
+        self.parse_stage = Stage(partial(self.step, self.parse),
+                                 metrics.queue(PARSE, config.parse_workers, config.queue_size))
+        # A single writer : the rows are handed to emit one at a time
+        self.emit_stage = Stage(self.emit_row, metrics.queue(EMIT, 1, config.queue_size))
+        self.stages = [self.resolve_stage, self.page_stage, self.composition_stage, self.parse_stage, self.emit_stage]
+
+        self.active: Dict[str, FundJob] = {}  # ISINs in the pipeline
+        self.rows: Dict[str, FundsData] = {}  # ISINs done, for the duplicates arriving later. Not the failed ones
+        self.failed: Set[str] = set()  # ISINs whose last row is empty because the fetch failed, not because unknown
+        self.pending = 0  # Funds queued and not emitted yet
+        self.input_done = False
+        self.finished = asyncio.Event()
+
+    async def run(self, isins: AsyncIterator[Tuple[int, str]]) -> None:
+        """Fetch every (position, ISIN) of the stream. Returns when every row was emitted"""
+        for stage in self.stages:
+            stage.start()
+
+        feed = asyncio.create_task(self.feed(isins))
+        finished = asyncio.create_task(self.finished.wait())
+        tasks = {feed, finished} | {task for stage in self.stages for task in stage.tasks}
+
+        try:
+            # Workers only stop on an unexpected error (e.g. writing a row) : raise it instead of waiting forever
+            while not finished.done():
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not finished and task.exception() is not None:
+                        raise task.exception()
+        finally:
+            for task in (feed, finished):
+                task.cancel()
+            for stage in self.stages:
+                await stage.stop()
+
+    async def feed(self, isins: AsyncIterator[Tuple[int, str]]) -> None:
+        async for position, isin in isins:
+            self.pending += 1
+
+            if (first := self.active.get(isin)) is not None:
+                first.duplicates.append(position)  # Emitted with the first occurrence
+            elif isin in self.rows:
+                await self.emit_stage.put(FundJob(position, isin, result=self.rows[isin]))
+            else:
+                job = self.active[isin] = FundJob(
+                    position, isin, self.snapshots.refresh(isin) if self.snapshots is not None else None,
+                    Deadline(self.deadline) if self.deadline is not None else None, {"ISIN": isin})
+                await self.resolve_stage.put(job)
+
+        self.input_done = True
+        self.check_finished()
+
+    def check_finished(self) -> None:
+        if self.input_done and self.pending == 0:
+            self.finished.set()
+
+    async def step(self, work: Callable[[FundJob], Awaitable[List[Stage]]], job: FundJob) -> None:
+        """Run a stage on a fund, then send it to the following stages. The fund page and the compositions
+        are fetched in parallel : the fund is emitted when the last of them is done.
+        A fetched page is parsed even if the fund failed, as other share classes may wait for it"""
+        try:
+            following = [] if (job.failed or job.expired) and work != self.parse else await work(job)
+        except DeadlineExceeded:
+            job.expired = True
+            following = []
+        except Exception as e:
+            job.failed = True
+            following = []
+            wipe_progress_bar()
+            print("Error with ISIN : ", job.isin, ":", e)
+
+        # This stage hands its part of the fund over to the following ones
+        await self.hand_over(job, following)
+        job.parts -= 1
+        if job.parts == 0:
+            await self.emit_stage.put(job)
+
+    @staticmethod
+    async def hand_over(job: FundJob, stages: List[Stage]) -> None:
+        job.parts += len(stages)
+        for stage in stages:
+            await stage.put(job)
+
+    def details(self, job: FundJob) -> List[Stage]:
+        """Stages fetching the parts of the plan of the fund"""
+        return [stage for stage, part in ((self.page_stage, PAGE), (self.composition_stage, COMPOSITION))
+                if job.plan.needs(part)]
+
+    async def resolve(self, job: FundJob) -> List[Stage]:
+        """Search the fund, or only resolve its product ID if no search column is needed.
+        When the index knows the product ID, the fund page and the compositions are fetched during the search"""
+        isin = job.isin
+        product_id = self.index.get(isin) if self.index is not None else None
+
+        if product_id is not None and self.with_search and job.refresh is None:
+            job.product_id, job.plan = product_id, self.plan
+            await self.hand_over(job, self.details(job))
+
+        if self.with_search:
+            search_results = await search_fund(isin, self.session, self.index, self.searched_columns, job.deadline)
+        else:
+            if product_id is None:
+                product_id = await before_deadline(resolve_product_id(isin, self.session, self.index), job.deadline)
+            search_results = [] if product_id is None else [{"ID_Produit": product_id}]
+
+        if len(search_results) == 0:
+            wipe_progress_bar()
+            print("Could not find ISIN", isin, "on Quantalys")
+            job.missing = True
+            return []
+
+        job.data = search_results[0]
+        if self.with_search:
+            job.row |= search_fields(job.data)
+            if self.index is not None:
+                self.index.put(isin, job.data["ID_Produit"], job.data["sNom"])
+
+        if job.product_id == job.data["ID_Produit"]:
+            return []  # Already fetched during the search
+
+        if job.product_id is not None:
+            # Outdated product ID : the details fetched for it are dropped
+            job.page_fields, job.page_hash, job.compositions = None, None, False
+            job.row.pop("Secteur et Style", None)
+
+        # Only fetch what changed since the previous run
+        job.plan, job.previous_page_hash = \
+            start_refresh(job.refresh, job.data, self.plan) if job.refresh is not None else (self.plan, None)
+        job.product_id = job.data["ID_Produit"]
+        return self.details(job)
+
+    async def fetch_page(self, job: FundJob) -> List[Stage]:
+        """Download the fund page, unless another share class of the fund already did (see RunMemo).
+        A page with the same hash as the previous run is not parsed again"""
+        product_id = job.product_id
+
+        while True:
+            page, first = self.memo.claim_page(product_id, job.previous_page_hash)
+            if first:
+                break
+            try:
+                page_fields, page_hash = await before_deadline(page, job.deadline)
+            except PageAbandoned:
+                continue  # Fetch it for this fund
+            self.page_done(job, product_id, page_fields, page_hash)
+            return []
+
+        try:
+            fonds_page_html = await before_deadline(fonds_page_from_product_id(product_id, self.session),
+                                                    job.deadline)
+        except BaseException as e:
+            self.memo.share_page(page, error=shared_error(e))
+            raise
+
+        page_hash = hash_page(fonds_page_html)
+        if page_hash == job.previous_page_hash:
+            self.memo.share_page(page, (None, page_hash))
+            self.page_done(job, product_id, None, page_hash)
+            return []
+
+        job.pages[product_id] = (fonds_page_html, page_hash, page)
+        return [self.parse_stage]
+
+    async def parse(self, job: FundJob) -> List[Stage]:
+        product_id, (fonds_page_html, page_hash, page) = job.pages.popitem()  # Only kept until parsed
+        try:
+            page_fields = await self.memo.parsed_page(fonds_page_html, page_hash, self.session, self.executor)
+        except BaseException as e:
+            self.memo.share_page(page, error=shared_error(e))
+            raise
+
+        self.memo.share_page(page, (page_fields, page_hash))
+        self.page_done(job, product_id, page_fields, page_hash)
+        return []
+
+    @staticmethod
+    def page_done(job: FundJob, product_id: int, page_fields: FondsPageFields | None, page_hash: str) -> None:
+        if product_id == job.product_id:  # Else outdated product ID of the index
+            job.page_fields, job.page_hash = page_fields, page_hash
+
+    async def fetch_compositions(self, job: FundJob) -> List[Stage]:
+        """Download and parse the 4 composition tables"""
+        product_id = job.product_id
+        sector_and_style = await before_deadline(self.memo.sector_and_style(product_id, self.session), job.deadline)
+
+        if product_id == job.product_id:  # Else outdated product ID of the index
+            job.row["Secteur et Style"] = sector_and_style
+            job.compositions = True
+        return []
+
+    def complete_row(self, job: FundJob) -> FundsData:
+        """Row of a fund that went through the pipeline"""
+        if job.missing or job.failed:
+            return {"ISIN": job.isin, }
+
+        # The fund page comes after the search : its geographical zone is more precise
+        row = job.row | (page_columns(job.page_fields) if job.page_fields is not None else {})
+
+        if job.expired:
+            if job.refresh is not None:
+                job.refresh.expired = True
+            deadline_expired(job.isin, self.session, perf_counter() - job.started_at)
+            return plan_row(job.isin, row, self.plan, job.data, partial=True)
+
+        if job.refresh is not None:
+            row |= carry_forward(job.refresh, self.plan, job.page_fields, job.page_hash, job.compositions)
+        return plan_row(job.isin, row, self.plan, job.data)
+
+    async def emit_row(self, job: FundJob) -> None:
+        row = job.result
+        if row is None:
+            row = self.complete_row(job)
+            # Whole fund, from the search to the parsed row
+            self.session.metrics.record_stage("fund", perf_counter() - job.started_at, job.failed)
+            if self.snapshots is not None:
+                self.snapshots.put(job.isin, job.refresh, row)
+
+            del self.active[job.isin]
+            if job.failed:
+                self.failed.add(job.isin)
+            else:
+                self.failed.discard(job.isin)
+            # A failed or partial row is not reused : a later duplicate fetches the fund again
+            if not (job.failed or job.expired):
+                if len(self.rows) >= MEMO_SIZE:
+                    del self.rows[next(iter(self.rows))]
+                self.rows[job.isin] = row
+
+        for position in [job.position] + job.duplicates:
+            self.emit(position, dict(row))
+            if self.progress is not None:
+                await self.progress.put(job.isin)  # Communicate to the progress bar
+
+        self.pending -= 1 + len(job.duplicates)
+        self.check_finished()
+
+
+def shared_error(error: BaseException) -> Exception:
+    """Error of a shared fund page, for the other share classes : they only fail if the page itself failed"""
+    if isinstance(error, Exception) and not isinstance(error, DeadlineExceeded):
+        return error
+    return PageAbandoned()
+
+
+async def enumerated(isins: Iterable[str]) -> AsyncIterator[Tuple[int, str]]:
+    """(position, ISIN) stream of a list, for Pipeline.run"""
+    for position, isin in enumerate(isins):
+        yield position, isin
@@ -0,0 +1,259 @@
+"""
+Portfolio exposures : the weighted geographical, sector, capitalisation and style breakdowns of a book of funds,
+computed over the raw exposures of the store (main.py --exposures, or --fetch here) with one shared category
+dictionary per composition table
+
+Usage : python -m api.portfolio BOOK [--fetch] [--method last|mean] [--output breakdown.csv]
+
+BOOK : one "ISIN weight" line per holding (separated by a tab, ";", "," or spaces). Weights are amounts or
+percentages, "12,5" or "12.5", they are normalized
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import os
+import re
+import numpy as np
+from api.exposures import EXPOSURES_DIRECTORY
+from api.fields import parse_french_number
+from api.quantalys import TypeCompo
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+# Exposure of a fund to a category
+LAST = "last"  # At the latest date of its composition table
+MEAN = "mean"  # Mean over all the dates, like the "Secteur et Style" column
+
+BOOK_LINE = re.compile(r"^\s*([A-Za-z0-9]+)[\s;,]+(.+?)\s*$")
+
+
+@dataclass
+class ExposureMatrix:
+    """One composition table of many funds : the exposure (%) of every fund to every category"""
+    product_ids: np.ndarray  # Sorted, one row per fund
+    categories: List[str]  # Shared by all the funds
+    values: np.ndarray  # Shape (funds, categories)
+    covered: np.ndarray  # Whether the table of the fund is in the store
+
+
+@dataclass
+class Breakdown:
+    """Exposure of the portfolio to the categories of one composition table, highest first"""
+    table: str
+    categories: List[str]
+    exposures: np.ndarray  # % of the covered weight
+    coverage: float  # Share of the portfolio weight whose table is in the store
+
+
+def read_book(path: str) -> Tuple[List[str], np.ndarray]:
+    """ISINs and weights of a book. A repeated ISIN gets the sum of its weights. A header line is skipped"""
+    weights: Dict[str, float] = {}
+
+    with open(path, encoding="utf-8-sig") as file:
+        for number, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+
+            match = BOOK_LINE.match(line)
+            try:
+                weight = parse_french_number(match.group(2).replace("%", "")) if match is not None else None
+            except ValueError:
+                weight = None
+
+            if weight is None or np.isnan(weight):
+                if number == 1:
+                    continue  # Header
+                raise ValueError(f"{path}, line {number} : expected an ISIN and a weight, got {line.strip()!r}")
+
+            isin = match.group(1).upper()
+            weights[isin] = weights.get(isin, 0.0) + weight
+
+    return list(weights), np.array(list(weights.values()), dtype=float)
+
+
+def stored_product_ids(directory: str = EXPOSURES_DIRECTORY) -> np.ndarray:
+    """Product IDs with exposures in the store"""
+    ids = [np.empty(0, dtype=np.int64)]
+    for path in glob.glob(os.path.join(directory, "exposures-*.npz")):
+        with np.load(path) as chunk:
+            ids.append(np.unique(chunk["product_id"]))
+    return np.unique(np.concatenate(ids))
+
+
+def load_exposure_matrices(product_ids: np.ndarray, directory: str = EXPOSURES_DIRECTORY,
+                           method: str = LAST) -> Dict[TypeCompo, ExposureMatrix]:
+    """Exposure matrix of every composition table, for these funds. Only the latest download of a table is used.
+    Everything runs on integer codes : category names are only looked at once per chunk"""
+
+    wanted = np.unique(np.asarray(product_ids, dtype=np.int64))
+    category_codes: Dict[str, int] = {}  # Dictionary shared by all the chunks
+    parts = []
+
+    for path in sorted(glob.glob(os.path.join(directory, "exposures-*.npz"))):
+        with np.load(path) as chunk:
+            keep = np.isin(chunk["product_id"], wanted)
+            if not keep.any():
+                continue
+
+            # Chunk category codes -> shared category codes
+            mapping = np.array([category_codes.setdefault(str(name), len(category_codes))
+                                for name in chunk["categories"]], dtype=np.int64)
+            parts.append({
+                "product_id": chunk["product_id"][keep],
+                "type_compo": chunk["type_compo"][keep].astype(np.int64),
+                "position": chunk["position"][keep],
+                "category": mapping[chunk["category"][keep]],
+                "value": chunk["value"][keep].astype(float),
+                "downloaded_at": chunk["downloaded_at"][keep],
+            })
+
+    names = np.array(list(category_codes), dtype=object)
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]} if len(parts) > 0 else None
+    matrices = {}
+
+    if columns is not None:
+        # One table = one product and composition type. Only keep its latest download
+        _, table = np.unique(columns["product_id"] * 256 + columns["type_compo"], return_inverse=True)
+        latest = np.full(table.max() + 1, -np.inf)
+        np.maximum.at(latest, table, columns["downloaded_at"])
+        newest = columns["downloaded_at"] == latest[table]
+        columns = {name: values[newest] for name, values in columns.items()}
+        table = table[newest]
+
+        dates = np.zeros(table.max() + 1, dtype=np.int64)
+        np.maximum.at(dates, table, columns["position"].astype(np.int64) + 1)
+
+        if method == LAST:
+            last = columns["position"] == dates[table] - 1
+            columns = {name: values[last] for name, values in columns.items()}
+            weights = columns["value"]
+        else:
+            weights = columns["value"] / dates[table]  # A category missing at a date counts as 0
+
+    for type_compo in TypeCompo:
+        if columns is None:
+            matrices[type_compo] = ExposureMatrix(wanted, [], np.zeros((len(wanted), 0)), np.zeros(len(wanted), bool))
+            continue
+
+        selected = columns["type_compo"] == type_compo.value
+        used, category = np.unique(columns["category"][selected], return_inverse=True)
+        rows = np.searchsorted(wanted, columns["product_id"][selected])
+
+        values = np.bincount(rows * len(used) + category, weights=weights[selected],
+                             minlength=len(wanted) * len(used)).reshape(len(wanted), len(used))
+        covered = np.zeros(len(wanted), dtype=bool)
+        covered[rows] = True
+        matrices[type_compo] = ExposureMatrix(wanted, names[used].tolist(), values, covered)
+
+    return matrices
+
+
+def portfolio_breakdowns(product_ids: np.ndarray, weights: np.ndarray,
+                         matrices: Dict[TypeCompo, ExposureMatrix]) -> List[Breakdown]:
+    """Weighted breakdown of the portfolio for every composition table.
+    Holdings without product ID (-1) or without data count in the coverage only"""
+
+    breakdowns = []
+    for type_compo, matrix in matrices.items():
+        rows = np.searchsorted(matrix.product_ids, product_ids)
+        found = rows < len(matrix.product_ids)
+        found[found] = matrix.product_ids[rows[found]] == product_ids[found]
+        found[found] = matrix.covered[rows[found]]
+
+        # Weight of every fund of the matrix : holdings of the same fund are added up
+        fund_weights = np.bincount(rows[found], weights=weights[found], minlength=len(matrix.product_ids))
+        covered_weight = fund_weights.sum()
+        exposures = fund_weights @ matrix.values / covered_weight if covered_weight > 0 \
+            else np.zeros(len(matrix.categories))
+
+        order = np.argsort(-exposures, kind="stable")
+        breakdowns.append(Breakdown(type_compo.name, [matrix.categories[i] for i in order], exposures[order],
+                                    covered_weight / weights.sum() if weights.sum() > 0 else 0.0))
+
+    return breakdowns
+
+
+async def fetch_exposures(isins: List[str], directory: str, base_url: str | None = None) -> None:
+    """Download the composition tables of these funds into the store"""
+    from api.cache import CacheConfig, ResponseCache
+    from api.data import RunMemo, display_progress_bar
+    from api.exposures import ExposureStore
+    from api.fields import field_plan
+    from api.index import ProductIndex
+    from api.pipeline import Pipeline, enumerated
+    from api.session import Session, SessionConfig
+
+    queue = asyncio.Queue()
+    progress_bar = asyncio.create_task(display_progress_bar(queue, len(isins)))
+    plan = field_plan(["Secteur et Style"])  # Only the composition tables
+    index = ProductIndex()
+
+    with ExposureStore(directory) as store:
+        memo = RunMemo(store=store)
+        config = SessionConfig(base_url=base_url) if base_url is not None else None
+        async with Session(config, cache=ResponseCache(CacheConfig())) as session:
+            # Only the store is needed : the rows are dropped
+            await Pipeline(session, plan, lambda position, row: None, index=index, memo=memo,
+                           progress=queue).run(enumerated(isins))
+    await progress_bar
+    index.close()
+
+
+def product_ids_of(isins: List[str]) -> np.ndarray:
+    """Product ID of every ISIN from the index, -1 if unknown"""
+    from api.index import ProductIndex
+
+    index = ProductIndex()
+    ids = [index.get(isin) for isin in isins]
+    index.close()
+    return np.array([-1 if product_id is None else product_id for product_id in ids], dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Weighted exposures of a portfolio of funds")
+    parser.add_argument("book", help='one "ISIN weight" line per holding')
+    parser.add_argument("--directory", default=EXPOSURES_DIRECTORY, help="exposure store (main.py --exposures)")
+    parser.add_argument("--fetch", action="store_true", help="download the funds missing from the store first")
+    parser.add_argument("--base-url", help="Quantalys server for --fetch, e.g. a local mock server")
+    parser.add_argument("--method", choices=[LAST, MEAN], default=LAST,
+                        help="exposure of a fund : latest date (default) or mean over the dates")
+    parser.add_argument("--top", type=int, default=10, help="categories printed per table")
+    parser.add_argument("--output", "-o", help="write every category of every table to this CSV file")
+    args = parser.parse_args()
+
+    try:
+        isins, weights = read_book(args.book)
+    except ValueError as e:
+        parser.error(str(e))
+
+    product_ids = product_ids_of(isins)
+    if args.fetch:
+        stored = np.isin(product_ids, stored_product_ids(args.directory))
+        missing = [isin for isin, product_id, is_stored in zip(isins, product_ids, stored)
+                   if product_id < 0 or not is_stored]
+        if len(missing) > 0:
+            print(f"Downloading the compositions of {len(missing)} funds")
+            asyncio.run(fetch_exposures(missing, args.directory, args.base_url))
+            product_ids = product_ids_of(isins)
+
+    breakdowns = portfolio_breakdowns(product_ids, weights, load_exposure_matrices(
+        product_ids[product_ids >= 0], args.directory, args.method))
+
+    for breakdown in breakdowns:
+        print(f"\n{breakdown.table} ({breakdown.coverage:.0%} of the weight covered)")
+        for category, exposure in list(zip(breakdown.categories, breakdown.exposures))[:args.top]:
+            print(f"  {category:<40} {exposure:>6.1f} %")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["table", "category", "exposure", "coverage"])
+            for breakdown in breakdowns:
+                writer.writerows([breakdown.table, category, round(float(exposure), 4), round(breakdown.coverage, 4)]
+                                 for category, exposure in zip(breakdown.categories, breakdown.exposures))
+        print(f"\nBreakdowns saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 """
 Api for quantalys data
 """
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, Tuple
 from enum import Enum
 
 # Quantalys composition page
@@ -14,194 +15,244 @@ class TypeCompo(Enum):
     DecompositionParStyle = 6
 
 
-def get_main_page_search_data_for_isin(isin: str) -> Dict[str, str]:
+# Columns of the main page search, as requested by the website
+SEARCH_COLUMNS = [
+    "ID_Produit",  # Product ID for search
+    "cTypeFinancialItem",
+    "cClasseFinancialItem",
+    "sTypeFinancialObject",
+    "checkbox",
+    "sNom",
+    "sURL",
+    "sNomManager",
+    "sNomTypeFinancialObject",
+    "sGroupeCat_Specific_Dynamic",
+    "sGroupeCat_rng1",
+    "sCodeISIN",
+    "nVL",
+    "sCurrency",
+    "nStarRating",
+    "nScore",
+    "nRetYTD",
+    "nRet1a",
+    "nRet3a",
+    "nRet5a",
+    "nRet1c",
+    "nRet3c",
+    "nRet1j",
+    "nRet1m",
+    "nRet3m",
+    "nRet6m",
+    "nRet5c",
+    "nRet8c",
+    "nVolat1a",
+    "nVolat3a",
+    "nVolat5a",
+    "nSharpe1a",
+    "nSharpe3a",
+    "nSharpe5a",
+    "nPerteMax1a",
+    "nPerteMax3a",
+    "nPerteMax5a",
+    "nSortino1a",
+    "nSortino3a",
+    "nSortino5a",
+    "nIr1A",
+    "nIr3A",
+    "nIr5A",
+    "nMinInvest",
+    "nFraisGestion",
+    "nFraisEntree",
+    "nFraisSortie",
+    "dtRet",
+    "dtRetMonth",
+    "bFerme",
+    "nIntensiteESG",
+    "nActifEur",
+    "nActifDiffEUR1m",
+    "nActifDiffEUR3m",
+    "nActifDiffEUR6m",
+    "nActifDiffEUR1A",
+    "nActifCompartimentEUR",
+    "nActifCompartimentDiffEUR1m",
+    "nActifCompartimentDiffEUR3m",
+    "nActifCompartimentDiffEUR6m",
+    "nActifCompartimentDiffEUR1A",
+    "nCollecteCompartiment1m",
+    "nCollecteCompartiment3m",
+    "nCollecteCompartiment6m",
+    "nCollecteCompartimentYTD",
+    "nCollecteCompartiment1A",
+    "nCollecteCompartiment3A",
+    "nCollecteRet1m",
+    "nCollecteRet3m",
+    "nCollecteRet6m",
+    "nCollecteRetYTD",
+    "nCollecteRet1A",
+    "nCollecteRet3A",
+    "nCollecteCompartimentRet1m",
+    "nCollecteCompartimentRet3m",
+    "nCollecteCompartimentRet6m",
+    "nCollecteCompartimentRetYTD",
+    "nCollecteCompartimentRet1A",
+    "nCollecteCompartimentRet3A",
+    "isESG",
+    "sArticleSFDR",
+    "nIntensiteISR",
+    "nESG_Environnement",
+    "nESG_Social",
+    "nESG_Gouvernance",
+    "nNbLabels",
+    "sProspectusUrl",
+    "sUrlMainDocument",
+    "isMainDocumentAccessible",
+]
+
+# Columns read by search_fields (and by the index). Only these are requested by default
+REQUIRED_SEARCH_COLUMNS = [
+    "ID_Produit",
+    "sNom",
+    "sGroupeCat_Specific_Dynamic",
+    "sGroupeCat_rng1",
+    "sCodeISIN",
+    "nStarRating",
+    "nSharpe3a",
+]
+
+# Fixed fields of the search form, copied from the website
+SEARCH_FORM_FIELDS = {
+    "draw ": "3",
+    "order[0][dir]": "asc",
+    "search[value]": "",
+    "search[regex]": "false",
+    "nbMaxCompare": "5",
+    "chkTypeProduits": "1",
+    "Values.bETF": "true",
+    "Values.isTypeProduitV2": "true",
+    "Values.sDevise": "",
+    "Values.nAge": "",
+    "Values.sDomicile": "",
+    "Values.nTypeFonds": "",
+    "Values.nTypeInvestisseur": "",
+    "Values.nDistribution": "",
+    "Values.nAMF": "",
+    "Values.bExcludeUncommercialized": "true",
+    "Values.perfAnnu.dateIndex": "0",
+    "Values.perfAnnu.signe": "ge",
+    "Values.perfAnnu.value": "",
+    "Values.perfCumulee.sDate": "0",
+    "Values.perfCumulee.signe": "ge",
+    "Values.perfCumulee.value": "",
+    "Values.superfAnnu.dateIndex": "0",
+    "Values.superfAnnu.signe": "le",
+    "Values.superfAnnu.value": "",
+    "Values.sharpe.dateIndex": "0",
+    "Values.sharpe.signe": "ge",
+    "Values.sharpe.value": "",
+    "Values.volat.dateIndex": "0",
+    "Values.volat.signe": "le",
+    "Values.volat.value": "",
+    "Values.perteMax.dateIndex": "0",
+    "Values.perteMax.signe": "le",
+    "Values.perteMax.value": "",
+    "Values.beta.dateIndex": "0",
+    "Values.beta.signe": "le",
+    "Values.beta.value": "",
+    "Values.ecartSuivi.dateIndex": "0",
+    "Values.ecartSuivi.signe": "le",
+    "Values.ecartSuivi.value": "",
+    "Values.IR.dateIndex": "0",
+    "Values.IR.signe": "le",
+    "Values.IR.value": "",
+    "Values.sortino.dateIndex": "0",
+    "Values.sortino.signe": "le",
+    "Values.sortino.value": "",
+    "Values.ratioOmega.dateIndex": "0",
+    "Values.ratioOmega.signe": "le",
+    "Values.ratioOmega.value": "",
+    "Values.betaHaussier.dateIndex": "0",
+    "Values.betaHaussier.signe": "le",
+    "Values.betaHaussier.value": "",
+    "Values.betaBaissier.dateIndex": "0",
+    "Values.betaBaissier.signe": "le",
+    "Values.betaBaissier.value": "",
+    "Values.upCaptureRatio.dateIndex": "0",
+    "Values.upCaptureRatio.signe": "le",
+    "Values.upCaptureRatio.value": "",
+    "Values.downCaptureRatio.dateIndex": "0",
+    "Values.downCaptureRatio.signe": "le",
+    "Values.downCaptureRatio.value": "",
+    "Values.DSR.dateIndex": "0",
+    "Values.DSR.signe": "le",
+    "Values.DSR.value": "",
+    "Values.var95.dateIndex": "0",
+    "Values.var95.signe": "le",
+    "Values.var95.value": "",
+    "Values.var99.dateIndex": "0",
+    "Values.var99.signe": "le",
+    "Values.var99.value": "",
+    "Values.skewness.dateIndex": "0",
+    "Values.skewness.signe": "le",
+    "Values.skewness.value": "",
+    "Values.kurtosis.dateIndex": "0",
+    "Values.kurtosis.signe": "le",
+    "Values.kurtosis.value": "",
+    "Values.fraisSouscription.Signe": "le",
+    "Values.fraisSouscription.Value": "",
+    "Values.fraisRachat.Signe": "le",
+    "Values.fraisRachat.Value": "",
+    "Values.fraisGestion.Signe": "le",
+    "Values.fraisGestion.Value": "",
+    "Values.fraisCourants.Signe": "le",
+    "Values.fraisCourants.Value": "",
+    "Values.ESG.isEnvironnement": "",
+    "Values.ESG.isSocial": "",
+    "Values.ESG.isGouvernance": "",
+    "Values.isIntersectionContrats": "false",
+    "Values.lstIdProduits[]": "1",
+    "lstIdProduits[]": "1",
+    "Values.isForProposition": "false",
+}
+
+
+@lru_cache(maxsize=None)
+def search_columns(extra_columns: Tuple[str, ...] = ()) -> Tuple[str, ...]:
+    """Columns to request : the required ones and the extra ones, in the website order"""
+    wanted = set(REQUIRED_SEARCH_COLUMNS) | set(extra_columns)
+
+    unknown = wanted - set(SEARCH_COLUMNS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown search columns : {', '.join(sorted(unknown))}")
+
+    return tuple(column for column in SEARCH_COLUMNS if column in wanted)
+
+
+@lru_cache(maxsize=None)
+def search_form_template(columns: Tuple[str, ...]) -> Dict[str, str]:
+    """Search form for these columns, built once per set of columns.
+    The results stay sorted by name : the order refers to the position of sNom in the columns"""
+    return {f"columns[{i}][name]": column for i, column in enumerate(columns)} | {
+        "order[0][column]": str(columns.index("sNom")),
+    } | SEARCH_FORM_FIELDS
+
+
+def get_main_page_search_data_for_isin(isin: str, columns: Tuple[str, ...] | None = None) -> Dict[str, str]:
+    """Data for the POST request to https://www.quantalys.com/Recherche/Data, searching one ISIN"""
+
+    return get_main_page_search_data(isin, columns=columns)
+
+
+def get_main_page_search_data(search: str = "", start: int = 0, length: int = 10,
+                              filters: Dict[str, str] | None = None,
+                              columns: Tuple[str, ...] | None = None) -> Dict[str, str]:
     """Data for the POST request to https://www.quantalys.com/Recherche/Data
-    This was copied from the website"""
-
-    return {
-        "draw ": "3",
-        "columns[0][name]": "ID_Produit",  # Product ID for search
-        "columns[1][name]": "cTypeFinancialItem",
-        "columns[2][name]": "cClasseFinancialItem",
-        "columns[3][name]": "sTypeFinancialObject",
-        "columns[4][name]": "checkbox",
-        "columns[5][name]": "sNom",
-        "columns[6][name]": "sURL",
-        "columns[7][name]": "sNomManager",
-        "columns[8][name]": "sNomTypeFinancialObject",
-        "columns[9][name]": "sGroupeCat_Specific_Dynamic",
-        "columns[10][name]": "sGroupeCat_rng1",
-        "columns[11][name]": "sCodeISIN",
-        "columns[12][name]": "nVL",
-        "columns[13][name]": "sCurrency",
-        "columns[14][name]": "nStarRating",
-        "columns[15][name]": "nScore",
-        "columns[16][name]": "nRetYTD",
-        "columns[17][name]": "nRet1a",
-        "columns[18][name]": "nRet3a",
-        "columns[19][name]": "nRet5a",
-        "columns[20][name]": "nRet1c",
-        "columns[21][name]": "nRet3c",
-        "columns[22][name]": "nRet1j",
-        "columns[23][name]": "nRet1m",
-        "columns[24][name]": "nRet3m",
-        "columns[25][name]": "nRet6m",
-        "columns[26][name]": "nRet5c",
-        "columns[27][name]": "nRet8c",
-        "columns[28][name]": "nVolat1a",
-        "columns[29][name]": "nVolat3a",
-        "columns[30][name]": "nVolat5a",
-        "columns[31][name]": "nSharpe1a",
-        "columns[32][name]": "nSharpe3a",
-        "columns[33][name]": "nSharpe5a",
-        "columns[34][name]": "nPerteMax1a",
-        "columns[35][name]": "nPerteMax3a",
-        "columns[36][name]": "nPerteMax5a",
-        "columns[37][name]": "nSortino1a",
-        "columns[38][name]": "nSortino3a",
-        "columns[39][name]": "nSortino5a",
-        "columns[40][name]": "nIr1A",
-        "columns[41][name]": "nIr3A",
-        "columns[42][name]": "nIr5A",
-        "columns[43][name]": "nMinInvest",
-        "columns[44][name]": "nFraisGestion",
-        "columns[45][name]": "nFraisEntree",
-        "columns[46][name]": "nFraisSortie",
-        "columns[47][name]": "dtRet",
-        "columns[48][name]": "dtRetMonth",
-        "columns[49][name]": "bFerme",
-        "columns[50][name]": "nIntensiteESG",
-        "columns[51][name]": "nActifEur",
-        "columns[52][name]": "nActifDiffEUR1m",
-        "columns[53][name]": "nActifDiffEUR3m",
-        "columns[54][name]": "nActifDiffEUR6m",
-        "columns[55][name]": "nActifDiffEUR1A",
-        "columns[56][name]": "nActifCompartimentEUR",
-        "columns[57][name]": "nActifCompartimentDiffEUR1m",
-        "columns[58][name]": "nActifCompartimentDiffEUR3m",
-        "columns[59][name]": "nActifCompartimentDiffEUR6m",
-        "columns[60][name]": "nActifCompartimentDiffEUR1A",
-        "columns[61][name]": "nCollecteCompartiment1m",
-        "columns[62][name]": "nCollecteCompartiment3m",
-        "columns[63][name]": "nCollecteCompartiment6m",
-        "columns[64][name]": "nCollecteCompartimentYTD",
-        "columns[65][name]": "nCollecteCompartiment1A",
-        "columns[66][name]": "nCollecteCompartiment3A",
-        "columns[67][name]": "nCollecteRet1m",
-        "columns[68][name]": "nCollecteRet3m",
-        "columns[69][name]": "nCollecteRet6m",
-        "columns[70][name]": "nCollecteRetYTD",
-        "columns[71][name]": "nCollecteRet1A",
-        "columns[72][name]": "nCollecteRet3A",
-        "columns[73][name]": "nCollecteCompartimentRet1m",
-        "columns[74][name]": "nCollecteCompartimentRet3m",
-        "columns[75][name]": "nCollecteCompartimentRet6m",
-        "columns[76][name]": "nCollecteCompartimentRetYTD",
-        "columns[77][name]": "nCollecteCompartimentRet1A",
-        "columns[78][name]": "nCollecteCompartimentRet3A",
-        "columns[79][name]": "isESG",
-        "columns[80][name]": "sArticleSFDR",
-        "columns[81][name]": "nIntensiteISR",
-        "columns[82][name]": "nESG_Environnement",
-        "columns[83][name]": "nESG_Social",
-        "columns[84][name]": "nESG_Gouvernance",
-        "columns[85][name]": "nNbLabels",
-        "columns[86][name]": "sProspectusUrl",
-        "columns[87][name]": "sUrlMainDocument",
-        "columns[88][name]": "isMainDocumentAccessible",
-        "order[0][column]": "5",
-        "order[0][dir]": "asc",
-        "start": "0",
-        "length": "10",
-        "search[value]": "",
-        "search[regex]": "false",
-        "nbMaxCompare": "5",
-        "Values.sNomOrISIN": isin,  # ISIN for search
-        "chkTypeProduits": "1",
-        "Values.bETF": "true",
-        "Values.isTypeProduitV2": "true",
-        "Values.sDevise": "",
-        "Values.nAge": "",
-        "Values.sDomicile": "",
-        "Values.nTypeFonds": "",
-        "Values.nTypeInvestisseur": "",
-        "Values.nDistribution": "",
-        "Values.nAMF": "",
-        "Values.bExcludeUncommercialized": "true",
-        "Values.perfAnnu.dateIndex": "0",
-        "Values.perfAnnu.signe": "ge",
-        "Values.perfAnnu.value": "",
-        "Values.perfCumulee.sDate": "0",
-        "Values.perfCumulee.signe": "ge",
-        "Values.perfCumulee.value": "",
-        "Values.superfAnnu.dateIndex": "0",
-        "Values.superfAnnu.signe": "le",
-        "Values.superfAnnu.value": "",
-        "Values.sharpe.dateIndex": "0",
-        "Values.sharpe.signe": "ge",
-        "Values.sharpe.value": "",
-        "Values.volat.dateIndex": "0",
-        "Values.volat.signe": "le",
-        "Values.volat.value": "",
-        "Values.perteMax.dateIndex": "0",
-        "Values.perteMax.signe": "le",
-        "Values.perteMax.value": "",
-        "Values.beta.dateIndex": "0",
-        "Values.beta.signe": "le",
-        "Values.beta.value": "",
-        "Values.ecartSuivi.dateIndex": "0",
-        "Values.ecartSuivi.signe": "le",
-        "Values.ecartSuivi.value": "",
-        "Values.IR.dateIndex": "0",
-        "Values.IR.signe": "le",
-        "Values.IR.value": "",
-        "Values.sortino.dateIndex": "0",
-        "Values.sortino.signe": "le",
-        "Values.sortino.value": "",
-        "Values.ratioOmega.dateIndex": "0",
-        "Values.ratioOmega.signe": "le",
-        "Values.ratioOmega.value": "",
-        "Values.betaHaussier.dateIndex": "0",
-        "Values.betaHaussier.signe": "le",
-        "Values.betaHaussier.value": "",
-        "Values.betaBaissier.dateIndex": "0",
-        "Values.betaBaissier.signe": "le",
-        "Values.betaBaissier.value": "",
-        "Values.upCaptureRatio.dateIndex": "0",
-        "Values.upCaptureRatio.signe": "le",
-        "Values.upCaptureRatio.value": "",
-        "Values.downCaptureRatio.dateIndex": "0",
-        "Values.downCaptureRatio.signe": "le",
-        "Values.downCaptureRatio.value": "",
-        "Values.DSR.dateIndex": "0",
-        "Values.DSR.signe": "le",
-        "Values.DSR.value": "",
-        "Values.var95.dateIndex": "0",
-        "Values.var95.signe": "le",
-        "Values.var95.value": "",
-        "Values.var99.dateIndex": "0",
-        "Values.var99.signe": "le",
-        "Values.var99.value": "",
-        "Values.skewness.dateIndex": "0",
-        "Values.skewness.signe": "le",
-        "Values.skewness.value": "",
-        "Values.kurtosis.dateIndex": "0",
-        "Values.kurtosis.signe": "le",
-        "Values.kurtosis.value": "",
-        "Values.fraisSouscription.Signe": "le",
-        "Values.fraisSouscription.Value": "",
-        "Values.fraisRachat.Signe": "le",
-        "Values.fraisRachat.Value": "",
-        "Values.fraisGestion.Signe": "le",
-        "Values.fraisGestion.Value": "",
-        "Values.fraisCourants.Signe": "le",
-        "Values.fraisCourants.Value": "",
-        "Values.ESG.isEnvironnement": "",
-        "Values.ESG.isSocial": "",
-        "Values.ESG.isGouvernance": "",
-        "Values.isIntersectionContrats": "false",
-        "Values.lstIdProduits[]": "1",
-        "lstIdProduits[]": "1",
-        "sNomOrISIN": isin,  # ISIN for search
-        "Values.isForProposition": "false",
-    }
+    An empty search matches the whole universe. The results are paged with start / length,
+    and filters can override any "Values.*" field of the form.
+    Only the given columns are returned (default : the required ones, see search_columns)"""
+
+    return search_form_template(columns or search_columns()) | {
+        "start": str(start),
+        "length": str(length),
+        "Values.sNomOrISIN": search,  # ISIN for search
+        "sNomOrISIN": search,  # ISIN for search
+    } | (filters or {})
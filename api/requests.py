@@ -1,9 +1,10 @@
 """
 Request functions for the API
 """
-from httpx import AsyncClient
-from typing import TypedDict, List, Dict
-from api.quantalys import TypeCompo, get_main_page_search_data_for_isin
+from httpx import Response
+from typing import TypedDict, List, Dict, Tuple
+from api.quantalys import TypeCompo, get_main_page_search_data, get_main_page_search_data_for_isin
+from api.session import Session
 
 
 class FastSearchResult(TypedDict):
@@ -12,12 +13,12 @@ class FastSearchResult(TypedDict):
     ID_Produit: int
 
 
-async def fast_search(isin: str, client: AsyncClient) -> List[FastSearchResult]:
+async def fast_search(isin: str, session: Session) -> List[FastSearchResult]:
     """Fast search using an ISIN number"""
 
-    url = "https://www.quantalys.com/Recherche/Produits"
+    url = "/Recherche/Produits"
 
-    return await client.post(url, data={
+    return await session.post(url, endpoint="fast_search", data={
         "sSearch": isin,
         "maxItem": "6"  # default max set in the website
     })
@@ -27,26 +28,37 @@ class MainPageResult(TypedDict):
     data: List[Dict[str, str]]
 
 
-async def main_page_search(isin: str, client: AsyncClient) -> MainPageResult:
-    """Main page data search using an ISIN number"""
+async def main_page_search(isin: str, session: Session, columns: Tuple[str, ...] | None = None) -> MainPageResult:
+    """Main page data search using an ISIN number. Only the given columns are requested"""
 
-    url = "https://www.quantalys.com/Recherche/Data"
+    url = "/Recherche/Data"
 
-    return await client.post(url, data=get_main_page_search_data_for_isin(isin))
+    return await session.post(url, endpoint="search", data=get_main_page_search_data_for_isin(isin, columns))
 
 
-async def fonds_page_from_product_id(Product_ID: int, client: AsyncClient) -> str:
+async def main_page_search_page(start: int, length: int, session: Session, search: str = "",
+                                filters: Dict[str, str] | None = None,
+                                columns: Tuple[str, ...] | None = None) -> MainPageResult:
+    """One page of the main page search. An empty search pages through the whole universe"""
+
+    url = "/Recherche/Data"
+
+    # Not cached : the rows are stored in the local index instead
+    return await session.post(url, data=get_main_page_search_data(search, start, length, filters, columns))
+
+
+async def fonds_page_from_product_id(Product_ID: int, session: Session) -> str:
     """Get the fonds page from the product ID.
     Only way to get the SRRI rating"""
 
-    url = f"https://www.quantalys.com/Fonds/{Product_ID}"
+    url = f"/Fonds/{Product_ID}"
 
-    return await client.get(url)
+    return await session.get(url, endpoint="page")
 
 
-async def get_composition_table_from_product_id(Product_ID: int, type_compo: TypeCompo, client: AsyncClient):
+async def get_composition_table_from_product_id(Product_ID: int, type_compo: TypeCompo, session: Session) -> Response:
     """Get the fonds Composition tab page from the product ID."""
 
-    url = "https://www.quantalys.com/Fonds/GetCompoTableAndGraph"
+    url = "/Fonds/GetCompoTableAndGraph"
 
-    return await client.post(url, data={"ID_Produit": Product_ID, "typeCompo": type_compo.value})
+    return await session.post(url, endpoint="composition", data={"ID_Produit": Product_ID, "typeCompo": type_compo.value})
@@ -0,0 +1,177 @@
+"""
+Request scheduler : bounds the number of requests in flight, caps the request rate
+and backs off when Quantalys throttles or fails
+"""
+import asyncio
+import random
+from api.deadlines import waiting_for_scheduler
+from dataclasses import dataclass
+from httpx import NetworkError, Response, TimeoutException
+from time import monotonic
+from typing import Awaitable, Callable
+
+# Status codes worth retrying : throttling and server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class SchedulerConfig:
+    """Concurrency, rate and retry configuration"""
+    max_in_flight: int = 16  # Upper bound of the adaptive concurrency window
+    min_in_flight: int = 1
+    requests_per_second: float = 20.0  # Upper bound of the adaptive rate
+    min_requests_per_second: float = 1.0
+    burst: int = 10  # Token bucket capacity
+    rate_increase: float = 0.2  # Requests per second added on every success
+    decrease_cooldown: float = 1.0  # Throttled responses within this many seconds count as one event
+    max_retries: int = 4
+    backoff_base: float = 0.5  # Seconds, doubled on every attempt
+    backoff_max: float = 30.0
+
+
+@dataclass
+class SchedulerStats:
+    """Retry and throttling statistics for a run"""
+    retries: int = 0
+    throttled: int = 0  # 429 / 5xx / timeouts
+    failures: int = 0  # Requests that ran out of retries
+
+    def __str__(self) -> str:
+        return f"{self.retries} retries, {self.throttled} throttled responses, {self.failures} failures"
+
+
+class TokenBucket:
+    """Token bucket limiting the request rate. The rate can be changed on the fly"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_refill = monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then consume it"""
+        # The lock makes waiters queue up in order instead of all waking up together
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
+class Scheduler:
+    """Global in-flight limit and token bucket, adapted with AIMD :
+    the limits grow slowly on success and are halved on throttling"""
+
+    def __init__(self, config: SchedulerConfig | None = None):
+        self.config = config or SchedulerConfig()
+        self.stats = SchedulerStats()
+
+        self.window = float(self.config.max_in_flight)  # Current concurrency limit
+        self.in_flight = 0
+        self.slot_freed = asyncio.Condition()
+        self.bucket = TokenBucket(self.config.requests_per_second, self.config.burst)
+        self.last_decrease = 0.0
+
+    async def acquire_slot(self) -> None:
+        async with self.slot_freed:
+            try:
+                await self.slot_freed.wait_for(lambda: self.in_flight < int(self.window))
+            except asyncio.CancelledError:
+                # Cancelled after being woken up (e.g. the deadline of its fund expired) : the free slot goes
+                # to another waiter, otherwise they could all wait forever
+                if self.in_flight < int(self.window):
+                    self.slot_freed.notify(1)
+                raise
+            self.in_flight += 1
+
+    async def release_slot(self) -> None:
+        async with self.slot_freed:
+            self.in_flight -= 1
+            # Only wake up as many waiters as there are free slots : waking them all is quadratic
+            self.slot_freed.notify(max(0, int(self.window) - self.in_flight))
+
+    def on_success(self) -> None:
+        """Additive increase"""
+        config = self.config
+        self.window = min(config.max_in_flight, self.window + 1 / self.window)
+        self.bucket.rate = min(config.requests_per_second, self.bucket.rate + config.rate_increase)
+
+    def on_throttle(self) -> None:
+        """Multiplicative decrease"""
+        config = self.config
+        self.stats.throttled += 1
+
+        # A burst of failures is a single congestion event : only decrease once
+        if monotonic() - self.last_decrease < config.decrease_cooldown:
+            return
+        self.last_decrease = monotonic()
+
+        self.window = max(config.min_in_flight, self.window / 2)
+        self.bucket.rate = max(config.min_requests_per_second, self.bucket.rate / 2)
+
+    def backoff_delay(self, attempt: int, response: Response | None) -> float:
+        """Exponential backoff with full jitter. Retry-After is honored when the server sends it"""
+        if response is not None and (retry_after := response.headers.get("Retry-After", "")).isdigit():
+            return float(retry_after)
+
+        return random.uniform(0, min(self.config.backoff_max, self.config.backoff_base * 2 ** attempt))
+
+    async def run_once(self, send: Callable[[], Awaitable[Response]]) -> Response:
+        """Send a request when the limits allow it, without retrying it nor adapting the limits to its response.
+        For the duplicate of a hedged request : the original request already takes care of both"""
+        with waiting_for_scheduler():
+            await self.bucket.acquire()
+            await self.acquire_slot()
+        try:
+            return await send()
+        finally:
+            await self.release_slot()
+
+    async def run(self, send: Callable[[], Awaitable[Response]]) -> Response:
+        """Send a request when the limits allow it, retrying on throttling, server errors, timeouts and network errors.
+        The number of retries is stored in response.extensions["retries"]"""
+
+        for attempt in range(self.config.max_retries + 1):
+            # The deadline of the fund does not run while it waits behind the other funds
+            with waiting_for_scheduler():
+                await self.bucket.acquire()
+                await self.acquire_slot()
+
+            response = None
+            error = None
+            try:
+                response = await send()
+            except (TimeoutException, NetworkError) as e:  # Transient, unlike protocol or proxy errors
+                error = e
+            finally:
+                await self.release_slot()
+
+            if response is not None:
+                response.extensions["retries"] = attempt
+
+            if error is None and response.status_code not in RETRY_STATUS_CODES:
+                self.on_success()
+                return response
+
+            self.on_throttle()
+
+            if attempt == self.config.max_retries:
+                break
+
+            self.stats.retries += 1
+            await asyncio.sleep(self.backoff_delay(attempt, response))
+
+        # Out of retries
+        self.stats.failures += 1
+        if error is not None:
+            raise error
+        response.raise_for_status()
+        return response
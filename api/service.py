@@ -0,0 +1,309 @@
+"""
+Resident lookup service : a local HTTP/JSON API over the pipeline of main.py.
+The connection pool, the response cache, the ISIN -> product ID index and the results stay warm between calls,
+and the ISINs requested within a few milliseconds are fetched together as one batch
+
+Usage : python -m api.service [--port 8080] [--batch-window 5]
+
+    GET  /fund/{isin}[?columns=Rating SRRI,Zone Géo&search_columns=nVolat3a]
+         404 when Quantalys does not know the fund, 502 when it could not be fetched (try again later)
+    POST /funds  {"isins": [...], "columns": [...], "search_columns": [...]}
+         The funds that could not be fetched are listed in "failed", with an ISIN only row
+    GET  /metrics  (Prometheus text format)
+    GET  /health
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+from api.cache import CacheConfig, ResponseCache
+from api.data import FundsData, parse_executor
+from api.fields import FieldPlan, field_plan
+from api.index import ProductIndex
+from api.pipeline import Pipeline, enumerated
+from api.scheduler import Scheduler, SchedulerConfig
+from api.session import Session, SessionConfig
+from collections import OrderedDict
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from http import HTTPStatus
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MAX_BODY_SIZE = 1024 * 1024  # Bytes
+
+
+@dataclass
+class ServiceConfig:
+    host: str = "127.0.0.1"
+    port: int = 8080
+    batch_window: float = 0.005  # Seconds waited for other ISINs before fetching a batch
+    max_batch: int = 256  # ISINs fetched together at most
+    result_ttl: float = 60 * 60  # Seconds a computed row is served from memory
+    max_results: int = 100_000  # Rows kept in memory, the oldest are evicted above
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FundService:
+    """Rows of the funds, served from memory when computed recently, else fetched in micro-batches.
+    Concurrent lookups of the same fund share a single fetch"""
+
+    def __init__(self, session: Session, index: ProductIndex | None = None, executor: Executor | None = None,
+                 config: ServiceConfig | None = None):
+        self.session = session
+        self.index = index
+        self.executor = executor
+        self.config = config or ServiceConfig()
+
+        # (ISIN, plan) -> (expiry, row future), oldest first
+        self.results: OrderedDict[Tuple[str, FieldPlan], Tuple[float, asyncio.Future]] = OrderedDict()
+        # Lookups waiting for the next batch
+        self.pending: Dict[Tuple[str, FieldPlan], asyncio.Future] = {}
+        self.flush_timer: asyncio.TimerHandle | None = None
+        self.batches: set = set()
+
+        self.lookups = 0
+        self.hits = 0  # Served from memory, or joined a fetch in progress
+        self.fetched = 0
+
+    def lookup(self, isin: str, plan: FieldPlan) -> asyncio.Future:
+        """Future row of a fund"""
+        self.lookups += 1
+        key = (isin, plan)
+
+        entry = self.results.get(key)
+        if entry is not None and (not entry[1].done() or entry[0] > monotonic()):
+            self.hits += 1
+            return entry[1]
+
+        future = asyncio.get_running_loop().create_future()
+        self.results[key] = (monotonic() + self.config.result_ttl, future)
+        self.results.move_to_end(key)
+        while len(self.results) > self.config.max_results:
+            self.results.popitem(last=False)
+
+        self.pending[key] = future
+        if len(self.pending) >= self.config.max_batch:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.config.batch_window, self.flush)
+
+        return future
+
+    def flush(self) -> None:
+        """Fetch the pending lookups as one batch"""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        batch, self.pending = self.pending, {}
+        if len(batch) > 0:
+            task = asyncio.create_task(self.fetch_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def fetch_batch(self, batch: Dict[Tuple[str, FieldPlan], asyncio.Future]) -> None:
+        """Fetch a batch, through one pipeline per plan.
+        Share classes of the same fund within a batch share their fund page and compositions"""
+        self.fetched += len(batch)
+        lookups: Dict[FieldPlan, List[Tuple[str, asyncio.Future]]] = {}
+        for (isin, plan), future in batch.items():
+            lookups.setdefault(plan, []).append((isin, future))
+
+        await asyncio.gather(*(self.fetch_plan(plan, plan_lookups) for plan, plan_lookups in lookups.items()))
+
+    async def fetch_plan(self, plan: FieldPlan, lookups: List[Tuple[str, asyncio.Future]]) -> None:
+        def emit(position: int, row: FundsData) -> None:
+            isin, future = lookups[position]
+            if isin in pipeline.failed:
+                future.set_exception(HTTPError(HTTPStatus.BAD_GATEWAY, f"Could not fetch {isin} from Quantalys"))
+            else:
+                future.set_result(row)
+
+            # Failed and unknown funds (ISIN only) are fetched again on the next lookup
+            if len(row) <= 1:
+                self.forget(isin, plan, future)
+
+        pipeline = Pipeline(self.session, plan, emit, index=self.index, executor=self.executor)
+        try:
+            await pipeline.run(enumerated(isin for isin, _ in lookups))
+        except Exception as e:
+            for isin, future in lookups:
+                if not future.done():
+                    future.set_exception(e)
+                    self.forget(isin, plan, future)
+
+    def forget(self, isin: str, plan: FieldPlan, future: asyncio.Future) -> None:
+        if self.results.get((isin, plan), (None, None))[1] is future:
+            del self.results[(isin, plan)]
+
+    async def funds(self, isins: List[str], plan: FieldPlan) -> List[FundsData | Exception]:
+        """Row of every fund, or the error of its fetch"""
+        futures = [self.lookup(isin, plan) for isin in isins]
+        # The service outlives a cancelled client : shield the shared fetches
+        results = await asyncio.shield(asyncio.gather(*futures, return_exceptions=True))
+        return [result if isinstance(result, Exception) else dict(result) for result in results]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"lookups": self.lookups, "hits": self.hits, "fetched": self.fetched,
+                "results_in_memory": len(self.results), "connections": str(self.session.stats)}
+
+
+def request_plan(columns: List[str] | None, search_columns: List[str]) -> FieldPlan:
+    try:
+        return field_plan(columns, search_columns)
+    except ValueError as e:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+
+
+def split_parameter(query: Dict[str, List[str]], name: str) -> List[str] | None:
+    """Comma separated list parameter, None if absent"""
+    if name not in query:
+        return None
+    return [column.strip() for value in query[name] for column in value.split(",") if column.strip()]
+
+
+class FundServer:
+    """Minimal HTTP/1.1 server (keep-alive, JSON) on the event loop of the service"""
+
+    def __init__(self, service: FundService):
+        self.service = service
+
+    async def route(self, method: str, target: str, body: bytes) -> Tuple[HTTPStatus, str, bytes]:
+        """Status, content type and body of the response"""
+        url = urlsplit(target)
+        path = unquote(url.path).rstrip("/")
+        query = parse_qs(url.query)
+
+        if method == "GET" and path.startswith("/fund/"):
+            plan = request_plan(split_parameter(query, "columns"), split_parameter(query, "search_columns") or [])
+            isin = path.removeprefix("/fund/").strip().upper()
+            [row] = await self.service.funds([isin], plan)
+            if isinstance(row, Exception):
+                raise row
+            if len(row) <= 1:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"No data for {isin}")
+            return HTTPStatus.OK, "application/json", json.dumps(row, ensure_ascii=False).encode()
+
+        if method == "POST" and path == "/funds":
+            try:
+                request = json.loads(body)
+                isins = [str(isin).strip().upper() for isin in request["isins"]]
+            except (ValueError, KeyError, TypeError):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, 'Expected a JSON object with an "isins" list')
+            plan = request_plan(request.get("columns"), request.get("search_columns", []))
+            results = await self.service.funds(isins, plan)
+            rows = [{"ISIN": isin} if isinstance(row, Exception) else row for isin, row in zip(isins, results)]
+            failed = [isin for isin, row in zip(isins, results) if isinstance(row, Exception)]
+            return (HTTPStatus.OK, "application/json",
+                    json.dumps({"funds": rows, "failed": failed}, ensure_ascii=False).encode())
+
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, "text/plain; version=0.0.4", self.service.session.metrics.to_prometheus().encode()
+
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, "application/json", json.dumps(self.service.stats()).encode()
+
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"No route for {method} {url.path}")
+
+    async def respond(self, method: str, target: str, body: bytes) -> Tuple[HTTPStatus, str, bytes]:
+        try:
+            with self.service.session.metrics.stage("service"):
+                return await self.route(method, target, body)
+        except HTTPError as e:
+            return e.status, "application/json", json.dumps({"error": str(e)}, ensure_ascii=False).encode()
+        except Exception as e:
+            return (HTTPStatus.INTERNAL_SERVER_ERROR, "application/json",
+                    json.dumps({"error": str(e)}, ensure_ascii=False).encode())
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    break
+                body = await reader.readexactly(length)
+
+                status, content_type, content = await self.respond(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+                writer.write((f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                              f"Content-Type: {content_type}\r\n"
+                              f"Content-Length: {len(content)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client gone, or not speaking HTTP
+        finally:
+            writer.close()
+
+
+async def serve(args: argparse.Namespace) -> None:
+    config = ServiceConfig(host=args.host, port=args.port, batch_window=args.batch_window / 1000)
+    cache = None if args.no_cache else ResponseCache(CacheConfig())
+    session_config = SessionConfig(max_connections=args.max_connections, base_url=args.base_url)
+    scheduler_config = SchedulerConfig(max_in_flight=args.max_in_flight, requests_per_second=args.rps)
+    index = ProductIndex()
+    # Forked from a server process : a fork of the service, with its event loop and threads, could deadlock
+    executor = parse_executor(args.parse_workers) if args.parse_workers > 0 else None
+
+    # Stopped by SIGTERM (e.g. systemd) : shut the parsing processes down too
+    if sys.platform != "win32":
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    try:
+        async with Session(session_config, Scheduler(scheduler_config), cache) as session:
+            server = FundServer(FundService(session, index, executor, config))
+            listener = await asyncio.start_server(server.handle_connection, config.host, config.port)
+            print(f"Serving on http://{config.host}:{config.port}")
+            async with listener:
+                await listener.serve_forever()
+    finally:
+        index.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fund data as a local HTTP/JSON API")
+    parser.add_argument("--host", default=ServiceConfig.host)
+    parser.add_argument("--port", type=int, default=ServiceConfig.port)
+    parser.add_argument("--batch-window", type=float, default=ServiceConfig.batch_window * 1000,
+                        help="milliseconds waited for other ISINs before fetching a batch")
+    parser.add_argument("--max-connections", type=int, default=SessionConfig.max_connections)
+    parser.add_argument("--max-in-flight", type=int, default=SchedulerConfig.max_in_flight)
+    parser.add_argument("--rps", type=float, default=SchedulerConfig.requests_per_second)
+    parser.add_argument("--no-cache", action="store_true", help="do not use the on-disk response cache")
+    parser.add_argument("--base-url", default=SessionConfig.base_url)
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count(),
+                        help="processes parsing the fund pages (0 : parse in the service process)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
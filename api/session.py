@@ -0,0 +1,222 @@
+"""
+HTTP session shared by every request of a run
+"""
+import asyncio
+from dataclasses import dataclass
+from api.cache import ResponseCache, conditional_headers, entry_to_response, request_key
+from api.deadlines import in_flight
+from api.fixtures import FixtureStore
+from api.hedging import Hedger
+from api.metrics import CACHE_BYPASS, CACHE_COALESCED, CACHE_HIT, CACHE_MISS, CACHE_REVALIDATED, Metrics
+from api.scheduler import Scheduler
+from httpx import AsyncClient, AsyncHTTPTransport, HTTPStatusError, Limits, Request, Response, Timeout, TransportError
+from time import perf_counter
+from typing import Any, Dict, Tuple
+
+BASE_URL = "https://www.quantalys.com"
+
+
+@dataclass
+class SessionConfig:
+    """Connection pool configuration"""
+    max_connections: int = 20
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0  # Seconds an idle connection is kept open
+    http2: bool = False  # Requires the "h2" package
+    base_url: str = BASE_URL
+    # Seconds. A request exceeding them fails with a timeout, which the scheduler retries
+    connect_timeout: float = 10.0
+    timeout: float = 30.0  # Between two bytes of the response, and to get a connection from the pool
+
+
+def share(future: asyncio.Future, waiters: Dict[asyncio.Future, int]) -> asyncio.Future:
+    """Shielded view of a future awaited by several callers : a caller giving up does not cancel it for the others.
+    Once they all gave up (e.g. the deadline of their fund expired), it is cancelled. waiters counts the callers"""
+    waiters[future] = waiters.get(future, 0) + 1
+    view = asyncio.shield(future)
+    view.add_done_callback(lambda view: leave(future, waiters))
+    return view
+
+
+def leave(future: asyncio.Future, waiters: Dict[asyncio.Future, int]) -> None:
+    waiters[future] -= 1
+    if waiters[future] == 0:
+        del waiters[future]
+        future.cancel()  # Nothing if it is done
+
+
+@dataclass
+class SessionStats:
+    """Connection usage statistics for a run"""
+    requests: int = 0
+    connections_opened: int = 0
+
+    @property
+    def connections_reused(self) -> int:
+        return self.requests - self.connections_opened
+
+    def __str__(self) -> str:
+        return (f"{self.requests} requests, {self.connections_opened} connections opened, "
+                f"{self.connections_reused} reused")
+
+
+class CountingTransport(AsyncHTTPTransport):
+    """Transport that counts requests and newly opened connections"""
+
+    def __init__(self, stats: SessionStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: Request) -> Response:
+        # httpcore calls the trace extension for every connection event
+        request.extensions["trace"] = self.trace
+        response = await super().handle_async_request(request)
+
+        # Only answered requests are counted : failed connections are neither opened nor reused
+        self.stats.requests += 1
+        return response
+
+    async def trace(self, event_name: str, info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.connections_opened += 1
+
+
+class Session:
+    """Pooled HTTP session, owned by main() and passed down to the request functions.
+    Every request goes through the scheduler, and through the response cache if there is one.
+    With a recorder, every response is also saved as a fixture for the mock server.
+    Every request is measured in the run metrics.
+    Identical requests made while one is in flight share its response instead of hitting the network again.
+    Slow requests are hedged by the hedger, their duplicate going through the scheduler too"""
+
+    def __init__(self, config: SessionConfig | None = None, scheduler: Scheduler | None = None,
+                 cache: ResponseCache | None = None, recorder: FixtureStore | None = None,
+                 metrics: Metrics | None = None, hedger: Hedger | None = None):
+        self.config = config or SessionConfig()
+        self.stats = SessionStats()
+        self.scheduler = scheduler or Scheduler()
+        self.cache = cache
+        self.recorder = recorder
+        self.metrics = metrics or Metrics()
+        self.hedger = hedger or Hedger()
+        self.in_flight: Dict[str, asyncio.Future] = {}  # Request key -> response being fetched
+        self.waiters: Dict[asyncio.Future, int] = {}  # Callers of every request in flight
+
+        limits = Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+        transport = CountingTransport(self.stats, limits=limits, http2=self.config.http2)
+
+        timeout = Timeout(self.config.timeout, connect=self.config.connect_timeout)
+        self.client = AsyncClient(base_url=self.config.base_url, timeout=timeout, transport=transport)
+
+    async def __aenter__(self) -> "Session":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+        if self.cache is not None:
+            self.cache.close()
+
+    async def send(self, method: str, url: str, endpoint: str | None = None, **kwargs) -> Response:
+        """Send a request through the scheduler and the shared connection pool.
+        Requests to an endpoint are hedged when they are slower than usual"""
+
+        async def attempt() -> Response:
+            with in_flight():
+                if endpoint is None:
+                    return await self.client.request(method, url, **kwargs)
+                return await self.hedger.run(endpoint, lambda: self.client.request(method, url, **kwargs),
+                                             self.scheduler.run_once)
+
+        return await self.scheduler.run(attempt)
+
+    async def request(self, method: str, url: str, endpoint: str | None = None, data: Dict | None = None,
+                      **kwargs) -> Response:
+        """Send a request, answering from the cache when possible.
+        The endpoint name selects the cache TTL, requests without one are never cached nor recorded.
+        A request identical to one in flight waits for its response (single flight).
+        It is cancelled if all its callers are"""
+
+        key = request_key(method, url, data)
+
+        if (flight := self.in_flight.get(key)) is not None:
+            start = perf_counter()
+            # A cancelled caller must not cancel the request of the others
+            response = await share(flight, self.waiters)
+            self.metrics.record_request(endpoint or url, perf_counter() - start, response.status_code, 0, 0,
+                                        CACHE_COALESCED)
+            return response
+
+        flight = asyncio.ensure_future(self.fetch(method, url, endpoint, data, **kwargs))
+        self.in_flight[key] = flight
+        flight.add_done_callback(lambda flight: self.land(key, flight))
+
+        return await share(flight, self.waiters)
+
+    def land(self, key: str, flight: asyncio.Future) -> None:
+        """Forget a finished request : the next identical one goes to the cache or the network again"""
+        del self.in_flight[key]
+        # Mark the error as retrieved, in case every caller was cancelled
+        if not flight.cancelled():
+            flight.exception()
+
+    async def fetch(self, method: str, url: str, endpoint: str | None, data: Dict | None, **kwargs) -> Response:
+        """Send a request through the cache, measuring it and recording its response"""
+
+        start = perf_counter()
+        try:
+            response, cache = await self.cached_request(method, url, endpoint, data, **kwargs)
+        except HTTPStatusError as e:  # Out of retries, the last response is in the error
+            self.metrics.record_request(endpoint or url, perf_counter() - start, e.response.status_code,
+                                        len(e.response.content), e.response.extensions.get("retries", 0), CACHE_MISS)
+            raise
+        except TransportError:  # Out of retries, without any response
+            self.metrics.record_request(endpoint or url, perf_counter() - start, None, 0,
+                                        self.scheduler.config.max_retries, CACHE_MISS)
+            raise
+
+        self.metrics.record_request(
+            endpoint or url, perf_counter() - start, response.status_code,
+            0 if cache in (CACHE_HIT, CACHE_REVALIDATED) else len(response.content),
+            response.extensions.get("retries", 0), cache)
+
+        if self.recorder is not None and endpoint is not None and response.status_code == 200:
+            self.recorder.record(method, url, data, endpoint, response)
+
+        return response
+
+    async def cached_request(self, method: str, url: str, endpoint: str | None, data: Dict | None,
+                             **kwargs) -> Tuple[Response, str]:
+        """Response and cache outcome of a request"""
+        if self.cache is None or endpoint is None:
+            return await self.send(method, url, endpoint, data=data, **kwargs), CACHE_BYPASS
+
+        key = request_key(method, url, data)
+        entry, fresh = self.cache.lookup(key, endpoint)
+        if fresh:
+            return entry_to_response(entry, method, url), CACHE_HIT
+
+        # Stale entry : let the server tell us if it changed
+        headers = conditional_headers(entry) if entry is not None else {}
+        response = await self.send(method, url, endpoint, data=data, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.refresh(key)
+            return entry_to_response(entry, method, url), CACHE_REVALIDATED
+
+        if response.status_code == 200:
+            self.cache.put(key, endpoint, response)
+
+        return response, CACHE_MISS
+
+    async def get(self, url: str, **kwargs) -> Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> Response:
+        return await self.request("POST", url, **kwargs)
@@ -0,0 +1,138 @@
+"""
+State of every fund after the last run, for the incremental refresh :
+the freshness markers of the search, the hash of the fund page and the row
+"""
+import json
+import os
+import sqlite3
+from api.cache import DATA_DIRECTORY
+from api.fields import COMPOSITION, PAGE, FieldPlan
+from dataclasses import dataclass, field, replace
+from time import time
+from typing import Any, Dict
+
+SNAPSHOTS_PATH = os.path.join(DATA_DIRECTORY, "snapshots.sqlite")
+
+# Search columns telling when the data of a fund last changed
+PERFORMANCE_DATE = "dtRet"  # Daily : the performances of the fund page
+MONTHLY_DATE = "dtRetMonth"  # Monthly : the composition tables
+FRESHNESS_COLUMNS = (PERFORMANCE_DATE, MONTHLY_DATE)
+
+# Columns produced by the fund page and by the composition tables
+PAGE_COLUMNS = ("Rating SRRI", "Zone Géo", "Perf. 1er janvier", "Perf. 1 an", "Perf. 3 ans", "Perf. 5 ans")
+COMPOSITION_COLUMNS = ("Secteur et Style",)
+
+
+@dataclass
+class FundState:
+    row: Dict[str, Any]
+    markers: Dict[str, Any]  # Freshness columns of the search
+    page_hash: str | None  # sha256 of the fund page
+
+
+@dataclass
+class FundRefresh:
+    """Refresh of one fund : its state after the previous run, and the new one, filled by the pipeline"""
+    previous: FundState | None
+    markers: Dict[str, Any] = field(default_factory=dict)
+    page_hash: str | None = None
+    fetched_page: bool = False
+    page_unchanged: bool = False  # Same hash as the previous run : not parsed, the previous values are kept
+    fetched_compositions: bool = False
+    expired: bool = False  # Deadline expired : the row is partial, the previous state is kept
+
+    def changed(self, marker: str, columns: tuple) -> bool:
+        """Whether the data behind these columns may have changed since the previous run"""
+        if self.previous is None or self.previous.markers.get(marker) is None:
+            return True
+        if any(column not in self.previous.row for column in columns):
+            return True  # Not selected last time
+        return self.markers.get(marker) != self.previous.markers[marker]
+
+    def stale_plan(self, plan: FieldPlan) -> FieldPlan:
+        """Plan only fetching the endpoints whose data changed"""
+        endpoints = set(plan.endpoints)
+        if not self.changed(PERFORMANCE_DATE, tuple(c for c in PAGE_COLUMNS if c in plan.columns)):
+            endpoints.discard(PAGE)
+        if not self.changed(MONTHLY_DATE, tuple(c for c in COMPOSITION_COLUMNS if c in plan.columns)):
+            endpoints.discard(COMPOSITION)
+        return replace(plan, endpoints=frozenset(endpoints))
+
+    def carried(self, column: str) -> Any:
+        """Value of the previous run"""
+        return self.previous.row.get(column) if self.previous is not None else None
+
+    def state(self, row: Dict[str, Any]) -> FundState:
+        previous_hash = self.previous.page_hash if self.previous is not None else None
+        return FundState(row, self.markers, self.page_hash or previous_hash)
+
+
+@dataclass
+class RefreshStats:
+    funds: int = 0
+    new: int = 0  # Not in the previous snapshot
+    pages_fetched: int = 0
+    pages_unchanged: int = 0  # Fetched, but with the same content : not parsed
+    compositions_fetched: int = 0
+
+    def __str__(self) -> str:
+        return (f"{self.funds} funds ({self.new} new), {self.pages_fetched} fund pages fetched "
+                f"({self.pages_unchanged} unchanged), {self.compositions_fetched} compositions fetched")
+
+
+class SnapshotStore:
+    """Latest state of every fund, in a sqlite file"""
+
+    def __init__(self, path: str = SNAPSHOTS_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS funds (
+            isin TEXT PRIMARY KEY,
+            row TEXT,
+            markers TEXT,
+            page_hash TEXT,
+            updated_at REAL
+        )""")
+        self.stats = RefreshStats()
+        self.refreshes: Dict[str, FundRefresh] = {}  # Funds of this run : a repeated ISIN shares its refresh
+
+    def __enter__(self) -> "SnapshotStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def get(self, isin: str) -> FundState | None:
+        entry = self.db.execute("SELECT row, markers, page_hash FROM funds WHERE isin = ?", (isin,)).fetchone()
+        if entry is None:
+            return None
+        return FundState(json.loads(entry[0]), json.loads(entry[1]), entry[2])
+
+    def refresh(self, isin: str) -> FundRefresh:
+        if isin not in self.refreshes:
+            self.refreshes[isin] = FundRefresh(self.get(isin))
+        return self.refreshes[isin]
+
+    def put(self, isin: str, refresh: FundRefresh, row: Dict[str, Any]) -> None:
+        """Save the new state of a refreshed fund, once per run.
+        Failed funds (ISIN only) and partial rows keep their previous state"""
+        if self.refreshes.pop(isin, None) is None:
+            return  # Repeated ISIN, already saved
+        self.stats.funds += 1
+        self.stats.new += refresh.previous is None
+        self.stats.pages_fetched += refresh.fetched_page
+        self.stats.pages_unchanged += refresh.page_unchanged
+        self.stats.compositions_fetched += refresh.fetched_compositions
+
+        if len(row) <= 1 or refresh.expired:
+            return
+
+        state = refresh.state(row)
+        self.db.execute("INSERT OR REPLACE INTO funds VALUES (?, ?, ?, ?, ?)", (
+            isin, json.dumps(state.row, ensure_ascii=False), json.dumps(state.markers), state.page_hash, time()))
+        self.db.commit()
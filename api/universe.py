@@ -0,0 +1,77 @@
+"""
+Bulk crawl of the searchable universe, page by page, into the local index.
+Afterwards the per-ISIN search is a local lookup
+
+Usage : python -m api.universe [--search TEXT] [--page-size 500]
+"""
+import argparse
+import asyncio
+from api.index import ProductIndex
+from api.quantalys import search_columns
+from api.requests import main_page_search_page
+from api.session import Session
+from math import ceil
+from time import time
+from typing import Dict, Tuple
+
+# Rows per page. The website uses 10, the server accepts much larger pages
+CRAWL_PAGE_SIZE = 500
+
+
+async def crawl_universe(session: Session, index: ProductIndex, search: str = "",
+                         filters: Dict[str, str] | None = None, page_size: int = CRAWL_PAGE_SIZE,
+                         columns: Tuple[str, ...] | None = None) -> int:
+    """Page through the search results (the whole universe by default) and store every row.
+    Only the given columns are crawled (default : the ones main.py needs). Returns the number of rows stored"""
+
+    # The first page tells how many rows there are : the other pages are then fetched concurrently
+    first_page = (await main_page_search_page(0, page_size, session, search, filters, columns)).json()
+    stored = index.put_search_rows(first_page["data"])
+
+    total = first_page.get("recordsFiltered", first_page.get("recordsTotal"))
+
+    if total is None:
+        # Unknown total : keep going until a page comes back incomplete
+        start = page_size
+        rows = first_page["data"]
+        while len(rows) == page_size:
+            rows = (await main_page_search_page(start, page_size, session, search, filters, columns)).json()["data"]
+            stored += index.put_search_rows(rows)
+            start += page_size
+
+        return stored
+
+    async def crawl_page(page: int) -> int:
+        response = await main_page_search_page(page * page_size, page_size, session, search, filters, columns)
+        return index.put_search_rows(response.json()["data"])
+
+    stored += sum(await asyncio.gather(*(crawl_page(page) for page in range(1, ceil(int(total) / page_size)))))
+
+    return stored
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Crawl the Quantalys search universe into the local index")
+    parser.add_argument("--search", default="", help="Only crawl the funds matching this text (default : everything)")
+    parser.add_argument("--page-size", type=int, default=CRAWL_PAGE_SIZE, help="Rows per search request")
+    parser.add_argument("--search-columns", nargs="+", default=[], metavar="COLUMN",
+                        help="Extra columns to crawl, for main.py --search-columns")
+    args = parser.parse_args()
+
+    try:
+        columns = search_columns(tuple(args.search_columns))
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time()
+    index = ProductIndex()
+
+    async with Session() as session:
+        stored = await crawl_universe(session, index, args.search, page_size=args.page_size, columns=columns)
+
+    index.close()
+    print(f"{stored} funds stored in {time() - start:.2f} seconds ({session.stats})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+"""
+Typed output writers : Parquet, Arrow IPC and SQLite, with the numbers parsed.
+Rows are written in batches as the funds complete, with their input position
+"""
+import importlib.util
+import math
+import sqlite3
+from api.fields import INTEGER, NUMBER, PERCENT, TEXT, parse_french_number, parse_french_percent
+from typing import Any, Dict, List
+
+WRITE_BATCH_ROWS = 1000  # Rows buffered before a batch is written
+
+PARQUET_EXTENSIONS = (".parquet",)
+ARROW_EXTENSIONS = (".arrow", ".feather")
+SQLITE_EXTENSIONS = (".sqlite", ".db")
+TYPED_EXTENSIONS = PARQUET_EXTENSIONS + ARROW_EXTENSIONS + SQLITE_EXTENSIONS
+
+SQLITE_TYPES = {TEXT: "TEXT", INTEGER: "INTEGER", NUMBER: "REAL", PERCENT: "REAL"}
+
+
+def is_typed_output(path: str) -> bool:
+    return path.lower().endswith(TYPED_EXTENSIONS)
+
+
+def typed_value(kind: str, value: Any) -> Any:
+    """Value converted to its column type. Missing values, and values that are not numbers in a numeric column
+    ("N/D", free text), are None : a single odd cell must not stop the run"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+
+    if kind == TEXT:
+        return str(value)
+
+    try:
+        if isinstance(value, str):
+            value = parse_french_percent(value) if kind == PERCENT else parse_french_number(value)
+        if math.isnan(value):
+            return None
+        return int(value) if kind == INTEGER else float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class ResultWriter:
+    """Base writer : buffers typed rows, and writes them in batches"""
+
+    def __init__(self, path: str, kinds: Dict[str, str], batch_rows: int = WRITE_BATCH_ROWS):
+        self.path = path
+        self.kinds = {"position": INTEGER} | kinds
+        self.batch_rows = batch_rows
+        self.buffer: List[Dict[str, Any]] = []
+        self.rows = 0
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, position: int, row: Dict) -> None:
+        row = {"position": position} | row
+        self.buffer.append({column: typed_value(kind, row.get(column)) for column, kind in self.kinds.items()})
+        if len(self.buffer) >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.buffer) > 0:
+            self.write_batch(self.buffer)
+            self.rows += len(self.buffer)
+            self.buffer = []
+
+    def write_batch(self, rows: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.flush()
+
+
+class ArrowWriter(ResultWriter):
+    """Parquet file (one row group per batch) or Arrow IPC file (one record batch per batch)"""
+
+    def __init__(self, path: str, kinds: Dict[str, str], batch_rows: int = WRITE_BATCH_ROWS):
+        super().__init__(path, kinds, batch_rows)
+        # Parquet and Arrow need pyarrow, which is optional and slow to import : only imported here
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+        self.pa = pa
+
+        arrow_types = {TEXT: pa.string(), INTEGER: pa.int64(), NUMBER: pa.float64(), PERCENT: pa.float64()}
+        self.schema = pa.schema([(column, arrow_types[kind]) for column, kind in self.kinds.items()])
+
+        if path.lower().endswith(PARQUET_EXTENSIONS):
+            self.writer = pa.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write_batch(self, rows: List[Dict[str, Any]]) -> None:
+        self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self) -> None:
+        super().close()
+        self.writer.close()
+
+
+class SqliteWriter(ResultWriter):
+    """"results" table of a SQLite database, replaced if it exists"""
+
+    def __init__(self, path: str, kinds: Dict[str, str], batch_rows: int = WRITE_BATCH_ROWS):
+        super().__init__(path, kinds, batch_rows)
+        self.db = sqlite3.connect(path)
+        self.db.execute("DROP TABLE IF EXISTS results")
+        self.db.execute(f"""CREATE TABLE results ({", ".join(
+            f'"{column}" {SQLITE_TYPES[kind]}' for column, kind in self.kinds.items())})""")
+
+    def write_batch(self, rows: List[Dict[str, Any]]) -> None:
+        self.db.executemany(f"INSERT INTO results VALUES ({', '.join('?' * len(self.kinds))})",
+                            [tuple(row.values()) for row in rows])
+        self.db.commit()
+
+    def close(self) -> None:
+        super().close()
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_position ON results (position)")
+        self.db.commit()
+        self.db.close()
+
+
+def check_output(path: str) -> None:
+    """Raises ValueError if the format of path is not available"""
+    if path.lower().endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS) and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError(f'Writing {path} requires the "pyarrow" package')
+    excel_packages = ("pandas", "openpyxl")
+    if path.lower().endswith(".xlsx") and any(importlib.util.find_spec(name) is None for name in excel_packages):
+        raise ValueError(f'Writing {path} requires the "pandas" and "openpyxl" packages')
+
+
+def open_writer(path: str, kinds: Dict[str, str], batch_rows: int = WRITE_BATCH_ROWS) -> ResultWriter:
+    """Writer for the extension of path (see TYPED_EXTENSIONS). Raises ValueError if the format is not available"""
+    check_output(path)
+
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteWriter(path, kinds, batch_rows)
+    if path.lower().endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS):
+        return ArrowWriter(path, kinds, batch_rows)
+
+    raise ValueError(f"No typed writer for {path}")
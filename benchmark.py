@@ -0,0 +1,389 @@
+"""
+Benchmark of the scraper against the local mock server : end-to-end throughput, per-fund latency,
+requests per fund, and CPU cost of the parsing functions.
+Responses are replayed from recorded fixtures (--fixtures) or generated for any ISIN.
+Every fund of a portfolio is distinct : a repeated ISIN would be served from the run memo, not fetched.
+
+Also measures the startup of main.py : time to the interactive prompt, and to the first result.
+
+Usage : python benchmark.py [--sizes 100 1000 10000] [--concurrency 8 16 32 64] [--output bench.json]
+"""
+from api.cache import request_key
+from api.data import (FondsPage, compute_mean_values_from_composition_data, parse_geo_zone_from_fonds_page,
+                      parse_performances_from_fonds_page, parse_srri_rating_from_fonds_page)
+from api.fields import field_plan
+from api.fixtures import FixtureStore, fixture_content
+from api.metrics import CACHE_COALESCED, percentile
+from api.mock_server import MockServerConfig, start_mock_server
+from api.pipeline import Pipeline, PipelineConfig, enumerated
+from api.scheduler import Scheduler, SchedulerConfig
+from api.session import Session, SessionConfig
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+# Synthetic composition categories, per typeCompo
+SYNTHETIC_CATEGORIES = {
+    "1": ["Act. Europe", "Act. Amérique du Nord", "Act. Asie", "Act. Pays Emergents", "Act. Japon"],
+    "2": ["Technologie", "Santé", "Finance", "Industrie", "Energie", "Consommation", "Immobilier", "Services"],
+    "3": ["Large Cap", "Mid Cap", "Small Cap"],
+    "6": ["Growth", "Value", "Blend"],
+}
+SYNTHETIC_MONTHS = 12
+SYNTHETIC_FILLER_ROWS = 400  # Table rows around the useful fields, for a realistic page size
+
+# Distinct funds of a portfolio built on recorded fixtures : ISIN prefix and first product ID of the aliases
+ALIAS_PREFIX = "ZZ"
+ALIAS_PRODUCT_ID = 100_000_000
+
+
+def synthetic_product_id(isin: str) -> int:
+    return zlib.crc32(isin.encode()) % 1_000_000
+
+
+def synthetic_isins(count: int) -> List[str]:
+    return [f"LU{i:010d}" for i in range(count)]
+
+
+def synthetic_fonds_page(product_id: int) -> str:
+    rng = random.Random(product_id)
+    filler = "".join(f"<tr><td>Indicateur {i}</td><td>{rng.uniform(-20, 20):.2f}</td></tr>"
+                     for i in range(SYNTHETIC_FILLER_ROWS))
+    perfs = "".join(f"<tr><td> {perf}</td><td>{rng.uniform(-20, 20):.1f} %</td></tr>"
+                    for perf in ["Perf. 1er janvier", "Perf. 1 an", "Perf. 3 ans", "Perf. 5 ans"])
+    srri = rng.randint(1, 7)
+    srri_scale = "".join(f'<div class="indic-srri{" indic-srri-selected" if i == srri else ""}">{i}</div>'
+                         for i in range(1, 8))
+
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8"><title>Fonds {product_id}</title></head><body>
+<div class="srri">{srri_scale}</div>
+<dl><dt>Société de gestion </dt><dd><a href="#">Gestion {product_id}</a></dd>
+<dt>Catégorie Quantalys </dt><dd><a href="#">Actions {rng.choice(["Europe", "Monde", "Etats-Unis", "Asie"])}</a></dd></dl>
+<table>{filler}</table><table>{perfs}</table><table>{filler}</table></body></html>"""
+
+
+def synthetic_composition(product_id: int, type_compo: str) -> Dict:
+    rng = random.Random(product_id * 10 + int(type_compo))
+    categories = SYNTHETIC_CATEGORIES[type_compo]
+
+    data_provider = []
+    for month in range(1, SYNTHETIC_MONTHS + 1):
+        weights = [rng.random() for _ in categories]
+        total = sum(weights)
+        data_provider.append({"x": f"2024-{month:02d}"} | {
+            category: 100 * weight / total for category, weight in zip(categories, weights)})
+
+    return {"graph": {"dataProvider": data_provider}}
+
+
+def synthetic_response(method: str, path: str, form: Dict[str, str]) -> Tuple[int, str, bytes] | None:
+    """Mock server fallback : generate a plausible response for any ISIN or product ID"""
+
+    if path == "/Recherche/Data":
+        isin = form.get("sNomOrISIN", "")
+        rng = random.Random(isin)
+        row = {
+            "ID_Produit": synthetic_product_id(isin), "sCodeISIN": isin, "sNom": f"Fonds {isin}",
+            "nStarRating": rng.randint(1, 5), "nSharpe3a": round(rng.uniform(-1, 2), 2),
+            "sGroupeCat_rng1": "Actions", "sGroupeCat_Specific_Dynamic": "Actions Europe",
+            "dtRet": "2024-12-31", "dtRetMonth": "2024-12-31",
+        }
+        # Like the real server, only the requested columns are returned
+        columns = [column for name, column in form.items() if name.startswith("columns[")]
+        row = {column: row.get(column, round(rng.uniform(-20, 20), 2)) for column in columns}
+        return 200, "application/json; charset=utf-8", json.dumps({"data": [row], "recordsFiltered": 1}).encode()
+
+    if path == "/Recherche/Produits":
+        isin = form.get("sSearch", "")
+        body = [{"sCodeISIN": isin, "sNom": f"Fonds {isin}", "ID_Produit": synthetic_product_id(isin)}]
+        return 200, "application/json; charset=utf-8", json.dumps(body).encode()
+
+    if path == "/Fonds/GetCompoTableAndGraph":
+        body = synthetic_composition(int(form["ID_Produit"]), form["typeCompo"])
+        return 200, "application/json; charset=utf-8", json.dumps(body).encode()
+
+    if path.startswith("/Fonds/"):
+        return 200, "text/html; charset=utf-8", synthetic_fonds_page(int(path.rsplit("/", 1)[1])).encode()
+
+    return None
+
+
+def alias_isins(count: int) -> List[str]:
+    """Distinct ISINs, each one replaying a recorded fund (see FixtureAliases)"""
+    return [f"{ALIAS_PREFIX}{i:010d}" for i in range(count)]
+
+
+class FixtureAliases:
+    """Mock server fallback answering the ISINs of alias_isins with the fixtures of the recorded funds, in turn.
+    Every alias has a product ID of its own, so that the share classes memo does not merge them either"""
+
+    def __init__(self, store: FixtureStore):
+        self.store = store
+        self.product_ids: Dict[str, int] = {}  # Recorded ISIN -> recorded product ID
+
+        for fixture in store:
+            if fixture["endpoint"] == "search" and fixture["status_code"] == 200:
+                data = json.loads(fixture_content(fixture))["data"]
+                if len(data) > 0:
+                    self.product_ids[fixture["data"]["sNomOrISIN"]] = int(data[0]["ID_Produit"])
+        self.isins = sorted(self.product_ids)
+
+    def recorded(self, alias: int) -> Tuple[str, int]:
+        isin = self.isins[alias % len(self.isins)]
+        return isin, self.product_ids[isin]
+
+    def replay(self, method: str, path: str, form: Dict[str, str] | None) -> Tuple[int, str, bytes] | None:
+        fixture = self.store.get(request_key(method, path, form))
+        if fixture is None:
+            return None
+        return fixture["status_code"], fixture["headers"].get("content-type", ""), fixture_content(fixture)
+
+    def __call__(self, method: str, path: str, form: Dict[str, str]) -> Tuple[int, str, bytes] | None:
+        if path == "/Recherche/Data" and form.get("sNomOrISIN", "").startswith(ALIAS_PREFIX):
+            alias = int(form["sNomOrISIN"][len(ALIAS_PREFIX):])
+            isin, _ = self.recorded(alias)
+            recorded_form = {name: isin if value == form["sNomOrISIN"] else value for name, value in form.items()}
+            if (response := self.replay(method, path, recorded_form)) is None:
+                return None
+            status, content_type, body = response
+            search = json.loads(body)
+            for row in search["data"]:
+                row |= {"sCodeISIN": form["sNomOrISIN"], "ID_Produit": ALIAS_PRODUCT_ID + alias}
+            return status, content_type, json.dumps(search).encode()
+
+        if path == "/Fonds/GetCompoTableAndGraph" and int(form.get("ID_Produit", 0)) >= ALIAS_PRODUCT_ID:
+            _, product_id = self.recorded(int(form["ID_Produit"]) - ALIAS_PRODUCT_ID)
+            return self.replay(method, path, form | {"ID_Produit": str(product_id)})
+
+        if path.startswith("/Fonds/") and (product_id := path.rsplit("/", 1)[1]).isdigit() \
+                and int(product_id) >= ALIAS_PRODUCT_ID:
+            _, recorded_product_id = self.recorded(int(product_id) - ALIAS_PRODUCT_ID)
+            return self.replay(method, f"/Fonds/{recorded_product_id}", None)
+
+        return None
+
+
+def serve(fixtures: str | None, config: MockServerConfig, address: "multiprocessing.Queue") -> None:
+    """Mock server process : the server does not compete with the scraper for the GIL"""
+    store = FixtureStore(fixtures) if fixtures is not None else None
+    fallback = FixtureAliases(store) if store is not None else synthetic_response
+    server = start_mock_server(store, config, fallback=fallback)
+    address.put(server.base_url)
+    threading.Event().wait()
+
+
+def start_server_process(fixtures: str | None, config: MockServerConfig) -> Tuple[multiprocessing.Process, str]:
+    address = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(fixtures, config, address), daemon=True)
+    process.start()
+    return process, address.get()
+
+
+async def run_end_to_end(base_url: str, isins: List[str], concurrency: int) -> Dict:
+    """Scrape every ISIN through the mock server with the pipeline of main.py, measuring the per-fund latency.
+    The fetching stages get as many workers as requests in flight, so that the scheduler is the limit"""
+
+    rows = []
+    pipeline_config = PipelineConfig(resolve_workers=concurrency, page_workers=concurrency,
+                                     composition_workers=concurrency)
+    scheduler = Scheduler(SchedulerConfig(max_in_flight=concurrency, requests_per_second=1e6, burst=concurrency))
+    session_config = SessionConfig(base_url=base_url, max_connections=concurrency,
+                                   max_keepalive_connections=concurrency)
+
+    start = perf_counter()
+    async with Session(session_config, scheduler) as session:
+        await Pipeline(session, field_plan(), lambda position, row: rows.append(row), pipeline_config).run(
+            enumerated(isins))
+    duration = perf_counter() - start
+    # From the intake of a fund to its row
+    latencies = session.metrics.stages["fund"].durations
+    # Every fund is searched once : fewer searches means some were served from the run memo instead
+    search = session.metrics.endpoints.get("search")
+    searches = search.requests - search.cache[CACHE_COALESCED] if search is not None else 0
+
+    return {
+        "isins": len(isins),
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "isins_per_s": len(isins) / duration,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "requests_per_fund": session.stats.requests / len(isins),
+        "searches_per_fund": searches / len(isins),
+        "connections_opened": session.stats.connections_opened,
+        "retries": scheduler.stats.retries,
+        "hedged": session.hedger.stats.hedged,
+        "failed_funds": sum(len(row) == 1 for row in rows),
+    }
+
+
+def time_function(function: Callable, arguments: List, repeat: int) -> float:
+    """Mean CPU time of a call, in microseconds"""
+    start = perf_counter()
+    for _ in range(repeat):
+        for argument in arguments:
+            function(argument)
+    return (perf_counter() - start) / (repeat * len(arguments)) * 1e6
+
+
+def parse_benchmark(pages: List[str], compositions: List[List[Dict]], repeat: int) -> Dict[str, float]:
+    """CPU cost of the parsing functions, in microseconds per call"""
+    parsed_pages = [FondsPage(page) for page in pages]
+
+    return {
+        "FondsPage_us": time_function(FondsPage, pages, repeat),
+        "parse_srri_rating_from_fonds_page_us": time_function(parse_srri_rating_from_fonds_page, parsed_pages, repeat),
+        "parse_geo_zone_from_fonds_page_us": time_function(parse_geo_zone_from_fonds_page, parsed_pages, repeat),
+        "parse_performances_from_fonds_page_us": time_function(parse_performances_from_fonds_page, parsed_pages,
+                                                               repeat),
+        "compute_mean_values_from_composition_data_us": time_function(compute_mean_values_from_composition_data,
+                                                                      compositions, repeat),
+    }
+
+
+def parse_inputs(store: FixtureStore | None, count: int = 20) -> Tuple[List[str], List[List[Dict]]]:
+    """Fund pages and composition data to time the parsers on : recorded if available, else synthetic"""
+    pages, compositions = [], []
+
+    if store is not None:
+        for fixture in store:
+            if fixture["endpoint"] == "page":
+                pages.append(fixture_content(fixture).decode("utf-8", errors="replace"))
+            elif fixture["endpoint"] == "composition":
+                compositions.append(json.loads(fixture_content(fixture))["graph"]["dataProvider"])
+
+    if len(pages) == 0:
+        pages = [synthetic_fonds_page(product_id) for product_id in range(count)]
+    if len(compositions) == 0:
+        compositions = [synthetic_composition(product_id, type_compo)["graph"]["dataProvider"]
+                        for product_id in range(count) for type_compo in SYNTHETIC_CATEGORIES]
+
+    return pages[:count], compositions[:4 * count]
+
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def time_to_prompt() -> float:
+    """Seconds from launching main.py to its interactive prompt"""
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               env=os.environ | {"PYTHONUNBUFFERED": "1"}, text=True)
+    while "Please enter" not in process.stdout.readline():
+        pass
+    elapsed = perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+
+def time_to_first_result(base_url: str, isin: str, directory: str) -> float:
+    """Seconds from launching main.py on stdin to the first result in its journal"""
+    output = os.path.join(directory, "startup.csv")
+    journal = os.path.join(directory, "startup.jsonl")
+    if os.path.exists(journal):
+        os.remove(journal)
+
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN_SCRIPT, "--input", "-", "--output", output, "--no-cache",
+                                "--base-url", base_url], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    process.stdin.write(isin + "\n")
+    process.stdin.flush()
+    while not os.path.exists(journal) or os.path.getsize(journal) == 0:
+        time.sleep(0.001)
+    elapsed = perf_counter() - start
+
+    process.stdin.close()
+    process.wait()
+    return elapsed
+
+
+def startup_benchmark(base_url: str, isin: str, repeat: int) -> Dict[str, float]:
+    """Median startup times of main.py over several launches"""
+    with tempfile.TemporaryDirectory() as directory:
+        prompts = [time_to_prompt() for _ in range(repeat)]
+        results = [time_to_first_result(base_url, isin, directory) for _ in range(repeat)]
+
+    return {"first_prompt_s": statistics.median(prompts), "first_result_s": statistics.median(results)}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against the local mock server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="portfolio sizes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 16, 32, 64],
+                        help="maximum requests in flight")
+    parser.add_argument("--fixtures", help="replay recorded fixtures (their funds are cycled under distinct ISINs "
+                                           "to reach each size)")
+    parser.add_argument("--latency", type=float, default=20, help="mock server latency, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=5, help="mock server jitter, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="mock server 503 probability")
+    parser.add_argument("--stall-rate", type=float, default=0, help="mock server stalled response probability")
+    parser.add_argument("--stall", type=float, default=5000, help="stalled response delay, in milliseconds")
+    parser.add_argument("--parse-repeat", type=int, default=5, help="repetitions of the parsing benchmark")
+    parser.add_argument("--startup-repeat", type=int, default=5, help="launches of main.py to time (0 : skip)")
+    parser.add_argument("--output", "-o", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    store = FixtureStore(args.fixtures) if args.fixtures is not None else None
+    server_config = MockServerConfig(args.latency / 1000, args.jitter / 1000, args.error_rate, seed=0,
+                                     stall_rate=args.stall_rate, stall=args.stall / 1000)
+    server, base_url = start_server_process(args.fixtures, server_config)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "server": {"latency_ms": args.latency, "jitter_ms": args.jitter, "error_rate": args.error_rate,
+                   "stall_rate": args.stall_rate, "stall_ms": args.stall, "fixtures": args.fixtures},
+        "parse": parse_benchmark(*parse_inputs(store), args.parse_repeat),
+        "end_to_end": [],
+    }
+
+    print("Parsing (µs per call)")
+    for name, value in results["parse"].items():
+        print(f"  {name[:-3]:<45} {value:>10.1f}")
+
+    isins = FixtureAliases(store).isins if store is not None else []
+
+    if args.startup_repeat > 0:
+        results["startup"] = startup_benchmark(base_url, (isins or synthetic_isins(1))[0], args.startup_repeat)
+        print(f"\nStartup of main.py : prompt after {results['startup']['first_prompt_s']:.2f} s, "
+              f"first result after {results['startup']['first_result_s']:.2f} s")
+
+    print(f"\n{'ISINs':>7} {'conc.':>6} {'ISINs/s':>9} {'p50 (s)':>9} {'p95 (s)':>9} {'p99 (s)':>9} {'req/fund':>9}")
+
+    for size in args.sizes:
+        portfolio = alias_isins(size) if len(isins) > 0 else synthetic_isins(size)
+
+        for concurrency in args.concurrency:
+            result = await run_end_to_end(base_url, portfolio, concurrency)
+            if result["searches_per_fund"] < 0.99:
+                raise RuntimeError(f"Only {result['searches_per_fund']:.2f} searches per fund : "
+                                   "the benchmark measures the run memo, not the fetching")
+            results["end_to_end"].append(result)
+            print(f"{size:>7} {concurrency:>6} {result['isins_per_s']:>9.1f} {result['latency_p50_s']:>9.2f} "
+                  f"{result['latency_p95_s']:>9.2f} {result['latency_p99_s']:>9.2f} {result['requests_per_fund']:>9.2f}")
+
+    server.terminate()
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,9 +1,31 @@
-from api.data import agregate_from_isin, display_progress_bar
+from time import perf_counter
+
+STARTED_AT = perf_counter()  # Start of the process, for the time to first prompt and to first result
+
+# Only the light modules are imported at startup. The fetching ones (httpx, lxml, beautifulsoup, numpy)
+# are imported by run(), in the background while the user types the ISINs
+from api.cache import DATA_DIRECTORY
+from api.deadlines import FUND_DEADLINE
+from api.fields import FIELD_NAMES, field_plan
+from api.history import HISTORY_PATH, History
+from api.journal import Journal, completed_entries, materialize
+from api.snapshots import SNAPSHOTS_PATH, SnapshotStore
+from api.writers import check_output, is_typed_output, open_writer
+import argparse
 import asyncio
-import pandas as pd
 import datetime
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import zlib
 from time import time
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+# Imported by run(), preloaded during the prompt
+FETCH_MODULES = ["api.data", "api.exposures", "api.fixtures", "api.index", "api.metrics", "api.pipeline",
+                 "api.scheduler", "api.session", "concurrent.futures"]
 
 TEST = False
 TEST_ISINS = [
@@ -159,6 +181,40 @@ def parse_isins() -> List[str]:
     return isins
 
 
+async def stream_isins(path: str) -> AsyncIterator[str]:
+    """Read ISINs line by line from a file, or from stdin if path is "-".
+    ISINs are yielded as soon as they are read, blank lines are skipped"""
+
+    file = sys.stdin if path == "-" else open(path, encoding="utf-8")
+
+    try:
+        # Reading in a thread lets the funds already read progress while waiting for input
+        while (line := await asyncio.to_thread(file.readline)) != "":
+            if (isin := line.strip()) != "":
+                yield isin
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a "i/n" shard specification, 0 <= i < n"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected i/n")
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected 0 <= i < n")
+
+    return index, count
+
+
+def in_shard(isin: str, shard: Tuple[int, int] | None) -> bool:
+    """Deterministic ISIN -> shard assignment, identical on every machine"""
+    return shard is None or zlib.crc32(isin.encode()) % shard[1] == shard[0]
+
+
 def create_unique_filename() -> str:
     """Create a unique filename using the current date and time"""
     now = datetime.datetime.now()
@@ -167,44 +223,284 @@ def create_unique_filename() -> str:
     return now.strftime("%d-%m-%Y_%H-%M-%S.csv")
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Fetch Quantalys data for a list of ISINs. Without --input, ISINs are asked interactively")
+    parser.add_argument("--input", "-i", metavar="FILE",
+                        help='read newline separated ISINs from FILE ("-" for stdin), without any prompt')
+    parser.add_argument("--output", "-o", metavar="FILE",
+                        help="result file (.csv, .xlsx, or typed : .parquet, .arrow, .sqlite), "
+                             "the journal is written next to it (default : date and time)")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/n",
+                        help="only process the ISINs of shard i out of n (0 <= i < n), to split a list between machines")
+    parser.add_argument("--resume", metavar="JOURNAL",
+                        help="resume an interrupted run from its .jsonl journal, skipping the funds already done")
+    parser.add_argument("--merge", nargs="+", metavar="JOURNAL",
+                        help="merge the journals of several shards into --output, without fetching anything")
+    parser.add_argument("--columns", nargs="+", metavar="COLUMN",
+                        help="only output these columns, and only fetch what they need (default : all of them). "
+                             f"Columns : {', '.join(FIELD_NAMES)}")
+    parser.add_argument("--search-columns", nargs="+", default=[], metavar="COLUMN",
+                        help="extra columns of the Quantalys search to add to the output, e.g. nVolat3a nFraisGestion")
+    # "" : api.exposures needs numpy, its default directory is only resolved by run()
+    parser.add_argument("--exposures", nargs="?", const="", metavar="DIRECTORY",
+                        help="keep the raw composition exposures of every fund in a columnar store "
+                             f"(default directory : {os.path.join(DATA_DIRECTORY, 'exposures')}), "
+                             "see python -m api.exposures")
+    parser.add_argument("--refresh", nargs="?", const=SNAPSHOTS_PATH, metavar="SNAPSHOTS",
+                        help="only fetch the fund pages and compositions that changed since the previous refresh, "
+                             f"and carry forward the other values (default snapshots : {SNAPSHOTS_PATH})")
+    parser.add_argument("--history", nargs="?", const=HISTORY_PATH, metavar="HISTORY",
+                        help="also record the values that changed since the previous run in a history "
+                             f"(default : {HISTORY_PATH}), see python -m api.history")
+    parser.add_argument("--deadline", type=float, default=FUND_DEADLINE, metavar="SECONDS",
+                        help="time budget of a fund, after which its row only has the fields collected so far "
+                             "(default : %(default)s, 0 : no deadline). The wait behind the other funds does not count")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="dump the run metrics per endpoint and per stage (.prom : Prometheus textfile, else JSON)")
+
+    # The defaults are the ones of SessionConfig and SchedulerConfig, which are not imported before run()
+    network = parser.add_argument_group("network")
+    network.add_argument("--max-connections", type=int)
+    network.add_argument("--http2", action="store_true", help='use HTTP/2 (requires the "h2" package)')
+    network.add_argument("--max-in-flight", type=int, help="maximum number of simultaneous requests")
+    network.add_argument("--rps", type=float, help="maximum number of requests per second")
+    network.add_argument("--timeout", type=float, metavar="SECONDS",
+                         help="timeout of a request between two bytes of the response (retried when exceeded)")
+    network.add_argument("--connect-timeout", type=float, metavar="SECONDS")
+    network.add_argument("--no-hedge", action="store_true",
+                         help="do not send a duplicate of the requests slower than the usual latency of their endpoint")
+    network.add_argument("--no-cache", action="store_true", help="do not use the on-disk response cache")
+    network.add_argument("--base-url",
+                         help="Quantalys server, e.g. a local mock server (python -m api.mock_server)")
+    network.add_argument("--record", metavar="DIRECTORY",
+                         help="save every response as a fixture, to be replayed by the mock server")
+
+    # The defaults are the ones of PipelineConfig
+    pipeline = parser.add_argument_group("pipeline", "workers of every stage, see api/pipeline.py")
+    pipeline.add_argument("--resolve-workers", type=int, help="funds being searched at the same time")
+    pipeline.add_argument("--page-workers", type=int, help="fund pages being downloaded at the same time")
+    pipeline.add_argument("--composition-workers", type=int,
+                          help="funds whose composition tables are being downloaded at the same time")
+    pipeline.add_argument("--parse-workers", type=int, default=os.cpu_count(),
+                          help="processes parsing the fund pages "
+                               "(0 : parse in the main process, default : one per core)")
+    pipeline.add_argument("--queue-size", type=int,
+                          help="funds waiting in front of a stage at most, a full queue slows down the stage before it")
+
+    args = parser.parse_args()
+
+    # Only the endpoints and search columns of the output are requested : check them before fetching anything
+    try:
+        args.plan = field_plan(args.columns, args.search_columns)
+        if args.output is not None:
+            check_output(args.output)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Else httpx only fails on the first request, once the ISINs were typed
+    if args.http2 and importlib.util.find_spec("h2") is None:
+        parser.error('--http2 requires the "h2" package (pip install httpx[http2])')
+
+    return args
+
+
+def preload_fetch_modules() -> None:
+    """Import the fetching modules in a background thread : run() then finds them already loaded"""
+    threading.Thread(target=lambda: [importlib.import_module(name) for name in FETCH_MODULES], daemon=True).start()
+
+
+def configured(config_class: type, **options: Any) -> Any:
+    """Config with the options given on the command line, the others keep their defaults"""
+    return config_class(**{name: value for name, value in options.items() if value is not None})
+
+
+async def run(isins: AsyncIterator[str], total: int | None, args: argparse.Namespace,
+              filename: str, journal_path: str, started_at: float = STARTED_AT,
+              first_prompt: float | None = None) -> None:
+    """Fetch every ISIN of the stream, writing the results to the journal, then to the output file.
+    started_at : perf_counter() when the ISINs were available, for the time to first result.
+    first_prompt : seconds from the start of the process to the interactive prompt"""
+
+    start = time()
+
+    from api.cache import CacheConfig, ResponseCache
+    from api.data import RunMemo, display_progress_bar, parse_executor
+    from api.exposures import EXPOSURES_DIRECTORY, ExposureStore
+    from api.fixtures import FixtureStore
+    from api.hedging import HedgeConfig, Hedger
+    from api.index import ProductIndex
+    from api.metrics import Metrics
+    from api.pipeline import Pipeline, PipelineConfig
+    from api.scheduler import Scheduler, SchedulerConfig
+    from api.session import Session, SessionConfig
+
+    # Startup costs : imports before the first request, and time to the first completed fund
+    metrics = Metrics()
+    metrics.record_stage("startup", perf_counter() - started_at)
+    if first_prompt is not None:
+        metrics.record_stage("first_prompt", first_prompt)
+
+    # Skip the funds that were already done by the interrupted run
+    done = completed_entries(journal_path) if args.resume is not None else set()
+    if len(done) > 0:
+        print(f"Resuming {journal_path} : {len(done)} funds already done")
+        if total is not None:
+            total -= len(done)
+
+    queue = asyncio.Queue()  # Wait for coroutine end messages, to display a progress bar
+    progress_bar = asyncio.create_task(display_progress_bar(queue, total))
+
+    # A single pooled session is shared by all the coroutines, so connections get reused.
+    # Its scheduler bounds the requests in flight, whatever the number of coroutines.
+    # Responses are cached on disk, so a re-run over the same funds barely hits the network
+    cache = None if args.no_cache else ResponseCache(CacheConfig())
+    session_config = configured(SessionConfig, max_connections=args.max_connections, http2=args.http2,
+                                base_url=args.base_url, timeout=args.timeout, connect_timeout=args.connect_timeout)
+    # Requests slower than usual get a duplicate, so a stalled connection does not hold a fund back
+    hedger = Hedger(HedgeConfig(enabled=not args.no_hedge))
+    deadline = args.deadline if args.deadline > 0 else None
+    scheduler_config = configured(SchedulerConfig, max_in_flight=args.max_in_flight, requests_per_second=args.rps)
+    # ISIN -> product ID mapping kept between runs, so the fund details can be fetched without waiting for the search
+    index = ProductIndex()
+    # Results are written as soon as each fund completes, instead of being kept in memory
+    journal = Journal(journal_path, resume=args.resume is not None)
+    # Typed outputs are written in batches as the funds complete. A resumed run rewrites them from the journal
+    streamed = is_typed_output(filename) and args.resume is None
+    writer = open_writer(filename, args.plan.kinds()) if streamed else None
+    # Fund pages are parsed on every core, the event loop only handles the network
+    executor = parse_executor(args.parse_workers) if args.parse_workers > 0 else None
+    # Raw exposures of the composition tables, for other aggregations later on
+    store = ExposureStore(args.exposures or EXPOSURES_DIRECTORY) if args.exposures is not None else None
+    # Repeated ISINs and share classes of the same fund are only fetched and parsed once
+    memo = RunMemo(store=store)
+    # State of every fund after the previous refresh : unchanged funds are not fetched again
+    snapshots = SnapshotStore(args.refresh) if args.refresh is not None else None
+    # Only the values that changed since the previous run are added to the history
+    history = History(args.history) if args.history is not None else None
+    if history is not None:
+        history.start_run(filename)
+
+    # Every stage has its own workers, and bounded queues between them keep the funds in progress
+    # (and the memory) flat, so that a long input does not create millions of coroutines
+    pipeline_config = configured(PipelineConfig, resolve_workers=args.resolve_workers, page_workers=args.page_workers,
+                                 composition_workers=args.composition_workers, parse_workers=max(1, args.parse_workers),
+                                 queue_size=args.queue_size)
+
+    def write_row(position: int, row: Dict) -> None:
+        """Write the row of a fund to the journal (and to the typed output) as soon as it is complete"""
+        if "first_result" not in metrics.stages:
+            metrics.record_stage("first_result", perf_counter() - started_at)
+        if history is not None:
+            history.record(row)
+        journal.append(position, row)
+        if writer is not None:
+            writer.write(position, row)
+
+    async def positions() -> AsyncIterator[Tuple[int, str]]:
+        """ISINs of the shard not done yet, with their position in the input"""
+        position = -1
+        async for isin in isins:
+            position += 1
+            if in_shard(isin, args.shard) and (position, isin) not in done:
+                yield position, isin
+
+    recorder = FixtureStore(args.record) if args.record is not None else None
+    async with Session(session_config, Scheduler(scheduler_config), cache, recorder, metrics, hedger) as session:
+        # Work starts as soon as the first ISINs are read
+        await Pipeline(session, args.plan, write_row, pipeline_config, index, executor, memo, snapshots, deadline,
+                       queue).run(positions())
+
+    journal.close()
+    index.close()
+    if store is not None:
+        store.close()
+    if snapshots is not None:
+        snapshots.close()
+    if history is not None:
+        history.close()
+    if executor is not None:
+        executor.shutdown()
+
+    await queue.put(None)  # End the progress bar if the total was unknown
+    await progress_bar
+
+    if writer is not None:
+        writer.close()
+    else:
+        materialize([journal_path], filename)
+
+    end = time() - start
+    print(f"\nTime to run : {end:.2f} seconds")
+    print(f"Connections : {session.stats}")
+    print(f"Scheduler : {session.scheduler.stats}")
+    print(f"Hedging : {session.hedger.stats}")
+    if cache is not None:
+        print(f"Cache : {cache.stats}")
+    if snapshots is not None:
+        print(f"Refresh : {snapshots.stats}")
+    if history is not None:
+        print(f"History : {history.changed} values changed in {history.recorded} funds")
+    print(f"\n{session.metrics.summary()}\n")
+    if args.metrics is not None:
+        session.metrics.write(args.metrics)
+        print(f"Metrics saved to {args.metrics}")
+    print(f"Results saved to {filename} (journal : {journal_path})")
+
+
+async def iterate(isins: List[str]) -> AsyncIterator[str]:
+    for isin in isins:
+        yield isin
+
+
 async def main():
+    args = parse_args()
+
+    # Use unique filename per run with the current date and time
+    if args.output is not None:
+        filename = args.output
+    elif args.resume is not None:
+        filename = os.path.splitext(args.resume)[0] + ".csv"
+    else:
+        filename = create_unique_filename()
+
+    if args.merge is not None:
+        count = materialize(args.merge, filename)
+        print(f"{count} results merged into {filename}")
+        return
+
+    if args.input is not None:
+        # Non-interactive : stream the ISINs, no prompt
+        journal_path = args.resume or os.path.splitext(filename)[0] + ".jsonl"
+        await run(stream_isins(args.input), None, args, filename, journal_path)
+        return
 
     print("Please enter newline separated ISIN numbers")
     print('Enter "test" to use a predefined test list of ISINs, enter nothing to quit the program')
     print("(You may copy/paste a column directly from excel)")
+    first_prompt = perf_counter() - STARTED_AT
 
+    # The user takes seconds to paste the ISINs : enough to import everything else
+    preload_fetch_modules()
     isins = parse_isins()
+    started_at = perf_counter()
 
     if len(isins) == 0:
         print("Nothing was done")
         return
 
-    start = time()
-
-    coroutine_list = []
-    queue = asyncio.Queue()  # Wait for coroutine end messages, to display a progress bar
+    if TEST and args.output is None and args.resume is None:
+        filename = "test.csv"
+    journal_path = args.resume or os.path.splitext(filename)[0] + ".jsonl"
 
     print("Creating and launching coroutines (this may take a few seconds)...\n")
-    for isin in isins:
-        coroutine_list.append(asyncio.create_task(
-            agregate_from_isin(queue, isin)))
-
-    coroutine_list.append(asyncio.create_task(
-        display_progress_bar(queue, len(coroutine_list))))
-    # Exclude the progress bar
-    results = (await asyncio.gather(*coroutine_list))[:-1]
-
-    df = pd.DataFrame.from_records(results)
+    total = sum(in_shard(isin, args.shard) for isin in isins)
+    await run(iterate(isins), total, args, filename, journal_path, started_at, first_prompt)
 
-    # Use unique filename per run with the current date and time
-    filename = "test.csv" if TEST else create_unique_filename()
-    df.to_csv(filename)
-
-    end = time() - start
-    print(f"\nTime to run : {end:.2f} seconds")
-    print(f"Results saved to {filename}")
     input("Press any key to exit\n")
 
 
 if __name__ == "__main__":
+    # Needed by the process pool in the PyInstaller executable
+    multiprocessing.freeze_support()
     asyncio.run(main())
@@ -0,0 +1,9 @@
+import pytest
+from quantalys_mock import Quantalys
+
+
+@pytest.fixture
+def quantalys():
+    mock = Quantalys()
+    yield mock
+    mock.close()
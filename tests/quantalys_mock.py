@@ -0,0 +1,84 @@
+"""
+Synthetic Quantalys for the end to end tests : the mock server with generated funds, and runs of main.py against it
+"""
+import asyncio
+import csv
+import json
+import os
+import subprocess
+import sys
+from api.fields import field_plan
+from api.mock_server import start_mock_server
+from api.pipeline import Pipeline
+from api.session import Session, SessionConfig
+from benchmark import synthetic_response
+from collections import Counter
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+class Quantalys:
+    """Mock server answering with synthetic funds, counting the requests per endpoint.
+    search_columns overrides search columns of some ISINs : the product ID of share classes of the same fund,
+    the freshness dates of a fund that changed..."""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.search_columns = {}  # ISIN -> {column: value}
+        self.failures = Counter()  # ISIN -> searches still to fail
+        self.server = start_mock_server(None, fallback=self.respond)
+
+    def respond(self, method, path, form):
+        if path == "/Recherche/Data":
+            isin = form.get("sNomOrISIN", "")
+            self.requests["search"] += 1
+            if self.failures[isin] > 0:
+                self.failures[isin] -= 1
+                return 400, "text/plain", b"Bad request"
+            if isin in self.search_columns:
+                status, content_type, body = synthetic_response(method, path, form)
+                data = json.loads(body)
+                row = data["data"][0]
+                row |= {column: value for column, value in self.search_columns[isin].items() if column in row}
+                return status, content_type, json.dumps(data).encode()
+        elif path == "/Fonds/GetCompoTableAndGraph":
+            self.requests["composition"] += 1
+        elif path.startswith("/Fonds/"):
+            self.requests["page"] += 1
+        return synthetic_response(method, path, form)
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+
+def run_main(tmp_path, quantalys: Quantalys, *args: str, stdin: str | None = None) -> str:
+    """Run main.py, with its data directory in tmp_path. Returns its output"""
+    command = [sys.executable, MAIN, "--base-url", quantalys.server.base_url, "--no-cache", "--parse-workers", "0",
+               "--rps", "1000", *args]
+    process = subprocess.run(command, cwd=tmp_path, env=dict(os.environ, HOME=str(tmp_path)), input=stdin,
+                             capture_output=True, text=True, timeout=120)
+    assert process.returncode == 0, process.stderr
+    return process.stdout
+
+
+def write_isins(tmp_path, isins) -> str:
+    path = tmp_path / "isins.txt"
+    path.write_text("\n".join(isins) + "\n")
+    return str(path)
+
+
+def read_csv(path) -> list:
+    with open(path, encoding="utf-8", newline="") as file:
+        return list(csv.DictReader(file))
+
+
+def fetch_rows(quantalys: Quantalys, isins) -> dict:
+    """Rows of the pipeline for a stream of (position, ISIN), by position"""
+    rows = {}
+
+    async def scenario():
+        async with Session(SessionConfig(base_url=quantalys.server.base_url)) as session:
+            await Pipeline(session, field_plan(), rows.__setitem__).run(isins)
+
+    asyncio.run(scenario())
+    return rows
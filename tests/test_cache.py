@@ -0,0 +1,33 @@
+from api.cache import CacheConfig, ResponseCache
+from httpx import Response
+
+
+def test_hits_do_not_lock_the_cache(tmp_path):
+    """A hit must not keep a write transaction open : the other processes could not write to the cache"""
+    path = str(tmp_path / "http_cache.sqlite")
+    first = ResponseCache(CacheConfig(path=path))
+    first.put("a", "page", Response(200, content=b"page a"))
+
+    assert first.get("a").content == b"page a"
+
+    other = ResponseCache(CacheConfig(path=path))
+    other.db.execute("PRAGMA busy_timeout = 100")
+    other.put("b", "page", Response(200, content=b"page b"))
+
+    assert first.get("b").content == b"page b"
+    first.close()
+    other.close()
+
+
+def test_hits_are_recently_used(tmp_path):
+    """The access times of the hits are written before evicting"""
+    cache = ResponseCache(CacheConfig(path=str(tmp_path / "http_cache.sqlite"), max_size=20))
+    cache.put("old", "page", Response(200, content=b"0123456789"))
+    cache.put("new", "page", Response(200, content=b"0123456789"))
+    cache.get("old")
+
+    cache.put("newest", "page", Response(200, content=b"0123456789"))
+
+    assert cache.get("old") is not None
+    assert cache.get("new") is None
+    cache.close()
@@ -0,0 +1,46 @@
+import importlib.util
+import main
+import pytest
+import sys
+from benchmark import synthetic_isins
+from quantalys_mock import read_csv, run_main, write_isins
+
+ISINS = synthetic_isins(12)
+
+
+def test_shards_split_the_input():
+    shards = [[isin for isin in ISINS if main.in_shard(isin, (index, 3))] for index in range(3)]
+    assert sorted(sum(shards, [])) == sorted(ISINS)
+    assert all(len(shard) > 0 for shard in shards)
+    assert all(main.in_shard(isin, None) for isin in ISINS)
+
+
+def test_stdin_input(tmp_path, quantalys):
+    run_main(tmp_path, quantalys, "--input", "-", "-o", "out.csv", stdin="\n".join(ISINS[:3]) + "\n\n")
+
+    assert [row["ISIN"] for row in read_csv(tmp_path / "out.csv")] == ISINS[:3]
+
+
+def test_shard_and_merge(tmp_path, quantalys):
+    isins = write_isins(tmp_path, ISINS)
+    run_main(tmp_path, quantalys, "--input", isins, "-o", "full.csv")
+    run_main(tmp_path, quantalys, "--input", isins, "-o", "shard0.csv", "--shard", "0/2")
+    run_main(tmp_path, quantalys, "--input", isins, "-o", "shard1.csv", "--shard", "1/2")
+
+    shards = [read_csv(tmp_path / "shard0.csv"), read_csv(tmp_path / "shard1.csv")]
+    assert len(shards[0]) > 0 and len(shards[1]) > 0
+    assert len(shards[0]) + len(shards[1]) == len(ISINS)
+
+    run_main(tmp_path, quantalys, "--merge", "shard0.jsonl", "shard1.jsonl", "-o", "merged.csv")
+    assert read_csv(tmp_path / "merged.csv") == read_csv(tmp_path / "full.csv")
+
+
+def test_http2_requires_h2(monkeypatch, capsys):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec",
+                        lambda name, *args: None if name == "h2" else find_spec(name, *args))
+    monkeypatch.setattr(sys, "argv", ["main.py", "--http2"])
+
+    with pytest.raises(SystemExit):
+        main.parse_args()
+    assert '"h2" package' in capsys.readouterr().err
@@ -0,0 +1,70 @@
+import pytest
+from api.data import GEO_ACTIVITY_THRESHOLD, compute_mean_values_from_composition_data, parse_composition_tables
+from api.exposures import composition_block
+from benchmark import SYNTHETIC_CATEGORIES, synthetic_composition
+
+
+def per_row_means(data):
+    """The former per row dict loop, kept as the reference of the vectorized means"""
+    percentages = {}
+    for obj in data:
+        for key, value in obj.items():
+            if key != 'x':
+                if key not in percentages:
+                    percentages[key] = value
+                else:
+                    percentages[key] += value
+
+    for key, value in percentages.items():
+        percentages[key] = value / len(data)
+
+    return percentages
+
+
+def per_row_fields(geo_data, *max_tables):
+    """The former formatting of the 4 tables, on the per row means"""
+    fields = [f"{key[5:] if 'Act. ' == key[:5] else key} {value:.0f}%"
+              for key, value in per_row_means(geo_data).items() if value >= GEO_ACTIVITY_THRESHOLD]
+    for data in max_tables:
+        if len(means := per_row_means(data)) > 0:
+            fields.append(max(means, key=means.get))
+    return ", ".join(fields)
+
+
+EDGE_TABLES = [
+    [],  # No data for this fund
+    [{"x": "2024-01"}],  # A date without any category
+    [{"x": "2024-01", "Europe": 40}, {"x": "2024-02", "Europe": 20, "Asie": 80}],  # Category missing at a date
+    [{"Large Cap": 50.0, "Small Cap": 50.0}, {"x": "2024-02", "Small Cap": 50.0, "Large Cap": 50.0}],  # No "x", ties
+    [{"x": "2024-01", "Act. Monde": 25.0}, {"x": "2024-02"}, {"x": "2024-03", "Act. Monde": 75.0}],  # Empty row
+    [{"x": "2024-01", "Growth": -5.5, "Value": 105.5}],  # Single row, values out of [0, 100]
+]
+
+
+@pytest.mark.parametrize("data", EDGE_TABLES + [
+    synthetic_composition(product_id, type_compo)["graph"]["dataProvider"]
+    for product_id in range(1, 11) for type_compo in SYNTHETIC_CATEGORIES])
+def test_means_match_the_per_row_loop(data):
+    means = compute_mean_values_from_composition_data(data)
+    assert list(means) == list(per_row_means(data))
+    assert means == pytest.approx(per_row_means(data))
+
+
+@pytest.mark.parametrize("tables", [
+    [synthetic_composition(product_id, type_compo)["graph"]["dataProvider"] for type_compo in SYNTHETIC_CATEGORIES]
+    for product_id in range(1, 21)] + [
+    [EDGE_TABLES[2], EDGE_TABLES[0], EDGE_TABLES[3], EDGE_TABLES[5]],
+    [EDGE_TABLES[4], EDGE_TABLES[1], EDGE_TABLES[0], EDGE_TABLES[1]],
+    [EDGE_TABLES[0]] * 4,
+])
+def test_fields_match_the_per_row_loop(tables):
+    assert parse_composition_tables(*map(composition_block, tables)) == per_row_fields(*tables)
+
+
+def test_non_numeric_values_are_rejected():
+    """The per row loop failed on them too : the fund is then reported as failed"""
+    data = [{"x": "2024-01", "Europe": "12,5"}, {"x": "2024-02", "Europe": "3"}]
+    with pytest.raises((TypeError, ValueError)):
+        per_row_means(data)
+    with pytest.raises((TypeError, ValueError)):
+        composition_block(data)
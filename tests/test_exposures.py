@@ -0,0 +1,18 @@
+import os
+from api.exposures import ExposureStore, composition_block
+from api.portfolio import stored_product_ids
+
+
+def test_writers_sharing_the_directory_keep_their_chunks(tmp_path):
+    """Shards of a run start with the same chunk count : the second one must not overwrite the first chunk"""
+    block = composition_block([{"x": "2024-01", "Europe": 100}])
+    first, second = ExposureStore(str(tmp_path), chunk_rows=1), ExposureStore(str(tmp_path), chunk_rows=1)
+
+    first.append(1, [1], [block])
+    second.append(2, [1], [block])
+    first.append(3, [1], [block])
+    first.close()
+    second.close()
+
+    assert sorted(os.listdir(tmp_path)) == ["exposures-00000.npz", "exposures-00001.npz", "exposures-00002.npz"]
+    assert stored_product_ids(str(tmp_path)).tolist() == [1, 2, 3]
@@ -0,0 +1,27 @@
+import pytest
+from api.fields import COMPOSITION, PAGE, SEARCH, field_plan
+from benchmark import synthetic_isins
+from quantalys_mock import read_csv, run_main, write_isins
+
+ISINS = synthetic_isins(12)
+
+
+def test_plan_only_needs_the_endpoints_of_its_columns():
+    assert field_plan(["Rating SRRI"]).endpoints == {PAGE}
+    assert field_plan(["Secteur et Style", "Nom du fond"]).endpoints == {COMPOSITION, SEARCH}
+    assert field_plan(["Rating SRRI"], ["nVolat3a"]).endpoints == {PAGE, SEARCH}
+    assert field_plan().endpoints == {SEARCH, PAGE, COMPOSITION}
+
+
+def test_unknown_column():
+    with pytest.raises(ValueError):
+        field_plan(["Rating"])
+
+
+def test_columns(tmp_path, quantalys):
+    run_main(tmp_path, quantalys, "--input", write_isins(tmp_path, ISINS), "-o", "out.csv",
+             "--columns", "Rating SRRI")
+
+    assert list(read_csv(tmp_path / "out.csv")[0]) == ["", "ISIN", "Rating SRRI"]
+    assert quantalys.requests["page"] == len(ISINS)
+    assert quantalys.requests["composition"] == 0  # Not needed by the columns
@@ -0,0 +1,53 @@
+import asyncio
+from api.hedging import HedgeConfig, Hedger
+from api.scheduler import Scheduler, SchedulerConfig
+from httpx import Response
+
+
+def slow_first_request(scheduler: Scheduler, in_flight: list):
+    calls = []
+
+    async def send():
+        calls.append(len(calls))
+        in_flight.append(scheduler.in_flight)
+        await asyncio.sleep(0.5 if len(calls) == 1 else 0.01)
+        return Response(200)
+
+    return send
+
+
+def primed_hedger() -> Hedger:
+    hedger = Hedger(HedgeConfig(min_samples=1, min_delay=0.01, max_ratio=1))
+    hedger.record("page", 0.01)
+    return hedger
+
+
+def test_duplicate_takes_a_slot_of_its_own():
+    async def scenario():
+        scheduler = Scheduler(SchedulerConfig(max_in_flight=2, requests_per_second=1000, burst=1000))
+        hedger = primed_hedger()
+        in_flight = []
+        send = slow_first_request(scheduler, in_flight)
+
+        await scheduler.run(lambda: hedger.run("page", send, scheduler.run_once))
+        assert hedger.stats.won == 1
+        assert in_flight == [1, 2]  # The duplicate holds the second slot
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_duplicate_waits_for_a_free_slot():
+    """No duplicate beyond the in-flight limit : the original request holds the only slot"""
+    async def scenario():
+        scheduler = Scheduler(SchedulerConfig(max_in_flight=1, requests_per_second=1000, burst=1000))
+        hedger = primed_hedger()
+        in_flight = []
+        send = slow_first_request(scheduler, in_flight)
+
+        await scheduler.run(lambda: hedger.run("page", send, scheduler.run_once))
+        assert hedger.stats.hedged == 1 and hedger.stats.won == 0
+        assert in_flight == [1]  # The duplicate never got the slot, and was cancelled
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,15 @@
+import datetime
+from api.history import History
+
+
+def test_unparsable_value_is_recorded_as_missing(tmp_path):
+    """Quantalys answers "N/D" in numeric columns : the run goes on, and the value is missing"""
+    with History(str(tmp_path / "history.sqlite")) as history:
+        history.start_run("first.csv", datetime.datetime(2026, 9, 1).timestamp())
+        assert history.record({"ISIN": "LU0000000000", "Rating SRRI": "N/D", "Perf. 1 an": "Non disponible"}) == 2
+
+        history.start_run("second.csv", datetime.datetime(2026, 9, 2).timestamp())
+        assert history.record({"ISIN": "LU0000000000", "Rating SRRI": "5", "Perf. 1 an": "N/D"}) == 1
+
+        [change] = history.changes("Rating SRRI", datetime.datetime(2026, 9, 1, 12))
+        assert (change.isin, change.before, change.after) == ("LU0000000000", None, 5)
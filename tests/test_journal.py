@@ -0,0 +1,71 @@
+from api.journal import Journal, completed_entries, materialize, read_journal
+from benchmark import synthetic_isins
+from quantalys_mock import read_csv, run_main, write_isins
+
+ISINS = synthetic_isins(12)
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    with Journal(path) as journal:
+        journal.append(0, {"ISIN": "LU0000000000", "Rating SRRI": 3})
+        journal.append(1, {"ISIN": "LU0000000001"})  # Failed
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"position": 2, "row": {"IS')  # Killed while writing
+
+    assert [position for position, _ in read_journal(path)] == [0, 1]
+    assert completed_entries(path) == {(0, "LU0000000000")}  # The failed fund is retried
+
+    # The resumed run starts on a fresh line
+    with Journal(path, resume=True) as journal:
+        journal.append(1, {"ISIN": "LU0000000001", "Rating SRRI": 5})
+    assert dict(read_journal(path))[1] == {"ISIN": "LU0000000001", "Rating SRRI": 5}
+
+
+def test_latest_result_of_a_position_wins(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    with Journal(path) as journal:
+        journal.append(1, {"ISIN": "LU0000000001"})
+        journal.append(0, {"ISIN": "LU0000000000", "Rating SRRI": 3})
+        journal.append(1, {"ISIN": "LU0000000001", "Rating SRRI": 5})
+
+    assert materialize([path], str(tmp_path / "out.csv")) == 2
+    assert read_csv(tmp_path / "out.csv") == [{"": "0", "ISIN": "LU0000000000", "Rating SRRI": "3"},
+                                              {"": "1", "ISIN": "LU0000000001", "Rating SRRI": "5"}]
+
+
+def test_merge_of_shards(tmp_path):
+    """Rows are read back from the journals by offset : the shards, their order and a cut character must not matter"""
+    paths = [str(tmp_path / "shard-0.jsonl"), str(tmp_path / "shard-1.jsonl")]
+    with Journal(paths[0]) as first, Journal(paths[1]) as second:
+        second.append(3, {"ISIN": "LU0000000003", "Nom": "Fonds é"})
+        first.append(2, {"ISIN": "LU0000000002", "Nom": "Fonds à", "Rating SRRI": 4})
+        first.append(0, {"ISIN": "LU0000000000"})
+        second.append(1, {"ISIN": "LU0000000001", "Rating SRRI": 2})
+    with open(paths[0], "a", encoding="utf-8") as file:
+        file.write('{"position": 0, "row": {"ISIN": "LU0000000000", "Nom": "Fonds é"}}\n')
+    with open(paths[1], "ab") as file:
+        file.write('{"position": 1, "row": {"Nom": "é'.encode()[:-1])  # Killed in the middle of a character
+
+    assert materialize(paths, str(tmp_path / "out.csv")) == 4
+    assert read_csv(tmp_path / "out.csv") == [
+        {"": "0", "ISIN": "LU0000000000", "Nom": "Fonds é", "Rating SRRI": ""},
+        {"": "1", "ISIN": "LU0000000001", "Nom": "", "Rating SRRI": "2"},
+        {"": "2", "ISIN": "LU0000000002", "Nom": "Fonds à", "Rating SRRI": "4"},
+        {"": "3", "ISIN": "LU0000000003", "Nom": "Fonds é", "Rating SRRI": ""}]
+
+
+def test_resume(tmp_path, quantalys):
+    isins = write_isins(tmp_path, ISINS)
+    run_main(tmp_path, quantalys, "--input", isins, "-o", "full.csv")
+
+    # Interrupted after 5 funds, while writing the 6th one
+    lines = (tmp_path / "full.jsonl").read_text(encoding="utf-8").splitlines(keepends=True)
+    (tmp_path / "out.jsonl").write_text("".join(lines[:5]) + lines[5][:20], encoding="utf-8")
+    quantalys.requests.clear()
+
+    output = run_main(tmp_path, quantalys, "--input", isins, "-o", "out.csv", "--resume", "out.jsonl")
+
+    assert "5 funds already done" in output
+    assert read_csv(tmp_path / "out.csv") == read_csv(tmp_path / "full.csv")
+    assert quantalys.requests["search"] == len(ISINS) - 5
@@ -0,0 +1,59 @@
+import asyncio
+from api.data import COMPOSITION_TYPES
+from api.pipeline import enumerated
+from api.session import Session, SessionConfig
+from benchmark import synthetic_isins
+from quantalys_mock import fetch_rows
+
+
+def test_identical_requests_in_flight_share_a_response(quantalys):
+    async def scenario():
+        async with Session(SessionConfig(base_url=quantalys.server.base_url)) as session:
+            responses = await asyncio.gather(*(session.get("/Fonds/4242", endpoint="page") for _ in range(5)))
+            assert len({response.text for response in responses}) == 1
+
+    asyncio.run(scenario())
+    assert quantalys.requests["page"] == 1
+
+
+def test_repeated_isin_is_fetched_once(quantalys):
+    isins = synthetic_isins(3)
+
+    async def stream():
+        for position, isin in enumerate(isins + isins[:1]):  # Repeated while in flight
+            yield position, isin
+        await asyncio.sleep(0.5)
+        yield 4, isins[1]  # Repeated once done
+
+    rows = fetch_rows(quantalys, stream())
+
+    assert rows[3] == rows[0] and rows[4] == rows[1]
+    assert quantalys.requests["search"] == quantalys.requests["page"] == len(isins)
+
+
+def test_share_classes_share_their_fund_page(quantalys):
+    isins = synthetic_isins(10)
+    quantalys.search_columns = {isin: {"ID_Produit": 4242} for isin in isins}
+
+    rows = fetch_rows(quantalys, enumerated(isins))
+
+    assert sorted(rows) == list(range(len(isins)))
+    assert len({row["Rating SRRI"] for row in rows.values()}) == 1
+    assert quantalys.requests["page"] == 1
+    assert quantalys.requests["composition"] == len(COMPOSITION_TYPES)  # Once for the fund
+
+
+def test_failed_fund_is_fetched_again(quantalys):
+    """A failed fund is not reused for the same ISIN later in the input"""
+    isin = synthetic_isins(1)[0]
+    quantalys.failures[isin] = 1
+
+    async def isins():
+        yield 0, isin
+        await asyncio.sleep(0.5)  # After the failure
+        yield 1, isin
+
+    rows = fetch_rows(quantalys, isins())
+
+    assert rows[0] == {"ISIN": isin}
+    assert len(rows[1]) > 1
@@ -0,0 +1,18 @@
+from api.metrics import LATENCY_WINDOW, Metrics
+
+
+def test_latencies_are_bounded():
+    metrics = Metrics()
+    for _ in range(LATENCY_WINDOW + 10):
+        metrics.record_request("fund", 1.0, 200, 100, 0, "miss")
+        metrics.record_stage("parse", 0.5)
+
+    assert len(metrics.endpoints["fund"].latencies) == LATENCY_WINDOW
+    assert len(metrics.stages["parse"].durations) == LATENCY_WINDOW
+
+    # The counters still cover every call
+    stats = metrics.to_dict()
+    assert stats["endpoints"]["fund"]["latency_total_s"] == LATENCY_WINDOW + 10
+    assert stats["stages"]["parse"]["calls"] == LATENCY_WINDOW + 10
+    assert f'quantalys_request_duration_seconds_count{{endpoint="fund"}} {LATENCY_WINDOW + 10}' in \
+        metrics.to_prometheus()
@@ -0,0 +1,37 @@
+import asyncio
+import httpx
+from api.fixtures import FixtureStore
+from api.mock_server import MockServerConfig, start_mock_server
+from api.session import Session, SessionConfig
+from benchmark import synthetic_response
+
+
+def test_recorded_responses_are_replayed(tmp_path):
+    store = FixtureStore(str(tmp_path / "fixtures"))
+    live = start_mock_server(None, fallback=synthetic_response)
+    replay = start_mock_server(store)
+
+    async def fetch(base_url: str, recorder: FixtureStore | None = None) -> httpx.Response:
+        async with Session(SessionConfig(base_url=base_url), recorder=recorder) as session:
+            return await session.post("/Fonds/GetCompoTableAndGraph", endpoint="composition",
+                                      data={"ID_Produit": 4242, "typeCompo": "1"})
+
+    try:
+        recorded = asyncio.run(fetch(live.base_url, store))
+        replayed = asyncio.run(fetch(replay.base_url))
+        assert replayed.content == recorded.content
+        assert replayed.headers["content-type"] == recorded.headers["content-type"]
+
+        assert httpx.get(f"{replay.base_url}/Fonds/4242").status_code == 404  # Not recorded
+    finally:
+        live.shutdown()
+        replay.shutdown()
+
+
+def test_errors_are_injected():
+    server = start_mock_server(None, MockServerConfig(error_rate=1.0, seed=0), fallback=synthetic_response)
+    try:
+        assert httpx.get(f"{server.base_url}/Fonds/4242").status_code == 503
+        assert server.stats.errors == 1
+    finally:
+        server.shutdown()
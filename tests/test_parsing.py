@@ -0,0 +1,54 @@
+import math
+import pytest
+import api.data
+from api.data import parse_fonds_page
+from benchmark import synthetic_fonds_page
+
+# Pages built around the cases the label lookups must agree on : a fund without SRRI, labels appearing twice
+# (the last <dt> and the first <td> win), nested markup and entities in the values
+EDGE_PAGES = [
+    """<html><body><dl><dt>Catégorie Quantalys </dt><dd><a>Actions Monde</a></dd></dl>
+<table><tr><td> Perf. 1er janvier</td><td>1,0 %</td></tr><tr><td> Perf. 1 an</td><td>-</td></tr>
+<tr><td> Perf. 3 ans</td><td></td></tr><tr><td> Perf. 5 ans</td><td>N/D</td></tr></table></body></html>""",
+    """<html><body><div class="indic-srri indic-srri-selected">3</div>
+<dl><dt>Catégorie Quantalys </dt><dd><a>Obligations</a></dd>
+<dt>Catégorie Quantalys </dt><dd><span>Zone</span> <a>Actions <b>Europe</b> &amp; Asie</a></dd></dl>
+<table><tr><td> Perf. 1er janvier</td><td><span>2,5</span> %</td></tr>
+<tr><td> Perf. 1 an</td><td>&minus;4,2&nbsp;%</td></tr><tr><td> Perf. 1 an</td><td>99 %</td></tr>
+<tr><td> Perf. 3 ans</td><td>12 %</td></tr><tr><td> Perf. 5 ans</td><td>30 %</td></tr></table></body></html>""",
+    """<html><body><div class="indic-srri">1</div><div class="indic-srri indic-srri-selected">7</div>
+<dl><dt>Catégorie Quantalys</dt><dd><a>Actions Monde</a></dd><dt>Catégorie Quantalys </dt><dd><a>Diversifiés</a></dd>
+</dl><table><tr><td>Perf. 1 an</td><td>0 %</td></tr><tr><td> Perf. 1er janvier</td><td>é %</td></tr>
+<tr><td> Perf. 1 an</td><td>5 %</td></tr><tr><td> Perf. 3 ans</td><td>6 %</td></tr>
+<tr><td> Perf. 5 ans</td><td>7 %</td></tr></table></body></html>""",
+]
+
+
+def parse_with_beautifulsoup(monkeypatch, content: bytes, encoding: str):
+    with monkeypatch.context() as patch:
+        patch.setattr(api.data, "lxml_html", None)
+        return parse_fonds_page(content, encoding)
+
+
+def comparable(fields):
+    """NaN SRRI ratings are not equal to themselves"""
+    return {**fields, "srri_rating": None if math.isnan(fields["srri_rating"]) else fields["srri_rating"]}
+
+
+@pytest.mark.skipif(api.data.lxml_html is None, reason="lxml is not installed")
+@pytest.mark.parametrize("html", [synthetic_fonds_page(product_id) for product_id in range(1, 21)] + EDGE_PAGES)
+def test_lxml_and_beautifulsoup_extract_the_same_fields(monkeypatch, html):
+    """There is no recorded fixture in the repository : the synthetic pages of the benchmark stand in for them"""
+    for encoding in ("utf-8", "latin-1"):
+        content = html.encode(encoding, errors="replace")
+        assert comparable(parse_fonds_page(content, encoding)) == comparable(
+            parse_with_beautifulsoup(monkeypatch, content, encoding))
+
+
+def test_edge_page_fields(monkeypatch):
+    fields = parse_with_beautifulsoup(monkeypatch, EDGE_PAGES[1].encode(), "utf-8")
+    assert fields["srri_rating"] == 3
+    assert fields["geo_zone"] == "Europe"
+    assert fields["performances"]["Perf. 1 an"] == "−4,2\xa0%"
+
+    assert math.isnan(parse_fonds_page(EDGE_PAGES[0].encode(), "utf-8")["srri_rating"])
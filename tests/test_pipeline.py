@@ -0,0 +1,32 @@
+import asyncio
+from benchmark import synthetic_isins
+from quantalys_mock import fetch_rows, read_csv, run_main, write_isins
+
+ISINS = synthetic_isins(12)
+
+
+def test_output_rows(tmp_path, quantalys):
+    run_main(tmp_path, quantalys, "--input", write_isins(tmp_path, ISINS), "-o", "out.csv")
+
+    rows = read_csv(tmp_path / "out.csv")
+    assert [row["ISIN"] for row in rows] == ISINS
+    assert [row[""] for row in rows] == [str(position) for position in range(len(ISINS))]
+    assert all(row["Rating SRRI"] and row["Perf. 1 an"] and row["Nom du fond"] for row in rows)
+    assert quantalys.requests["search"] == quantalys.requests["page"] == len(ISINS)
+
+
+def test_rows_are_emitted_while_the_input_streams(quantalys):
+    """A fund is fetched as soon as it is read, without waiting for the end of the input"""
+    emitted_before_the_end = []
+
+    async def isins():
+        for position, isin in enumerate(ISINS[:3]):
+            yield position, isin
+        await asyncio.sleep(1)
+        emitted_before_the_end.append(quantalys.requests["page"])
+        yield 3, ISINS[3]
+
+    rows = fetch_rows(quantalys, isins())
+
+    assert sorted(rows) == [0, 1, 2, 3]
+    assert emitted_before_the_end == [3]
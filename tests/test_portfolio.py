@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import api.exposures
+from api.exposures import ExposureStore, composition_block
+from api.portfolio import LAST, MEAN, load_exposure_matrices, portfolio_breakdowns, read_book
+from api.quantalys import TypeCompo
+
+GEO = TypeCompo.ActiviteGeographique.value
+SECTOR = TypeCompo.RepartitionSectorielle.value
+
+
+def test_read_book(tmp_path):
+    path = tmp_path / "book.csv"
+    path.write_text("ISIN;Montant\nlu0000000001;1 234,5\nLU0000000002\t12.5 %\n\nLU0000000001, 100\n",
+                    encoding="utf-8")
+
+    isins, weights = read_book(str(path))
+    assert isins == ["LU0000000001", "LU0000000002"]
+    assert weights.tolist() == [1334.5, 12.5]
+
+    path.write_text("LU0000000001 10\nLU0000000002 beaucoup\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="line 2"):
+        read_book(str(path))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Fund 1 : geographical table over 2 dates. Fund 2 : geographical table downloaded twice, and sector table.
+    Fund 3 has no table. One chunk per fund, so the category dictionaries of the chunks differ"""
+    downloads = iter([1.0, 2.0, 3.0])
+    monkeypatch.setattr(api.exposures, "time", lambda: next(downloads))
+
+    with ExposureStore(str(tmp_path), chunk_rows=1) as exposures:
+        exposures.append(1, [GEO], [composition_block([
+            {"x": "2024-01", "Europe": 60, "Asie": 40}, {"x": "2024-02", "Europe": 90, "Asie": 10}])])
+        exposures.append(2, [GEO, SECTOR], [composition_block([{"x": "2024-02", "Asie": 50, "Monde": 50}]),
+                                            composition_block([{"x": "2024-02", "Finance": 100}])])
+        exposures.append(2, [GEO], [composition_block([{"x": "2024-03", "Europe": 10, "Monde": 90}])])
+    return str(tmp_path)
+
+
+def breakdown_of(breakdowns, type_compo: TypeCompo):
+    [breakdown] = [breakdown for breakdown in breakdowns if breakdown.table == type_compo.name]
+    return dict(zip(breakdown.categories, breakdown.exposures.tolist())), breakdown.coverage
+
+
+@pytest.mark.parametrize("method, expected", [
+    (LAST, {"Europe": 70.0, "Monde": 22.5, "Asie": 7.5}),  # (300 * 90 + 100 * 10) / 400 for Europe
+    (MEAN, {"Europe": 58.75, "Monde": 22.5, "Asie": 18.75}),  # (300 * 75 + 100 * 10) / 400 for Europe
+])
+def test_weighted_breakdowns(store, method, expected):
+    # Amounts, not summing to 1 : fund 1, fund 2, an ISIN without product ID and a fund without data
+    product_ids = np.array([1, 2, -1, 3], dtype=np.int64)
+    weights = np.array([300.0, 100.0, 100.0, 100.0])
+
+    matrices = load_exposure_matrices(product_ids[product_ids >= 0], store, method)
+    assert matrices[TypeCompo.ActiviteGeographique].covered.tolist() == [True, True, False]
+    breakdowns = portfolio_breakdowns(product_ids, weights, matrices)
+
+    exposures, coverage = breakdown_of(breakdowns, TypeCompo.ActiviteGeographique)
+    assert list(exposures) == list(expected)  # Highest first
+    assert exposures == pytest.approx(expected)
+    assert coverage == pytest.approx(400 / 600)
+
+    assert breakdown_of(breakdowns, TypeCompo.RepartitionSectorielle) == (
+        {"Finance": pytest.approx(100.0)}, pytest.approx(100 / 600))
+    assert breakdown_of(breakdowns, TypeCompo.DecompositionParStyle) == ({}, 0.0)
+
+
+def test_breakdowns_without_data(tmp_path):
+    product_ids = np.array([-1, 7], dtype=np.int64)
+    breakdowns = portfolio_breakdowns(product_ids, np.array([1.0, 2.0]),
+                                      load_exposure_matrices(np.array([7]), str(tmp_path)))
+
+    assert len(breakdowns) == len(TypeCompo)
+    assert all(breakdown.categories == [] and breakdown.coverage == 0.0 for breakdown in breakdowns)
@@ -0,0 +1,36 @@
+from api.data import COMPOSITION_TYPES
+from api.snapshots import MONTHLY_DATE, PERFORMANCE_DATE
+from benchmark import synthetic_isins
+from quantalys_mock import read_csv, run_main, write_isins
+
+ISINS = synthetic_isins(12)
+
+
+def refresh(tmp_path, quantalys, output: str) -> str:
+    quantalys.requests.clear()
+    return run_main(tmp_path, quantalys, "--input", write_isins(tmp_path, ISINS), "-o", output,
+                    "--refresh", "snapshots.sqlite")
+
+
+def test_unchanged_funds_are_carried_forward(tmp_path, quantalys):
+    refresh(tmp_path, quantalys, "first.csv")
+    assert quantalys.requests["page"] == len(ISINS)
+
+    refresh(tmp_path, quantalys, "second.csv")
+
+    # Nothing changed : only the searches, the other values are carried forward
+    assert quantalys.requests["search"] == len(ISINS)
+    assert quantalys.requests["page"] == 0 and quantalys.requests["composition"] == 0
+    assert read_csv(tmp_path / "second.csv") == read_csv(tmp_path / "first.csv")
+
+
+def test_only_the_changed_parts_are_fetched(tmp_path, quantalys):
+    refresh(tmp_path, quantalys, "first.csv")
+
+    quantalys.search_columns = {ISINS[0]: {PERFORMANCE_DATE: "2025-01-02"},  # New performances
+                                ISINS[1]: {MONTHLY_DATE: "2025-01-31"}}  # New composition tables
+    refresh(tmp_path, quantalys, "second.csv")
+
+    assert quantalys.requests["page"] == 1
+    assert quantalys.requests["composition"] == len(COMPOSITION_TYPES)
+    assert read_csv(tmp_path / "second.csv") == read_csv(tmp_path / "first.csv")  # Same synthetic values
@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from api.scheduler import Scheduler, SchedulerConfig
+from httpx import ConnectError, ProxyError, ReadTimeout, Response, UnsupportedProtocol
+
+
+def test_cancelled_waiter_passes_the_slot_on():
+    """A waiter cancelled after being woken up must not keep the other waiters waiting for the free slot"""
+    async def scenario():
+        scheduler = Scheduler(SchedulerConfig(max_in_flight=1))
+        await scheduler.acquire_slot()
+        first = asyncio.create_task(scheduler.acquire_slot())
+        second = asyncio.create_task(scheduler.acquire_slot())
+        await asyncio.sleep(0)  # Both wait for the slot
+
+        await scheduler.release_slot()
+        first.cancel()  # Woken up, then cancelled before it takes the slot (e.g. its deadline expired)
+
+        await asyncio.wait_for(second, 1)
+        assert scheduler.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_in_flight_limit():
+    async def scenario():
+        scheduler = Scheduler(SchedulerConfig(max_in_flight=3, requests_per_second=1000, burst=1000))
+        in_flight = []
+
+        async def send():
+            in_flight.append(scheduler.in_flight)
+            await asyncio.sleep(0.01)
+            return Response(200)
+
+        await asyncio.gather(*(scheduler.run(send) for _ in range(20)))
+        assert max(in_flight) == 3
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("error, attempts", [(ReadTimeout, 3), (ConnectError, 3), (ProxyError, 1),
+                                             (UnsupportedProtocol, 1)])
+def test_only_transient_errors_are_retried(error, attempts):
+    async def scenario():
+        scheduler = Scheduler(SchedulerConfig(max_retries=2, backoff_base=0))
+        sent = []
+
+        async def send():
+            sent.append(1)
+            raise error("failed")
+
+        with pytest.raises(error):
+            await scheduler.run(send)
+        assert len(sent) == attempts
+        assert scheduler.in_flight == 0
+
+    asyncio.run(scenario())
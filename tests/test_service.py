@@ -0,0 +1,76 @@
+import asyncio
+import json
+from api.mock_server import start_mock_server
+from api.session import Session, SessionConfig
+from api.service import FundServer, FundService
+from benchmark import synthetic_response
+from http import HTTPStatus
+
+UNKNOWN = "LU9999999998"
+UNREACHABLE = "LU9999999999"
+
+
+def fallback(method, path, form):
+    """Synthetic funds, except one unknown to the search and one whose search always fails"""
+    isin = form.get("sNomOrISIN", form.get("sSearch"))
+    if isin == UNKNOWN:
+        body = {"data": [], "recordsFiltered": 0} if path == "/Recherche/Data" else []
+        return 200, "application/json; charset=utf-8", json.dumps(body).encode()
+    if isin == UNREACHABLE:
+        return 400, "text/plain", b"Bad request"
+    return synthetic_response(method, path, form)
+
+
+def test_failed_fetch_is_not_a_missing_fund():
+    """A fund that could not be fetched is a 502, to be tried again, an unknown fund a 404"""
+    server = start_mock_server(None, fallback=fallback)
+
+    async def scenario():
+        async with Session(SessionConfig(base_url=server.base_url)) as session:
+            server_app = FundServer(FundService(session))
+
+            status, _, body = await server_app.respond("GET", "/fund/LU0000000001", b"")
+            assert status == HTTPStatus.OK
+            assert json.loads(body)["ISIN"] == "LU0000000001"
+
+            status, _, _ = await server_app.respond("GET", f"/fund/{UNKNOWN}", b"")
+            assert status == HTTPStatus.NOT_FOUND
+
+            status, _, _ = await server_app.respond("GET", f"/fund/{UNREACHABLE}", b"")
+            assert status == HTTPStatus.BAD_GATEWAY
+
+            request = json.dumps({"isins": ["LU0000000001", UNREACHABLE], "columns": ["Rating SRRI"]}).encode()
+            status, _, body = await server_app.respond("POST", "/funds", request)
+            assert status == HTTPStatus.OK
+            assert json.loads(body)["failed"] == [UNREACHABLE]
+            assert json.loads(body)["funds"][1] == {"ISIN": UNREACHABLE}
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.shutdown()
+
+
+def test_pipeline_metrics_add_up_over_batches():
+    """Every batch runs its own pipelines : /metrics counts the funds of all of them"""
+    server = start_mock_server(None, fallback=fallback)
+
+    async def scenario():
+        async with Session(SessionConfig(base_url=server.base_url)) as session:
+            server_app = FundServer(FundService(session))
+
+            # Two plans in the same batch : two pipelines at the same time
+            await asyncio.gather(server_app.respond("GET", "/fund/LU0000000001?columns=Rating SRRI", b""),
+                                 server_app.respond("GET", "/fund/LU0000000002?columns=Zone Géo", b""))
+            await server_app.respond("GET", "/fund/LU0000000003", b"")
+
+            status, _, body = await server_app.respond("GET", "/metrics", b"")
+            assert status == HTTPStatus.OK
+            assert 'quantalys_pipeline_processed_total{stage="resolve"} 3' in body.decode()
+            assert 'quantalys_pipeline_processed_total{stage="emit"} 3' in body.decode()
+            assert 'quantalys_pipeline_queue_depth{stage="resolve"} 0' in body.decode()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.shutdown()
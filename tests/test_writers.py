@@ -0,0 +1,31 @@
+import sqlite3
+from api.fields import INTEGER, NUMBER, PERCENT, TEXT
+from api.writers import SqliteWriter, typed_value
+
+
+def test_typed_values():
+    assert typed_value(PERCENT, "12,3 %") == 12.3
+    assert typed_value(NUMBER, "1 234,5") == 1234.5
+    assert typed_value(INTEGER, "7") == 7
+    assert typed_value(TEXT, 7) == "7"
+    assert typed_value(NUMBER, "-") is None
+
+
+def test_values_that_are_not_numbers_are_missing():
+    for value in ("N/D", "n.c.", "Non disponible", "12,3 % (est.)"):
+        assert typed_value(PERCENT, value) is None
+        assert typed_value(NUMBER, value) is None
+        assert typed_value(INTEGER, value) is None
+    assert typed_value(INTEGER, float("inf")) is None
+
+
+def test_odd_cell_does_not_stop_the_output(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    with SqliteWriter(path, {"ISIN": TEXT, "Rating SRRI": INTEGER, "Perf. 1 an": PERCENT}) as writer:
+        writer.write(0, {"ISIN": "LU0000000000", "Rating SRRI": "N/D", "Perf. 1 an": "12,3 %"})
+        writer.write(1, {"ISIN": "LU0000000001", "Rating SRRI": 4, "Perf. 1 an": "Non disponible"})
+
+    db = sqlite3.connect(path)
+    assert db.execute("SELECT * FROM results ORDER BY position").fetchall() == [
+        (0, "LU0000000000", None, 12.3), (1, "LU0000000001", 4, None)]
+    db.close()